@@ -570,11 +570,13 @@ class DaapLibrary(collection.Library):
         self.daap_share = daap_share
         #self.collection = col
 
-    def rescan(self, notify_interval=None, force_update=False):
+    def rescan(self, notify_interval=None, force_update=False,
+            deep_verify=False, progress=None):
         '''
             Called when a library needs to refresh its track list.
 
-            The force_update parameter is not applicable and is ignored.
+            The force_update, deep_verify and progress parameters are not
+            applicable and are ignored.
         '''
         if self.collection is None:
             return True
@@ -606,14 +608,6 @@ class DaapLibrary(collection.Library):
         self.scanning = False
         #return True
 
-    # Needed to be overriden for who knows why (exceptions)
-    def _count_files(self):
-        count = 0
-        if self.daap_share:
-            count = len(self.daap_share.all)
-
-        return count
-
 
 class NetworkPanel(CollectionPanel):
     """
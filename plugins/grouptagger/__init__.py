@@ -226,12 +226,14 @@ class GroupTaggerPlugin(object):
         dialog.destroy()
         
         if len(groups) > 0:
+            tracks_groups = []
             for track in tracks:
                 existing = get_track_groups(track)
                 if add:
-                    set_track_groups(track, existing | groups)
+                    tracks_groups.append((track, existing | groups))
                 else:
-                    set_track_groups(track, existing - groups)
+                    tracks_groups.append((track, existing - groups))
+            set_tracks_groups(tracks_groups)
     
     def on_add_tags(self, widget, name, parent, context, exaile):
         self._add_rm_multi_tags(True, context, exaile)
@@ -29,6 +29,7 @@
 #
 
 
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import GObject
  
@@ -43,7 +44,7 @@ from xl import (
 )
 
 from xl.nls import gettext as _
-from xl.trax import search
+from xl.trax import search, TagWriteJob
 
 from xlgui import guiutil, main
 from xlgui.widgets import menu, dialogs
@@ -95,7 +96,7 @@ def set_track_groups(track, groups):
         Returns true if successful, false if there was an error
     '''
     
-    grouping = ' '.join( sorted( [ '_'.join( group.split() ) for group in groups ] ) )
+    grouping = _get_grouping(groups)
     track.set_tag_raw(get_tagname(), grouping )
     
     if not track.write_tags():
@@ -104,6 +105,31 @@ def set_track_groups(track, groups):
         
     return True
 
+def set_tracks_groups(tracks_groups, on_success=None):
+    '''
+        Given (track, groups) pairs, sets the groups on each track,
+        writing several files at a time in the background
+        
+        Calls on_success on the main thread if all files were written,
+        shows an error otherwise
+    '''
+    
+    tagname = get_tagname()
+    job = TagWriteJob([ (track, {tagname: _get_grouping(groups)})
+                        for track, groups in tracks_groups ])
+    job.connect('done', lambda job: GLib.idle_add(_on_groups_written, job, on_success))
+    job.start()
+    
+def _on_groups_written(job, on_success):
+    if job.errors:
+        dialogs.error( None, "Error writing tags to %s" % GObject.markup_escape_text(
+            ', '.join( track.get_loc_for_io() for track, error in job.errors ) ) )
+    elif on_success is not None:
+        on_success()
+
+def _get_grouping(groups):
+    return ' '.join( sorted( [ '_'.join( group.split() ) for group in groups ] ) )
+
     
 def get_group_categories():
     '''
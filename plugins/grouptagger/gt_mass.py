@@ -123,6 +123,7 @@ class GtMassRename(Gtk.Window):
         if dialogs.yesno(self, query) != Gtk.ResponseType.YES:
             return 
 
+        tracks_groups = []
         for track in tracks:
             
             groups = gt_common._get_track_groups(track, self.tagname)
@@ -133,9 +134,12 @@ class GtMassRename(Gtk.Window):
             if self.replace_str != '':
                 groups.add(self.replace_str)
             
-            if not gt_common.set_track_groups(track, groups):
-                return
+            tracks_groups.append((track, groups))
         
+        self.replace.set_sensitive(False)
+        gt_common.set_tracks_groups(tracks_groups, self.on_renamed)
+    
+    def on_renamed(self):
         dialogs.info(self, "Tags successfully renamed!")
         self.reset()
 
@@ -0,0 +1,404 @@
+
+import os
+import shutil
+import tempfile
+
+from gi.repository import Gio
+from gi.repository import GLib
+import pytest
+
+from xl import collection
+from xl import common
+from xl import event
+from xl.trax import track
+
+
+@pytest.yield_fixture()
+def library_dir():
+    tmpdir = tempfile.mkdtemp()
+    location = os.path.join(tmpdir, 'music')
+    shutil.copytree(os.path.join('tests', 'data', 'music'), location)
+    yield location
+    shutil.rmtree(tmpdir)
+
+
+def make_library(location, **kwargs):
+    track.Track._Track__tracksdict.clear()
+    coll = collection.Collection('test')
+    library = collection.Library(Gio.File.new_for_path(location).get_uri(),
+                                 **kwargs)
+    coll.add_library(library)
+    return coll, library
+
+
+class TestRescan(object):
+
+    @pytest.mark.parametrize('workers', [1, 4])
+    def test_rescan(self, library_dir, workers):
+        coll, library = make_library(library_dir, scan_workers=workers)
+        try:
+            library.rescan()
+            locs = sorted(tr.get_local_path() for tr in coll.get_tracks())
+            assert len(locs) == 17
+            assert all(loc.startswith(library_dir) for loc in locs)
+
+            os.remove(locs[0])
+            library.rescan()
+            assert len(coll) == 16
+        finally:
+            coll.close()
+
+    def test_remove_library(self, library_dir):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            other = track.Track(Gio.File.new_for_path(
+                library_dir + '2').get_uri() + '/foo.mp3', scan=False)
+            coll.add(other)
+            coll.remove_library(library)
+            assert coll.get_tracks() == [other]
+        finally:
+            coll.close()
+
+    def test_serialize_scan_workers(self):
+        coll, library = make_library('/nonexistent', scan_workers=2)
+        try:
+            serial = coll.serialize_libraries()
+            assert serial[0]['scan_workers'] == 2
+        finally:
+            coll.close()
+
+    def test_unchanged_not_read(self, library_dir, monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            reads = []
+            monkeypatch.setattr(track.Track, 'read_tags',
+                                lambda tr, *args, **kwargs: reads.append(tr))
+            tracks = set(coll.get_tracks())
+            library.rescan()
+            # files that aren't tracks are tried again on every scan
+            assert not tracks.intersection(reads)
+            library.rescan(force_update=True)
+            assert tracks.issubset(reads)
+        finally:
+            coll.close()
+
+    def test_unlisted_directory_kept(self, library_dir, monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            unlisted = os.path.join(library_dir, 'delerium')
+            list_directory = common.list_directory
+
+            def failing_list_directory(dir, root=None):
+                if dir.get_path() == unlisted:
+                    raise GLib.Error('listing failed')
+                return list_directory(dir, root)
+            monkeypatch.setattr(common, 'list_directory',
+                                failing_list_directory)
+            library.rescan()
+            assert len(coll) == 17
+            os.remove(os.path.join(library_dir, 'delerium', 'chimera',
+                                   '05 - Truly.wav'))
+            library.rescan()
+            assert len(coll) == 16
+        finally:
+            coll.close()
+
+
+def set_old_mtimes(location):
+    for dirpath, dirnames, filenames in os.walk(location):
+        os.utime(dirpath, (1000000000, 1000000000))
+
+
+class TestDirectoryCache(object):
+
+    def test_unchanged_skipped(self, library_dir, monkeypatch):
+        set_old_mtimes(library_dir)
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            assert len(library._dir_cache) == 6
+            totals = library.scan_totals
+
+            listed = []
+            list_directory = common.list_directory
+
+            def recording_list_directory(dir, root=None):
+                listed.append(dir.get_path())
+                return list_directory(dir, root)
+            monkeypatch.setattr(common, 'list_directory',
+                                recording_list_directory)
+            library.rescan()
+            assert listed == []
+            assert len(coll) == 17
+            # the files of skipped directories are still counted
+            assert library.scan_totals == totals
+
+            # new files change the mtime of their directory
+            first = os.path.join(library_dir, 'testartist', 'first')
+            shutil.copy(os.path.join(first, '1-black.ogg'),
+                        os.path.join(first, '3-grey.ogg'))
+            library.rescan()
+            assert listed == [first]
+            assert len(coll) == 18
+
+            del listed[:]
+            library.rescan(force_update=True)
+            assert len(listed) == 6
+        finally:
+            coll.close()
+
+    def test_full_scan_interval(self, library_dir, monkeypatch):
+        set_old_mtimes(library_dir)
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            assert library._last_full_scan > 0
+            library._last_full_scan -= collection.FULL_SCAN_INTERVAL + 1
+            # not listed again after the first scan otherwise
+            os.remove(os.path.join(library_dir, 'delerium', 'chimera',
+                                   '05 - Truly.wav'))
+            set_old_mtimes(library_dir)
+            library.rescan()
+            assert len(coll) == 16
+        finally:
+            coll.close()
+
+
+class TestScanProgress(object):
+
+    def test_estimate(self):
+        progress = collection.ScanProgress(expected_files=10,
+                                           expected_bytes=1000)
+        assert progress.get_fraction() == 0
+        assert progress.get_eta() is None
+        progress.files_found = progress.files_done = 5
+        progress.bytes_found = progress.bytes_done = 250
+        assert progress.get_percent() == 25
+        assert progress.get_eta() >= 0
+        progress.walked = True
+        assert progress.get_percent() == 99
+        progress.finished = True
+        assert progress.get_percent() == 100
+
+    def test_rescan_libraries(self, library_dir):
+        coll, library = make_library(library_dir)
+        updates = []
+
+        def on_progress(type, obj, progress):
+            updates.append((progress.files_done, progress.get_totals(),
+                            progress.finished))
+        event.add_callback(on_progress, 'scan_progress_update', coll)
+        try:
+            coll.rescan_libraries()
+            assert library.scan_totals[0] == 18
+            assert updates[-1] == (18, library.scan_totals, True)
+
+            # the next scan knows the totals from the start
+            del updates[:]
+            coll.rescan_libraries(force_update=True)
+            assert updates[0][1] == library.scan_totals
+            serial = coll.serialize_libraries()
+            assert serial[0]['scan_totals'] == library.scan_totals
+        finally:
+            event.remove_callback(on_progress, 'scan_progress_update', coll)
+            coll.close()
+
+
+class TestScanEvents(object):
+
+    def test_batched(self, library_dir, monkeypatch):
+        monkeypatch.setattr(collection, 'SCAN_BATCH_SIZE', 10)
+        coll, library = make_library(library_dir)
+        added = []
+        changed = []
+
+        def on_added(type, obj, locations):
+            added.append(len(locations))
+
+        def on_changed(type, tr, tag):
+            changed.append((tr, tag))
+        event.add_callback(on_added, 'tracks_added', coll)
+        event.add_callback(on_changed, 'track_tags_changed')
+        try:
+            library.rescan()
+            assert sorted(added) == [7, 10]
+            assert changed == []
+
+            # rereading unchanged files changes nothing
+            library.rescan(force_update=True)
+            assert changed == []
+        finally:
+            event.remove_callback(on_added, 'tracks_added', coll)
+            event.remove_callback(on_changed, 'track_tags_changed')
+            coll.close()
+
+
+class TestLibraryMonitor(object):
+
+    def send(self, library, path, event):
+        library.monitor.on_location_changed(None, Gio.File.new_for_path(path),
+                                            None, event)
+
+    def test_changes_coalesced(self, library_dir, monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            album = os.path.join(library_dir, 'testartist', 'first')
+            copy = os.path.join(library_dir, 'copy')
+            shutil.copytree(album, copy)
+            shutil.rmtree(os.path.join(library_dir, 'delerium'))
+
+            updates = []
+            update_directories = library.update_directories
+            monkeypatch.setattr(library, 'update_directories',
+                                lambda locations: updates.append(
+                                    update_directories(locations)))
+            self.send(library, copy, Gio.FileMonitorEvent.CREATED)
+            for name in os.listdir(copy):
+                for e in (Gio.FileMonitorEvent.CREATED,
+                          Gio.FileMonitorEvent.CHANGED,
+                          Gio.FileMonitorEvent.CHANGES_DONE_HINT):
+                    self.send(library, os.path.join(copy, name), e)
+            self.send(library, os.path.join(library_dir, 'delerium'),
+                      Gio.FileMonitorEvent.DELETED)
+            assert len(coll) == 17
+
+            library.monitor._LibraryMonitor__update()
+            assert len(updates) == 1
+            paths = set(tr.get_local_path() for tr in coll.get_tracks())
+            assert len(paths) == 7
+            assert set(os.path.join(copy, name)
+                       for name in os.listdir(copy)) < paths
+        finally:
+            coll.close()
+
+    def test_poll_without_watches(self, library_dir, monkeypatch):
+        monkeypatch.setattr(collection, '_get_watch_limit', lambda: 0)
+        coll, library = make_library(library_dir)
+        try:
+            monitor = library.monitor
+            monitor.props.monitored = True
+            monitor._LibraryMonitor__update_monitors()
+            assert monitor._LibraryMonitor__monitors == {}
+            assert monitor._LibraryMonitor__polling
+        finally:
+            coll.close()
+
+
+class TestMoves(object):
+
+    def test_moved_tracks_kept(self, library_dir, monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            album = os.path.join(library_dir, 'testartist', 'first')
+            moved = os.path.join(library_dir, 'testartist', 'moved')
+            tracks = dict((tr.get_local_path(), tr)
+                          for tr in coll.get_tracks()
+                          if tr.get_local_path().startswith(album))
+            assert len(tracks) == 2
+            for tr in tracks.itervalues():
+                assert tr.get_tag_raw('__fingerprint')
+                tr.set_tag_raw('__playcount', 3)
+
+            os.rename(album, moved)
+            shutil.copytree(os.path.join(library_dir, 'testartist', 'second'),
+                            os.path.join(library_dir, 'copy'))
+            reads = []
+            read_tags = track.Track.read_tags
+
+            def recording_read_tags(tr, *args, **kwargs):
+                reads.append(tr.get_local_path())
+                return read_tags(tr, *args, **kwargs)
+            monkeypatch.setattr(track.Track, 'read_tags', recording_read_tags)
+            library.rescan()
+
+            assert len(coll) == 20
+            for path, tr in tracks.iteritems():
+                new_path = path.replace(album, moved)
+                assert tr.get_local_path() == new_path
+                assert coll.get_track_by_loc(tr.get_loc_for_io()) is tr
+                assert tr.get_tag_raw('__playcount') == 3
+                assert tr.get_tag_raw('__basedir') == moved
+                assert new_path not in reads
+            # copies are new tracks
+            assert len([r for r in reads if "/copy/" in r]) == 3
+        finally:
+            coll.close()
+
+    def test_unchanged_tracks_not_fingerprinted(self, library_dir,
+                                                monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            for tr in coll.get_tracks():
+                tr.set_tag_raw('__fingerprint', None, notify_changed=False)
+            fingerprinted = []
+            get_fingerprint = collection.trax.util.get_fingerprint
+
+            def recording_get_fingerprint(gloc, size=None):
+                fingerprinted.append(gloc.get_uri())
+                return get_fingerprint(gloc, size)
+            monkeypatch.setattr(collection.trax.util, 'get_fingerprint',
+                                recording_get_fingerprint)
+            library.rescan(deep_verify=True)
+            assert fingerprinted == []
+            assert all(tr.get_tag_raw('__fingerprint') is None
+                       for tr in coll.get_tracks())
+        finally:
+            coll.close()
+
+    def test_candidates_fingerprinted_once(self, library_dir, monkeypatch):
+        coll, library = make_library(library_dir)
+        try:
+            library.rescan()
+            # copies have the sizes of tracks, but none of those is gone
+            shutil.copytree(os.path.join(library_dir, 'testartist', 'second'),
+                            os.path.join(library_dir, 'copy'))
+            fingerprinted = []
+            get_fingerprint = collection.trax.util.get_fingerprint
+
+            def recording_get_fingerprint(gloc, size=None):
+                fingerprinted.append(gloc.get_path())
+                return get_fingerprint(gloc, size)
+            monkeypatch.setattr(collection.trax.util, 'get_fingerprint',
+                                recording_get_fingerprint)
+            library.rescan()
+            assert len(coll) == 20
+            # only to be stored with the new tracks
+            assert sorted(fingerprinted) == sorted(
+                tr.get_local_path() for tr in coll.get_tracks()
+                if '/copy/' in tr.get_local_path())
+        finally:
+            coll.close()
+
+
+class TestCompilations(object):
+
+    def make_track(self, name, basedir, album, artist):
+        tr = track.Track('file://%s/%s.mp3' % (basedir, name), scan=False)
+        tr.set_tag_raw('__basedir', basedir)
+        tr.set_tag_raw('album', album)
+        tr.set_tag_raw('artist', artist)
+        return tr
+
+    def test_update_compilations(self):
+        track.Track._Track__tracksdict.clear()
+        various = [self.make_track(str(i), '/various', u'Hits', u'Artist %d' % i)
+                   for i in range(200)]
+        album = [self.make_track(str(i), '/album', u'Hits', u'Band')
+                 for i in range(3)]
+        untagged = self.make_track('x', '/various', None, u'Band')
+        collection.update_compilations(various + album + [untagged])
+        assert all(tr.get_tag_raw('__compilation') == ('/various', u'hits')
+                   for tr in various)
+        assert all(tr.get_tag_raw('__compilation') is None
+                   for tr in album + [untagged])
+
+        for tr in various[1:]:
+            tr.set_tag_raw('artist', u'Artist 0')
+        collection.update_compilations(various)
+        assert all(tr.get_tag_raw('__compilation') is None for tr in various)
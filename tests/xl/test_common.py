@@ -0,0 +1,44 @@
+
+import threading
+
+from xl import common
+
+
+class TestWorkerPool(object):
+
+    def test_results(self):
+        for workers in (1, 4):
+            pool = common.WorkerPool(workers)
+            jobs = [pool.submit(pow, i, 2) for i in range(20)]
+            assert [job.get() for job in jobs] == [i * i for i in range(20)]
+            pool.close()
+
+    def test_error(self):
+        pool = common.WorkerPool(2)
+        job = pool.submit(int, 'x')
+        try:
+            job.get()
+        except ValueError:
+            pass
+        else:
+            assert False, "no exception"
+        pool.close()
+
+    def test_cancel(self):
+        pool = common.WorkerPool(2)
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def block():
+            started.release()
+            release.wait()
+            return True
+        jobs = [pool.submit(block) for i in range(2)]
+        # wait until both workers are busy
+        started.acquire()
+        started.acquire()
+        cancelled = pool.submit(block)
+        pool.close(cancel=True)
+        release.set()
+        assert [job.get() for job in jobs] == [True, True]
+        assert cancelled.get() is None
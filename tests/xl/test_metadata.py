@@ -0,0 +1,79 @@
+import glob
+import os
+import shutil
+import tempfile
+
+from gi.repository import Gio
+from mutagen import flac, id3
+import pytest
+
+from xl import metadata
+
+
+def get_uri(path):
+    return Gio.File.new_for_path(path).get_uri()
+
+
+class TestProbe(object):
+
+    @pytest.mark.parametrize('path', sorted(
+        glob.glob(os.path.join('tests', 'data', 'music', '*', '*', '*'))))
+    def test_same_as_read_all(self, path):
+        uri = get_uri(path)
+        result = metadata.probe(uri)
+        f = metadata.get_format(uri)
+        if f is None:
+            assert result is None
+            return
+        assert result.tags == f.read_all()
+        assert result.format is type(f)
+        if type(f) in metadata.probes:
+            assert result.bytes_read <= os.path.getsize(path)
+        else:
+            assert result.bytes_read is None
+
+    def test_flac_picture_skipped(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cover.flac')
+            shutil.copy(os.path.join('tests', 'data', 'music', 'delerium',
+                                     'chimera', '05 - Truly.flac'), path)
+            f = flac.FLAC(path)
+            picture = flac.Picture()
+            picture.data = b'\0' * 1000000
+            f.add_picture(picture)
+            f.save()
+
+            result = metadata.probe(get_uri(path))
+            assert result.bytes_read < 1000
+            assert result.tags == metadata.get_format(get_uri(path)).read_all()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_mp3_picture_skipped(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cover.mp3')
+            shutil.copy(os.path.join('tests', 'data', 'music', 'delerium',
+                                     'chimera', '05 - Truly.mp3'), path)
+            tags = id3.ID3(path)
+            tags.add(id3.APIC(encoding=3, mime=u'image/jpeg', type=3,
+                              desc=u'', data=b'\0' * 1000000))
+            tags.save()
+
+            result = metadata.probe(get_uri(path))
+            assert result.bytes_read < 100000
+            assert result.tags == metadata.get_format(get_uri(path)).read_all()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fallback(self, monkeypatch):
+        def failing_probe(path, formatclass):
+            raise metadata._probe.ProbeError()
+        monkeypatch.setitem(metadata.probes, metadata.ogg.OggFormat,
+                            failing_probe)
+        uri = get_uri(os.path.join('tests', 'data', 'music', 'testartist',
+                                   'first', '1-black.ogg'))
+        result = metadata.probe(uri)
+        assert result.bytes_read is None
+        assert result.tags == metadata.get_format(uri).read_all()
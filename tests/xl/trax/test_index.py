@@ -0,0 +1,176 @@
+
+from xl.trax import search
+from xl.trax import track
+from xl.trax import trackdb
+
+
+def make_track(name, **tags):
+    tr = track.Track('file:///index/%s.mp3' % name, scan=False)
+    for tag, value in tags.iteritems():
+        tr.set_tag_raw(tag, value)
+    return tr
+
+
+class TestSearchIndex(object):
+
+    def setup(self):
+        track.Track._Track__tracksdict.clear()
+        self.db = trackdb.TrackDB()
+        self.foo = make_track('foo', artist=u'Foo Fighters', title=u'Everlong')
+        self.bar = make_track('bar', artist=u'Bar', title=[u'One', u'Two'])
+        self.baz = make_track('baz', artist=u'Jazz Band', album=u'Foo')
+        self.db.add_tracks([self.foo, self.bar, self.baz])
+        self.index = self.db.get_search_index()
+
+    def test_find_containing(self):
+        find = self.index.find_containing
+        assert find('artist', u'foo') == set([self.foo])
+        assert find('artist', u'o f') == set([self.foo])
+        assert find('artist', u'a') == set([self.bar, self.baz])
+        assert find('title', u'tw') == set([self.bar])
+        assert find('artist', u'nothing') == set()
+
+    def test_find_not_narrowed(self):
+        assert self.index.find_containing('artist', u' ') is None
+        assert self.index.find_containing('__length', u'1') is None
+
+    def test_albumartist(self):
+        # albumartist is searched in the artist tag
+        assert self.index.find_containing('albumartist', u'jazz') == \
+            set([self.baz])
+        self.baz.set_tag_raw('artist', u'Swing Band')
+        assert self.index.find_containing('albumartist', u'jazz') == set()
+
+    def test_basename(self):
+        # __basename is derived from __loc
+        assert self.index.find_equal('__basename', u'foo.mp3') == \
+            set([self.foo])
+        self.db.relocate_tracks([(self.foo, 'file:///index/renamed.mp3')])
+        assert self.index.find_equal('__basename', u'foo.mp3') == set()
+        assert self.index.find_equal('__basename', u'renamed.mp3') == \
+            set([self.foo])
+
+    def test_updates(self):
+        find = self.index.find_containing
+        assert find('artist', u'fight') == set([self.foo])
+
+        self.foo.set_tag_raw('artist', u'Nirvana', notify_changed=False)
+        assert find('artist', u'fight') == set()
+        assert find('artist', u'nirv') == set([self.foo])
+
+        self.db.remove(self.foo)
+        assert find('artist', u'nirv') == set()
+        assert 'nirvana' not in self.index._tag_indexes['artist'].tokens
+
+        qux = make_track('qux', artist=u'Nirvana')
+        self.db.add(qux)
+        assert find('artist', u'nirv') == set([qux])
+
+    def test_search_tracks(self):
+        tracks = [self.baz, self.bar, self.foo]
+        for query, keyword_tags, expected in [
+                (u'foo', ['artist', 'album'], [self.baz, self.foo]),
+                (u'foo', ['artist'], [self.foo]),
+                (u'artist=a', None, [self.baz, self.bar]),
+                (u'artist=a | title=ever', None, tracks),
+                (u'! artist=a', None, [self.foo]),
+                (u'artist=a title=two', None, [self.bar]),
+                (u'band', [], []),
+                ]:
+            matcher = search.TracksMatcher(query, case_sensitive=False,
+                keyword_tags=keyword_tags)
+            assert matcher.candidates(self.index) is None or \
+                set(expected) <= matcher.candidates(self.index)
+            result = [s.track for s in search.search_tracks(tracks,
+                [matcher], index=self.index)]
+            assert result == expected, query
+            result = [s.track for s in search.search_tracks(self.db,
+                [matcher])]
+            assert sorted(result) == sorted(expected), query
+
+    def test_case_sensitive(self):
+        tracks = [self.foo, self.bar, self.baz]
+        result = search.search_tracks_from_string(tracks, u'Foo',
+            keyword_tags=['artist'], index=self.index)
+        assert [s.track for s in result] == [self.foo]
+        result = search.search_tracks_from_string(tracks, u'FOO',
+            keyword_tags=['artist'], index=self.index)
+        assert list(result) == []
+
+    def test_find_equal(self):
+        find = self.index.find_equal
+        assert find('artist', u'foo fighters') == set([self.foo])
+        assert find('artist', u'foo') == set()
+        assert find('title', u'two') == set([self.bar])
+        assert find('album', None) == set([self.foo, self.bar])
+        assert find('__loc', self.foo.get_loc_for_io()) == set([self.foo])
+        # numbers are compared as floats by the matcher
+        assert find('__length', u'0.0') == set([self.foo, self.bar, self.baz])
+
+        self.foo.set_tag_raw('album', u'Foo')
+        assert find('album', None) == set([self.bar])
+        assert find('album', u'foo') == set([self.foo, self.baz])
+
+    def test_search_exact(self):
+        tracks = [self.baz, self.bar, self.foo]
+        for query, expected in [
+                (u'artist=="Foo Fighters"', [self.foo]),
+                (u'artist=="foo fighters"', []),
+                (u'album==__null__', [self.bar, self.foo]),
+                (u'album==__null__ title=="One"', [self.bar]),
+                (u'! album==__null__', [self.baz]),
+                ]:
+            matcher = search.TracksMatcher(query)
+            result = [s.track for s in search.search_tracks(tracks,
+                [matcher], index=self.index)]
+            assert result == expected, query
+
+    def test_find_range(self):
+        self.foo.set_tag_raw('__playcount', 3)
+        self.bar.set_tag_raw('__playcount', 10)
+        self.foo.set_tag_raw('__last_played', 1000.5)
+        greater, less = self.index.find_greater, self.index.find_less
+        assert greater('__playcount', u'2') == set([self.foo, self.bar])
+        assert greater('__playcount', u'3') == set([self.bar])
+        assert less('__playcount', u'3') == set([self.baz])
+        assert greater('__playcount', u'x') == set()
+        # tracks without the tag count as 0
+        assert less('__last_played', u'1') == set([self.bar, self.baz])
+        assert greater('__last_played', u'1') == set([self.foo])
+        assert self.index.find_equal('__playcount', u'10.00001') == \
+            set([self.bar])
+
+        self.bar.set_tag_raw('__playcount', 1)
+        assert greater('__playcount', u'2') == set([self.foo])
+        self.db.remove(self.foo)
+        assert greater('__playcount', u'0') == set([self.bar])
+
+    def test_range_batches(self):
+        assert self.index.find_greater('__playcount', u'0') == set()
+        tracks = [make_track('batch%d' % i, **{'__playcount': i})
+                  for i in range(40)]
+        self.db.add_tracks(tracks)
+        assert self.index.find_greater('__playcount', u'29') == \
+            set(tracks[30:])
+        self.db.remove_tracks(tracks[20:35])
+        assert self.index.find_greater('__playcount', u'9') == \
+            set(tracks[10:20] + tracks[35:])
+        numeric = self.index._numeric_indexes['__playcount']
+        assert numeric.keys == sorted(numeric.keys)
+        assert len(numeric.keys) == 25
+
+    def test_search_range(self):
+        tracks = [self.baz, self.bar, self.foo]
+        self.foo.set_tag_raw('__rating', 80)
+        self.bar.set_tag_raw('__rating', 40)
+        for query, expected in [
+                (u'__rating>60', [self.foo]),
+                (u'__rating<60', [self.baz, self.bar]),
+                (u'__rating>20 __rating<60', [self.bar]),
+                (u'__rating==40', [self.bar]),
+                (u'__rating>x', []),
+                ]:
+            matcher = search.TracksMatcher(query)
+            result = [s.track for s in search.search_tracks(tracks,
+                [matcher], index=self.index)]
+            assert result == expected, query
@@ -4,6 +4,7 @@ from mox3 import mox
 
 from xl.trax import search
 from xl.trax import track
+from xl.trax import trackdb
 import pytest
 
 
@@ -448,3 +449,195 @@ class TestSearchTracks(object):
         assert gen.next().track == tracks[2]
         with pytest.raises(StopIteration):
             gen.next()
+
+
+class TestCompiledMatcher(object):
+
+    QUERIES = [
+        u"foo",
+        u"artist==foo",
+        u"artist==__null__",
+        u"! foo",
+        u"foo | bar",
+        u"( fo | ba ) ! album=x",
+        u"title~^Ba",
+        u"__rating>40",
+        u"__rating<40",
+        u"__rating==80",
+        u"__rating>x",
+        u"foo __rating>40 album==X",
+    ]
+
+    def setup(self):
+        self.tracks = [track.Track('file:///compiled/%d' % i, scan=False)
+                       for i in range(4)]
+        self.tracks[0].set_tag_raw('artist', [u'foo', u'Bar'])
+        self.tracks[0].set_tag_raw('__rating', 80)
+        self.tracks[1].set_tag_raw('artist', u'Foo')
+        self.tracks[1].set_tag_raw('album', u'X')
+        self.tracks[1].set_tag_raw('__rating', 60)
+        self.tracks[2].set_tag_raw('title', u'Baz')
+        self.tracks[2].set_tag_raw('__rating', 20)
+
+    @pytest.mark.parametrize("case_sensitive", [True, False])
+    @pytest.mark.parametrize("query", QUERIES)
+    def test_same_as_matchers(self, query, case_sensitive):
+        matcher = search.TracksMatcher(query, case_sensitive=case_sensitive,
+                keyword_tags=['artist', 'title'])
+        for tr in self.tracks:
+            expected = all(ma.match(search.SearchResultTrack(tr))
+                           for ma in matcher.matchers)
+            assert matcher.match(search.SearchResultTrack(tr)) == expected
+
+    def test_appended_matcher(self):
+        matcher = search.TracksMatcher("artist=foo")
+        matcher.match(search.SearchResultTrack(self.tracks[0]))
+        matcher.append_matcher(search.TracksInList(self.tracks[1:]))
+        assert not matcher.match(search.SearchResultTrack(self.tracks[0]))
+
+    def test_explain(self):
+        matcher = search.TracksMatcher("artist=foo __rating>x")
+        assert matcher.explain().splitlines() == [
+            u'__rating > x (never matches)  [passes ~0%, cost 0.0]',
+            u'artist = "foo"  [passes ~20%, cost 1.5]',
+        ]
+        assert search.TracksMatcher("").explain() == u"(matches all tracks)"
+
+
+class TestSearchSession(object):
+
+    def setup(self):
+        self.tracks = [track.Track('file:///session/%d' % i, scan=False)
+                       for i in range(3)]
+        self.tracks[0].set_tag_raw('artist', u'foobar')
+        self.tracks[1].set_tag_raw('artist', u'foo')
+        self.tracks[2].set_tag_raw('artist', u'bar')
+        self.session = search.SearchSession(case_sensitive=False)
+
+    def search(self, query, tracks=None):
+        results = self.session.search(tracks or self.tracks, query,
+                keyword_tags=['artist'])
+        return [srtr.track for srtr in results]
+
+    @pytest.mark.parametrize(("old", "new", "expected"), [
+        (u"foo", u"foob", True),
+        (u"foo", u"foo bar", True),
+        (u"", u"foo", True),
+        (u"foo", u"fo", False),
+        (u"foo", u"foo | bar", False),
+        (u"! foob", u"! foo", True),
+        (u"! foo", u"! foob", False),
+        (u"__rating>4", u"__rating>40", True),
+        (u"__rating<4", u"__rating<40", False),
+        (u"artist==foo", u"artist==foob", False),
+    ])
+    def test_implies(self, old, new, expected):
+        old = search.TracksMatcher(old, keyword_tags=['artist'])
+        new = search.TracksMatcher(new, keyword_tags=['artist'])
+        assert search._implies_all(new.matchers, old.matchers) == expected
+
+    def test_refine(self):
+        assert self.search(u'foo') == self.tracks[:2]
+        # only the last results are searched again
+        self.tracks[2].set_tag_raw('artist', u'foobar')
+        assert self.search(u'foob') == self.tracks[:1]
+        # a query that isn't a refinement searches everything
+        assert self.search(u'bar') == [self.tracks[0], self.tracks[2]]
+        self.session.reset()
+        assert self.search(u'foob') == [self.tracks[0], self.tracks[2]]
+
+    def test_other_tracks(self):
+        assert self.search(u'foo') == self.tracks[:2]
+        assert self.search(u'foob', self.tracks[2:]) == []
+
+    def test_cancel(self):
+        session = self.session
+
+        def tracks():
+            yield self.tracks[0]
+            session.cancel()
+            yield self.tracks[1]
+
+        with pytest.raises(search.SearchCancelled):
+            session.search(tracks(), u'foo', keyword_tags=['artist'])
+        # cancelled results are not reused
+        assert self.search(u'foob') == self.tracks[:1]
+
+    def test_refine_trackdb(self):
+        db = trackdb.TrackDB()
+        db.add_tracks(self.tracks)
+        assert sorted(self.search(u'foo', db)) == sorted(self.tracks[:2])
+        # the results of a changed TrackDB are not refined
+        self.tracks[2].set_tag_raw('artist', u'foobar')
+        assert sorted(self.search(u'foob', db)) == \
+            sorted([self.tracks[0], self.tracks[2]])
+
+    def test_trackdb_not_iterated(self, monkeypatch):
+        db = trackdb.TrackDB()
+        db.add_tracks(self.tracks)
+
+        def fail(self):
+            raise RuntimeError("dictionary changed size during iteration")
+        # other threads may add tracks while searching
+        monkeypatch.setattr(trackdb.TrackDB, '__iter__', fail)
+        assert sorted(self.search(u'foo', db)) == sorted(self.tracks[:2])
+        assert sorted(self.search(u'', db)) == sorted(self.tracks)
+
+
+class TestResultCache(object):
+
+    def setup(self):
+        search._result_cache.clear()
+        self.db = trackdb.TrackDB()
+        self.tracks = [track.Track('file:///cache/%d' % i, scan=False)
+                       for i in range(3)]
+        for tr, artist in zip(self.tracks, [u'foo', u'bar', u'foobar']):
+            tr.set_tag_raw('artist', artist)
+        self.db.add_tracks(self.tracks)
+
+    def search(self, query):
+        return search.search_tracks_from_string(self.db, query,
+                keyword_tags=['artist'])
+
+    def test_cached(self):
+        results = list(self.search(u'foo'))
+        assert sorted(r.track for r in results) == \
+            sorted([self.tracks[0], self.tracks[2]])
+        assert results[0].on_tags == ['artist']
+        assert len(search._result_cache) == 1
+
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(search, 'search_tracks')
+        self.mox.ReplayAll()
+        cached = list(self.search(u'foo'))
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+        assert [r.track for r in cached] == [r.track for r in results]
+        # the results can be modified without affecting the cache
+        assert cached[0] is not results[0]
+
+    def test_stale(self):
+        assert len(list(self.search(u'bar'))) == 2
+        self.tracks[0].set_tag_raw('artist', u'bar')
+        assert len(list(self.search(u'bar'))) == 3
+        self.db.remove(self.tracks[1])
+        assert len(list(self.search(u'bar'))) == 2
+
+    def test_limits(self):
+        assert list(self.search(u'')) and len(search._result_cache) == 0
+        cache = search._ResultCache(2, 3)
+        cache.put('a', (1, 2))
+        cache.put('b', (3,))
+        cache.get('a')
+        cache.put('c', (4,))
+        # least recently used first
+        assert list(cache.entries) == ['a', 'c']
+        cache.put('d', (5, 6))
+        assert list(cache.entries) == ['c', 'd'] and cache.size == 3
+        # too large to be cached at all
+        cache.put('e', (1, 2, 3, 4))
+        assert list(cache.entries) == ['c', 'd']
+
+    def test_not_trackdb(self):
+        search.search_tracks_from_string(self.tracks, u'foo')
+        assert len(search._result_cache) == 0
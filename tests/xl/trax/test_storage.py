@@ -0,0 +1,72 @@
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from xl.trax import storage
+
+
+@pytest.yield_fixture()
+def tmpdir():
+    tmpdir = tempfile.mkdtemp()
+    yield tmpdir
+    shutil.rmtree(tmpdir)
+
+
+TRACKS = [
+    (0, {'__loc': u'file:///foo.mp3', 'artist': [u'foo', u'bar'],
+         '__length': 123.4, '__playcount': 3,
+         '__basedir': '/\xe9', '__compilation': ('/', u'album'),
+         'album': None}, {}),
+    (1, {'__loc': u'file:///bar.mp3', 'title': [u'b\xe4r']}, {'foo': 1}),
+]
+
+
+@pytest.mark.parametrize('engine', storage.ENGINES.values())
+class TestStorage(object):
+
+    def test_roundtrip(self, tmpdir, engine):
+        location = os.path.join(tmpdir, 'music')
+        with engine(location) as s:
+            assert s.get_version() is None
+            s.write_tracks(TRACKS)
+            s.set('name', u'Collection')
+            s.set('_dbversion', 2.0)
+            s.commit()
+
+        with engine(location) as s:
+            assert s.get_version() == 2.0
+            assert s.get('name') == u'Collection'
+            assert s.get('missing', 42) == 42
+            assert sorted(s.iter_tracks()) == TRACKS
+            assert s.get_track_count() == 2
+
+    def test_replace_and_delete(self, tmpdir, engine):
+        location = os.path.join(tmpdir, 'music')
+        with engine(location) as s:
+            s.write_tracks(TRACKS)
+            s.write_tracks([(0, {'__loc': u'file:///foo.mp3'}, {})])
+            s.delete_tracks([1])
+            s.commit()
+
+        with engine(location) as s:
+            assert list(s.iter_tracks()) == \
+                [(0, {'__loc': u'file:///foo.mp3'}, {})]
+
+    def test_uncommitted(self, tmpdir, engine):
+        if engine is storage.ShelveStorage:
+            pytest.skip("shelve writes are not transactional")
+        location = os.path.join(tmpdir, 'music')
+        with engine(location) as s:
+            s.write_tracks(TRACKS)
+
+        with engine(location) as s:
+            assert s.get_track_count() == 0
+
+
+def test_sqlite_tag_value_counts(tmpdir):
+    with storage.SQLiteStorage(os.path.join(tmpdir, 'music')) as s:
+        s.write_tracks(TRACKS + [(2, {'artist': [u'foo']}, {})])
+        assert s.get_tag_value_counts('artist') == {u'foo': 2, u'bar': 1}
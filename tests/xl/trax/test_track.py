@@ -74,6 +74,65 @@ class Test_MetadataCacher(object):
     def test_remove_not_exist(self):
         assert self.mc.remove('foo') == None
 
+    def stub_timeout(self):
+        self.mox.StubOutWithMock(GLib, 'timeout_add_seconds')
+        GLib.timeout_add_seconds(
+                mox.IsA(types.IntType),
+                mox.IsA(types.MethodType)).MultipleTimes().AndReturn(1)
+        self.mox.ReplayAll()
+
+    def test_least_recently_used_evicted(self):
+        self.stub_timeout()
+        mc = track._MetadataCacher(self.TIMEOUT, 3)
+        for key in ('a', 'b', 'c'):
+            mc.add(key, key.upper())
+        assert mc.get('a') == 'A'
+        mc.add('d', 'D')
+        assert mc.get('b') is None
+        assert [mc.get(key) for key in ('a', 'c', 'd')] == ['A', 'C', 'D']
+        assert (mc.hits, mc.misses) == (4, 1)
+
+    def test_mtime_changed(self, monkeypatch):
+        self.stub_timeout()
+        now = [1000.0]
+        monkeypatch.setattr(track.time, 'time', lambda: now[0])
+        self.mc.add('foo', 'bar', mtime=(1, 0))
+        now[0] += 2
+        assert self.mc.get('foo', lambda: (1, 0)) == 'bar'
+        now[0] += 2
+        assert self.mc.get('foo', lambda: (2, 0)) is None
+        assert self.mc.get('foo') is None
+
+    def test_mtime_checked_after_interval(self, monkeypatch):
+        self.stub_timeout()
+        now = [1000.0]
+        monkeypatch.setattr(track.time, 'time', lambda: now[0])
+        checks = []
+
+        def get_mtime():
+            checks.append(now[0])
+            return (1, 0)
+        self.mc.add('foo', 'bar', mtime=(1, 0))
+        assert self.mc.get('foo', get_mtime) == 'bar'
+        assert checks == []
+        now[0] += 2
+        assert self.mc.get('foo', get_mtime) == 'bar'
+        assert self.mc.get('foo', get_mtime) == 'bar'
+        assert checks == [1002.0]
+
+    def test_expired(self, monkeypatch):
+        self.stub_timeout()
+        now = [1000.0]
+        monkeypatch.setattr(track.time, 'time', lambda: now[0])
+        self.mc.add('foo', 'bar')
+        self.mc.add('baz', 'qux')
+        now[0] += self.TIMEOUT - 1
+        assert self.mc.get('baz') == 'qux'
+        now[0] += 2
+        self.mc._MetadataCacher__cleanup()
+        assert list(self.mc._cache) == ['baz']
+        assert self.mc.get('foo') is None
+
 def random_str(l=8):
     return ''.join(random.choice(string.ascii_letters) for _ in range(l))
 
@@ -478,6 +537,26 @@ class TestTrack(object):
         tr.set_tag_raw('coverart', u'foobar')
         assert tr.get_tag_sort('coverart') == ret
 
+    def test_get_sort_tag_cached(self):
+        tr = track.Track('/foo')
+        tr.set_tag_raw('artist', u'The Foo')
+        assert tr.get_tag_sort('artist') == u'foo the foo The Foo The Foo'
+        tr.set_tag_raw('artist', u'The Bar')
+        assert tr.get_tag_sort('artist') == u'bar the bar The Bar The Bar'
+        # the returned lists are copies
+        tr.get_tag_sort('artist', join=False).append(u'x')
+        assert len(tr.get_tag_sort('artist', join=False)) == 1
+
+        cuts = track.Track._Track__the_cuts
+        try:
+            settings.set_option('collection/strip_list', [])
+            track.Track._the_cuts_cb(None, None, 'collection/strip_list')
+            assert tr.get_tag_sort('artist') == \
+                u'the bar the bar The Bar The Bar'
+        finally:
+            settings.set_option('collection/strip_list', cuts)
+            track.Track._the_cuts_cb(None, None, 'collection/strip_list')
+
     ## Display Tags
     def test_get_display_tag_loc(self):
         tr = track.Track('/foo')
@@ -594,6 +673,19 @@ class TestTrack(object):
         tr.set_tag_raw('__bitrate', 48000)
         assert tr.get_tag_search('__bitrate') == '__bitrate=="48k" __bitrate=="48000"'
 
+    def test_get_search_values(self):
+        tr = track.Track('/foo')
+        tr.set_tag_raw('artist', [u'M\xf6tley Cr\xfce', u'foo'])
+        assert tr._get_search_values('artist') == (u'Motley Crue', u'foo')
+        assert tr._get_search_values('artist', True) == \
+            (u'motley crue', u'foo')
+        assert tr._get_search_values('album') == (None,)
+        # cached until the track changes
+        assert tr._get_search_values('artist') is \
+            tr._get_search_values('artist')
+        tr.set_tag_raw('artist', u'bar')
+        assert tr._get_search_values('albumartist') == (u'bar',)
+
     def test_get_disk_tag_invalid_format(self):
         tr = track.Track('/tmp/foo.bah')
         assert tr.get_tag_disk('artist') == None
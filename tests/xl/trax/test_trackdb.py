@@ -0,0 +1,144 @@
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from xl.trax import search
+from xl.trax import track
+from xl.trax import trackdb
+
+
+@pytest.yield_fixture()
+def db_location():
+    tmpdir = tempfile.mkdtemp()
+    yield os.path.join(tmpdir, 'music.db')
+    shutil.rmtree(tmpdir)
+
+
+class TestDirtyTracks(object):
+
+    def test_add_marks_dirty(self):
+        db = trackdb.TrackDB()
+        tr = track.Track('file:///foo.mp3', scan=False)
+        db.add(tr)
+        assert [h._track for h in db._dirty_tracks] == [tr]
+
+    def test_set_tag_marks_dirty(self, db_location):
+        db = trackdb.TrackDB(location=db_location)
+        tracks = [track.Track('file:///%s.mp3' % x, scan=False)
+                  for x in ('foo', 'bar', 'baz')]
+        db.add_tracks(tracks)
+        db.save_to_location()
+        assert not db._dirty_tracks
+
+        tracks[1].set_tag_raw('__playcount', 1, notify_changed=False)
+        assert [h._track for h in db._dirty_tracks] == [tracks[1]]
+
+    def test_remove_clears_dirty(self):
+        db = trackdb.TrackDB()
+        tr = track.Track('file:///foo.mp3', scan=False)
+        db.add(tr)
+        db.remove(tr)
+        assert not db._dirty_tracks
+
+    def test_untracked_track_not_dirty(self):
+        db = trackdb.TrackDB()
+        tr = track.Track('file:///foo.mp3', scan=False)
+        tr.set_tag_raw('artist', u'foo')
+        assert not db._dirty_tracks
+
+    def test_save_and_load(self, db_location):
+        db = trackdb.TrackDB(location=db_location)
+        tr = track.Track('file:///foo.mp3', scan=False)
+        tr.set_tag_raw('artist', u'foo')
+        db.add(tr)
+        db.save_to_location()
+
+        tr.set_tag_raw('artist', u'bar')
+        db.save_to_location()
+        del db, tr
+
+        db = trackdb.TrackDB(location=db_location)
+        tr = db.get_track_by_loc('file:///foo.mp3')
+        assert tr.get_tag_raw('artist') == [u'bar']
+
+
+class TestGeneration(object):
+
+    def test_changes(self):
+        db = trackdb.TrackDB()
+        tr = track.Track('file:///generation.mp3', scan=False)
+        generations = [db.get_generation()]
+        db.add(tr)
+        generations.append(db.get_generation())
+        tr.set_tag_raw('artist', u'foo')
+        generations.append(db.get_generation())
+        db.remove(tr)
+        generations.append(db.get_generation())
+        assert len(set(generations)) == 4
+
+        # tracks that aren't in the TrackDB don't affect it
+        tr.set_tag_raw('artist', u'bar')
+        assert db.get_generation() == generations[-1]
+        assert trackdb.TrackDB().get_generation() != generations[-1]
+
+    def test_search_session(self):
+        db = trackdb.TrackDB()
+        tracks = [track.Track('file:///session%d.mp3' % i, scan=False)
+                  for i in range(2)]
+        tracks[0].set_tag_raw('artist', u'foo')
+        db.add_tracks(tracks)
+        results = db.search_session(search.SearchSession(), u'foo',
+                                    keyword_tags=['artist'])
+        assert [srtr.track for srtr in results] == [tracks[0]]
+
+
+class TestLocations(object):
+
+    def test_get_locations_under(self):
+        db = trackdb.TrackDB()
+        locs = ['file:///music/a/1.mp3', 'file:///music/a/b/2.mp3',
+                'file:///music/ab/3.mp3', 'file:///other/4.mp3']
+        db.add_tracks([track.Track(loc, scan=False) for loc in locs])
+        assert db.get_locations_under('file:///music/a') == locs[:2]
+        assert db.get_locations_under('file:///music/a/') == locs[:2]
+        assert db.get_locations_under('file:///music') == locs[:3]
+        assert db.get_locations_under('file:///none') == []
+
+        db.remove(db.get_track_by_loc(locs[0]))
+        db.add(track.Track('file:///music/a/0.mp3', scan=False))
+        assert db.get_locations_under('file:///music/a') == \
+            ['file:///music/a/0.mp3', locs[1]]
+
+    def test_many(self):
+        db = trackdb.TrackDB()
+        tracks = [track.Track('file:///many/%03d.mp3' % i, scan=False)
+                  for i in range(200)]
+        db.add_tracks(tracks[100:])
+        assert len(db.get_locations_under('file:///many')) == 100
+        db.add_tracks(tracks[:100])
+        db.remove_tracks(tracks[50:150])
+        assert db.get_tracks_under('file:///many') == \
+            tracks[:50] + tracks[150:]
+
+    def test_relocate(self):
+        db = trackdb.TrackDB()
+        tracks = [track.Track('file:///old/%d.mp3' % i, scan=False)
+                  for i in range(3)]
+        db.add_tracks(tracks)
+        tracks[0].set_tag_raw('__playcount', 2)
+        assert db.get_locations_under('file:///old') == \
+            [tr.get_loc_for_io() for tr in tracks]
+
+        db.relocate_tracks([(tracks[0], 'file:///new/0.mp3'),
+                            (tracks[1], 'file:///old/2.mp3')])
+        assert db.get_locations_under('file:///new') == ['file:///new/0.mp3']
+        assert db.get_track_by_loc('file:///new/0.mp3') is tracks[0]
+        assert db.get_track_by_loc('file:///old/0.mp3') is None
+        # the location of tracks[2] is taken
+        assert db.get_track_by_loc('file:///old/1.mp3') is tracks[1]
+        assert tracks[0].get_tag_raw('__playcount') == 2
+        assert db.get_search_index().find_equal(
+            '__loc', 'file:///new/0.mp3') == set([tracks[0]])
@@ -1,11 +1,16 @@
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from mox3 import mox
 
 from gi.repository import Gio
+import pytest
 
 import xl.collection
+from xl import event, metadata
 import xl.trax.search
 import xl.trax.track
 import xl.trax.util
@@ -139,3 +144,131 @@ class TestSortResultTracks(object):
         assert xl.trax.util.sort_result_tracks(self.fields,
             self.tracks, True) == list(reversed(self.result))
 
+
+def test_get_album_tracks():
+    tracks = [xl.trax.track.Track('/tmp/album/%d' % i, scan=False)
+            for i in range(3)]
+    for track, artist, album in zip(tracks, u'aab', u'xyx'):
+        track.set_tag_raw('artist', artist)
+        track.set_tag_raw('album', album)
+    assert list(xl.trax.util.get_album_tracks(tracks, tracks[0])) == \
+        tracks[:1]
+
+class TestSortRanks(object):
+
+    def test_ranks(self):
+        ranks = xl.trax.util._SortRanks()
+        keys = [u'b', 3, u'a', 1.5]
+        assert sorted(keys, key=dict(zip(keys, ranks.get_ranks(keys))).get) \
+            == sorted(keys)
+        # a few new keys are fitted in between the others
+        ranks.GAP = 4
+        ranks._SortRanks__renumber(sorted(keys))
+        keys += [u'aa', u'ab', u'ac', u'c', 0]
+        assert sorted(keys, key=dict(zip(keys, ranks.get_ranks(keys))).get) \
+            == sorted(keys)
+        assert len(ranks._ranks) == len(keys)
+
+    def test_limit(self):
+        ranks = xl.trax.util._SortRanks()
+        ranks.LIMIT = 4
+        assert ranks.get_ranks([u'b', u'c', u'd']) == sorted(ranks._ranks.values())
+        # crossing the limit starts the table over with the requested keys
+        keys = [u'e', u'b', u'a', u'f']
+        result = ranks.get_ranks(keys)
+        assert sorted(keys, key=dict(zip(keys, result)).get) == sorted(keys)
+        assert sorted(ranks._ranks) == sorted(keys)
+
+    def test_unhashable_keys(self):
+        tracks = [xl.trax.track.Track('/tmp/unhashable/%d' % i, scan=False)
+                for i in range(2)]
+        tracks[0].set_tag_raw('__foo', [2])
+        tracks[1].set_tag_raw('__foo', [1])
+        assert xl.trax.util.sort_tracks(['__foo'], tracks) == tracks[::-1]
+
+
+@pytest.yield_fixture()
+def music_dir():
+    tmpdir = tempfile.mkdtemp()
+    source = os.path.join('tests', 'data', 'music', 'delerium', 'chimera')
+    for i in range(3):
+        shutil.copy(os.path.join(source, '05 - Truly.ogg'),
+                    os.path.join(tmpdir, '%d.ogg' % i))
+    shutil.copy(os.path.join(source, '05 - Truly.ogg'),
+                os.path.join(tmpdir, 'unknown.xyz'))
+    yield tmpdir
+    shutil.rmtree(tmpdir)
+
+
+class TestTagWriteJob(object):
+
+    def get_track(self, path):
+        return xl.trax.track.Track(Gio.File.new_for_path(path).get_uri())
+
+    def run_job(self, changes, workers=4):
+        job = xl.trax.util.TagWriteJob(changes, workers=workers)
+        progress = []
+        written = []
+        changed = []
+
+        def on_written(type, obj, data):
+            written.append((obj, data))
+
+        def on_changed(type, tr, tag):
+            changed.append((tr, tag))
+        job.connect('progress-update', lambda job, p: progress.append(p))
+        event.add_callback(on_written, 'tracks_tags_changed')
+        event.add_callback(on_changed, 'track_tags_changed')
+        try:
+            job.run()
+        finally:
+            event.remove_callback(on_written, 'tracks_tags_changed')
+            event.remove_callback(on_changed, 'track_tags_changed')
+        assert progress == [(n + 1, len(changes)) for n in range(len(changes))]
+        assert changed == []
+        return job, written
+
+    @pytest.mark.parametrize('workers', [1, 4])
+    def test_write(self, music_dir, workers):
+        tracks = [self.get_track(os.path.join(music_dir, '%d.ogg' % i))
+                  for i in range(3)]
+        changes = [(tr, {'genre': u'Genre %d' % i, 'artist': None})
+                   for i, tr in enumerate(tracks)]
+        job, written = self.run_job(changes, workers)
+
+        assert job.errors == []
+        assert written == [(job, [(tr, set(['genre', 'artist']))
+                                  for tr in tracks])]
+        for i, tr in enumerate(tracks):
+            assert tr.get_tag_raw('genre') == [u'Genre %d' % i]
+            assert tr.get_tag_raw('artist') is None
+            # deleted tags are removed from the track, as by write_tags
+            assert 'artist' not in tr._pickles()
+            f = metadata.get_format(tr.get_loc_for_io())
+            tags = f.read_tags(['genre', 'artist', 'title'])
+            assert tags['genre'] == [u'Genre %d' % i]
+            assert 'artist' not in tags
+            # tags that didn't change are kept
+            assert tags['title'] == [u'Truly']
+
+    def test_errors(self, music_dir):
+        good = self.get_track(os.path.join(music_dir, '0.ogg'))
+        bad = xl.trax.track.Track(Gio.File.new_for_path(
+            os.path.join(music_dir, 'unknown.xyz')).get_uri(), scan=False)
+        job, written = self.run_job([(bad, {'genre': u'Bad'}),
+                                     (good, {'genre': u'Good'})])
+
+        assert [(tr, type(e)) for tr, e in job.errors] == \
+            [(bad, metadata.NotWritable)]
+        assert bad.get_tag_raw('genre') is None
+        assert written == [(job, [(good, set(['genre']))])]
+        assert good.get_tag_raw('genre') == [u'Good']
+
+    def test_internal_tags(self, music_dir):
+        # internal tags aren't written, so the file isn't even opened
+        tr = xl.trax.track.Track(Gio.File.new_for_path(
+            os.path.join(music_dir, 'missing.ogg')).get_uri(), scan=False)
+        job, written = self.run_job([(tr, {'__rating': 80})])
+        assert job.errors == []
+        assert tr.get_tag_raw('__rating') == 80
+        assert written == [(job, [(tr, set(['__rating']))])]
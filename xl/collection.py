@@ -53,6 +53,29 @@ logger = logging.getLogger(__name__)
 
 COLLECTIONS = set()
 
+# number of threads reading tags while a library is scanned
+DEFAULT_SCAN_WORKERS = 4
+
+# new tracks found by a scan are added to the collection in batches of
+# at most this many tracks, or after this many seconds
+SCAN_BATCH_SIZE = 500
+SCAN_BATCH_TIME = 2
+
+# seconds after which a library is scanned completely again, including
+# the directories that don't seem to have changed
+FULL_SCAN_INTERVAL = 7 * 24 * 60 * 60
+
+# a monitored library is updated after no changes happened for this many
+# seconds, or after at most this many seconds of changes
+MONITOR_DELAY = 1
+MONITOR_MAX_DELAY = 10
+
+# seconds between rescans of a library that can't be watched completely
+MONITOR_POLL_INTERVAL = 5 * 60
+
+# number of directories watched if the system limit can't be determined
+DEFAULT_WATCH_LIMIT = 8192
+
 def get_collection_by_loc(loc):
     """
         gets the collection by a location.
@@ -66,6 +89,87 @@ def get_collection_by_loc(loc):
             return c
     return None
 
+def _get_watch_limit():
+    """
+        Returns the number of directories that may be watched by all
+        library monitors together
+    """
+    limit = settings.get_option('collection/monitor_watch_limit', 0)
+    if limit:
+        return limit
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            # leave some for other programs
+            return int(f.read()) // 2
+    except (IOError, ValueError):
+        return DEFAULT_WATCH_LIMIT
+
+def _join_values(value):
+    if not value or isinstance(value, basestring):
+        return value
+    try:
+        return u"\u0000".join(value)
+    except UnicodeDecodeError:
+        return "\0".join(value)
+
+def update_compilations(tracks):
+    """
+        This is the hacky way to find the tracks that are part of a
+        compilation.
+
+        Basically, if there is more than one track in a directory that
+        has the same album but different artist, we assume that it's part
+        of a compilation. The __compilation tag of these tracks is set to
+        a (basedir, album) tuple, and that of the other tracks is
+        removed.
+
+        The tracks are grouped by directory and album in a single pass,
+        so this takes linear time.
+
+        :param tracks: the tracks to check, which should include all
+            tracks of their directories
+    """
+    if not settings.get_option('collection/file_based_compilations', True):
+        return
+
+    # (basedir, album) -> (artists, tracks)
+    groups = {}
+    others = []
+    for tr in tracks:
+        try:
+            basedir = _join_values(tr.get_tag_raw('__basedir'))
+            album = _join_values(tr.get_tag_raw('album'))
+            artist = _join_values(tr.get_tag_raw('artist'))
+        except Exception:
+            logger.warning("Error while checking for compilation: %s", tr)
+            continue
+        if not basedir or not album or not artist:
+            others.append(tr)
+            continue
+        key = (basedir, album.lower())
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (set(), [])
+        group[0].add(artist.lower())
+        group[1].append(tr)
+
+    for key, (artists, group) in groups.iteritems():
+        if len(artists) > 1:
+            logger.debug("Compilation %(album)r detected in %(dir)r" %
+                    {'album': key[1], 'dir': key[0]})
+            _set_compilation(group, key)
+        else:
+            _set_compilation(group, None)
+    _set_compilation(others, None)
+
+def _set_compilation(tracks, compilation):
+    for tr in tracks:
+        current = tr.get_tag_raw('__compilation')
+        if current is not None:
+            current = tuple(current)
+        if current != compilation:
+            tr.set_tag_raw('__compilation', compilation)
+
 class CollectionScanThread(common.ProgressThread):
     """
         Scans the collection
@@ -108,11 +212,176 @@ class CollectionScanThread(common.ProgressThread):
         """
             Notifies about progress changes
         """
-        if progress < 100:
-            self.emit('progress-update', progress)
+        if not progress.finished:
+            self.emit('progress-update', progress.get_percent())
         else:
             self.emit('done')
 
+class ScanProgress(object):
+    """
+        The progress of a scan, sent with the "scan_progress_update"
+        event.
+
+        Files and their sizes are counted as they are found while
+        walking the libraries, and as they are processed. Until all
+        files have been found, the totals of the previous scan are used
+        as an estimate of the total.
+    """
+    def __init__(self, expected_files=0, expected_bytes=0):
+        """
+            :param expected_files: the number of files expected
+            :param expected_bytes: the total size of the files expected
+        """
+        self.started = time.time()
+        self.files_found = 0
+        self.bytes_found = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.expected_files = expected_files
+        self.expected_bytes = expected_bytes
+        #: whether all files have been found
+        self.walked = False
+        #: whether the scan is over
+        self.finished = False
+
+    def get_totals(self):
+        """
+            :returns: the number of files and bytes expected in total
+        """
+        if self.walked:
+            return self.files_found, self.bytes_found
+        return (max(self.files_found, self.expected_files),
+                max(self.bytes_found, self.expected_bytes))
+
+    def get_fraction(self):
+        """
+            :returns: how much of the scan is done, between 0 and 1, or
+                None if unknown
+        """
+        if self.finished:
+            return 1.0
+        files, bytes = self.get_totals()
+        if bytes:
+            fraction = self.bytes_done / float(bytes)
+        elif files:
+            fraction = self.files_done / float(files)
+        else:
+            return None
+        return min(fraction, 1.0)
+
+    def get_percent(self):
+        """
+            :returns: how much of the scan is done in percent; it stays
+                below 100 until the scan is over
+        """
+        if self.finished:
+            return 100
+        return min(int((self.get_fraction() or 0) * 100), 99)
+
+    def get_rate(self):
+        """
+            :returns: the number of bytes processed per second
+        """
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_done / elapsed
+
+    def get_eta(self):
+        """
+            :returns: the estimated number of seconds until the scan is
+                over, or None if unknown
+        """
+        fraction = self.get_fraction()
+        if self.finished:
+            return 0
+        if not fraction:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed / fraction - elapsed
+
+    def __str__(self):
+        eta = self.get_eta()
+        return "%d%%, %d of %d files, %.1f MB/s, ETA %s" % (
+                self.get_percent(), self.files_done, self.get_totals()[0],
+                self.get_rate() / 1000000,
+                '?' if eta is None else common.TimeSpan(eta))
+
+class _MoveFinder(object):
+    """
+        Recognizes the new files found in a library that are tracks of
+        the collection whose files were moved, by their fingerprints
+        (see :func:`xl.trax.util.get_fingerprint`).
+
+        While scanning, the new files with the size of a track of the
+        library are kept as candidates instead of being read. Once the
+        tracks whose files are gone are known, only the candidates with
+        the size of one of those are fingerprinted and paired with them.
+    """
+    def __init__(self, collection, location):
+        self.collection = collection
+        self.location = location
+        # new URI -> (gloc, fileinfo)
+        self.candidates = {}
+        self.__sizes = None
+        self.__lock = threading.Lock()
+
+    def add_candidate(self, gloc, fileinfo):
+        """
+            Keeps a new file as candidate if it could be a moved track
+
+            :returns: whether the file was kept
+        """
+        if not fileinfo.has_attribute("standard::size"):
+            return False
+        with self.__lock:
+            if self.__sizes is None:
+                # only looked at once there are new files
+                self.__sizes = set()
+                for tr in self.collection.get_tracks_under(self.location):
+                    fp = tr.get_tag_raw('__fingerprint')
+                    if fp is not None:
+                        self.__sizes.add(
+                                trax.util.get_fingerprint_size(fp))
+            if fileinfo.get_size() not in self.__sizes:
+                return False
+            self.candidates[gloc.get_uri()] = (gloc, fileinfo)
+            return True
+
+    def pair(self, removals):
+        """
+            Pairs the candidates with tracks that are about to be removed
+
+            :param removals: the tracks whose files are gone
+            :returns: a list of (track, gloc, fileinfo) tuples for the
+                tracks that were moved to gloc, and a list of
+                (gloc, fileinfo) tuples for the other candidates
+        """
+        fingerprints = {}
+        for tr in removals:
+            fp = tr.get_tag_raw('__fingerprint')
+            if fp is not None:
+                fingerprints.setdefault(fp, []).append(tr)
+        sizes = set(trax.util.get_fingerprint_size(fp) for fp in fingerprints)
+        moves = []
+        others = []
+        for uri, (gloc, fileinfo) in sorted(self.candidates.iteritems()):
+            tracks = None
+            size = fileinfo.get_size()
+            if size in sizes:
+                try:
+                    fp = trax.util.get_fingerprint(gloc, size)
+                except GLib.Error:
+                    logger.debug("Could not compute fingerprint of %s", uri,
+                            exc_info=True)
+                else:
+                    tracks = fingerprints.get(fp)
+            if tracks:
+                moves.append((tracks.pop(), gloc, fileinfo))
+            else:
+                others.append((gloc, fileinfo))
+        return moves, others
+
 class Collection(trax.TrackDB):
     """
         Manages a persistent track database.
@@ -132,18 +401,17 @@ class Collection(trax.TrackDB):
         5
         >>>
     """
-    def __init__(self, name, location=None, pickle_attrs=[]):
+    def __init__(self, name, location=None, pickle_attrs=[], storage=None):
         global COLLECTIONS
         self.libraries = {}
         self._scanning = False
         self._scan_stopped = False
-        self._running_count = 0
-        self._running_total_count = 0
+        self._scan_progress = None
         self._frozen = False
         self._libraries_dirty = False
         pickle_attrs += ['_serial_libraries']
         trax.TrackDB.__init__(self, name, location=location,
-                pickle_attrs=pickle_attrs)
+                pickle_attrs=pickle_attrs, storage=storage)
         COLLECTIONS.add(self)
 
     def freeze_libraries(self):
@@ -201,15 +469,11 @@ class Collection(trax.TrackDB):
                 del self.libraries[k]
                 break
 
-        to_rem = []
         if not "://" in library.location:
             location = u"file://" + library.location
         else:
             location = library.location
-        for tr in self.tracks:
-            if tr.startswith(location):
-                to_rem.append(self.tracks[tr]._track)
-        self.remove_tracks(to_rem)
+        self.remove_tracks(self.get_tracks_under(location))
 
         self.serialize_libraries()
         self._dirty = True
@@ -240,30 +504,34 @@ class Collection(trax.TrackDB):
         """
         if self._scanning:
             raise Exception("Collection is already being scanned")
-        if len(self.libraries) == 0:
-            event.log_event('scan_progress_update', self, 100)
+
+        libraries = [library for library in self.libraries.itervalues()
+                if force_update or not startup_only or
+                (library.monitored and library.startup_scan)]
+        # the totals of the last scans tell how much there is to scan
+        # before the libraries have been walked
+        progress = ScanProgress(
+                sum(library.scan_totals[0] for library in libraries),
+                sum(library.scan_totals[1] for library in libraries))
+        self._scan_progress = progress
+
+        if len(libraries) == 0:
+            progress.walked = progress.finished = True
+            event.log_event('scan_progress_update', self, progress)
             return # no libraries, no need to scan :)
 
         self._scanning = True
         self._scan_stopped = False
 
-        self.file_count = -1 # negative means we dont know it yet
-
-        self.__count_files()
-
         scan_interval = 20
 
-        for library in self.libraries.itervalues():
-            
-            if not force_update and startup_only and not (library.monitored and library.startup_scan):
-                continue
-            
+        for library in libraries:
             event.add_callback(self._progress_update, 'tracks_scanned',
                 library)
-            library.rescan(notify_interval=scan_interval, force_update=force_update)
+            library.rescan(notify_interval=scan_interval, force_update=force_update,
+                    deep_verify=force_update, progress=progress)
             event.remove_callback(self._progress_update, 'tracks_scanned',
                 library)
-            self._running_total_count += self._running_count
             if self._scan_stopped:
                 break
         else: # didnt break
@@ -273,41 +541,18 @@ class Collection(trax.TrackDB):
             except AttributeError:
                 logger.exception("Exception occurred while saving")
 
-        event.log_event('scan_progress_update', self, 100)
+        progress.walked = progress.finished = True
+        event.log_event('scan_progress_update', self, progress)
+        logger.info("Scan of %s finished: %s", self.name, progress)
 
-        self._running_total_count = 0
-        self._running_count = 0
         self._scanning = False
-        self.file_count = -1
-
-    @common.threaded
-    def __count_files(self):
-        file_count = 0
-        for library in self.libraries.values():
-            if self._scan_stopped:
-                self._scanning = False
-                return
-            file_count += library._count_files()
-        self.file_count = file_count
-        logger.debug("File count: %s"%self.file_count)
 
     def _progress_update(self, type, library, count):
         """
             Called when a progress update should be emitted while scanning
             tracks
         """
-        self._running_count = count
-        count = count + self._running_total_count
-
-        if self.file_count < 0:
-            event.log_event('scan_progress_update', self, 0)
-            return
-
-        try:
-            event.log_event('scan_progress_update', self,
-                int((float(count) / float(self.file_count)) * 100))
-        except ZeroDivisionError:
-            pass
+        event.log_event('scan_progress_update', self, self._scan_progress)
 
     def serialize_libraries(self):
         """
@@ -323,6 +568,10 @@ class Collection(trax.TrackDB):
             l['realtime'] = v.monitored
             l['scan_interval'] = v.scan_interval
             l['startup_scan'] = v.startup_scan
+            l['scan_workers'] = v.scan_workers
+            l['dir_cache'] = v._dir_cache
+            l['last_full_scan'] = v._last_full_scan
+            l['scan_totals'] = v.scan_totals
             _serial_libraries.append(l)
         return _serial_libraries
 
@@ -333,12 +582,24 @@ class Collection(trax.TrackDB):
             Should only be called once, from the constructor.
         """
         for l in _serial_libraries:
-            self.add_library( Library( l['location'],
+            library = Library( l['location'],
                     l.get('monitored', l.get('realtime')),
-                    l['scan_interval'], l.get('startup_scan', True) ))
+                    l['scan_interval'], l.get('startup_scan', True),
+                    l.get('scan_workers', DEFAULT_SCAN_WORKERS) )
+            library._dir_cache = l.get('dir_cache', {})
+            library._last_full_scan = l.get('last_full_scan', 0)
+            library.scan_totals = l.get('scan_totals', (0, 0))
+            self.add_library(library)
 
     _serial_libraries = property(serialize_libraries, unserialize_libraries)
 
+    def update_compilations(self):
+        """
+            Recomputes which tracks of the collection are part of a
+            compilation, see :func:`update_compilations`
+        """
+        update_compilations(self.get_tracks())
+
     def close(self):
         """
             close the collection. does any work like saving to disk,
@@ -355,6 +616,17 @@ class Collection(trax.TrackDB):
 class LibraryMonitor(GObject.GObject):
     """
         Monitors library locations for changes
+
+        Changes aren't handled one by one: the files and directories
+        they affect are collected until no more changes happened for
+        MONITOR_DELAY seconds (or for at most MONITOR_MAX_DELAY seconds),
+        and then updated all at once in the background, see
+        :meth:`Library.update_directories`.
+
+        Every directory needs a watch of its own. If there are more
+        directories than watches available, the library is instead
+        rescanned every MONITOR_POLL_INTERVAL seconds, which only lists
+        the directories that were modified.
     """
     __gproperties__ = {
         'monitored': (
@@ -377,7 +649,11 @@ class LibraryMonitor(GObject.GObject):
             [Gio.File]
         )
     }
-    
+
+    # the number of directories watched by all monitors
+    _watch_count = 0
+    _watch_lock = threading.Lock()
+
     def __init__(self, library):
         """
             :param library: the library to monitor
@@ -388,9 +664,16 @@ class LibraryMonitor(GObject.GObject):
         self.__library = library
         self.__root = Gio.File.new_for_uri(library.location)
         self.__monitored = False
+        # directory URI -> (directory, file monitor)
         self.__monitors = {}
-        self.__queue = {}
+        self.__polling = False
+        # URI -> whether to look at subdirectories too
+        self.__pending = {}
+        self.__first_change = None
+        self.__last_change = None
+        self.__timer = None
         self.__lock = threading.RLock()
+        self.__update_lock = threading.Lock()
 
     def do_get_property(self, property):
         """
@@ -421,90 +704,154 @@ class LibraryMonitor(GObject.GObject):
         with self.__lock:
             if self.props.monitored:
                 logger.debug('Setting up library monitors')
-
-                for directory in common.walk_directories(self.__root):
-                    monitor = directory.monitor_directory(Gio.FileMonitorFlags.NONE, None)
-                    monitor.connect('changed', self.on_location_changed)
-                    self.__monitors[directory] = monitor
-
-                    self.emit('location-added', directory)
+                self.__add_monitors(self.__root)
             else:
                 logger.debug('Removing library monitors')
+                self.__remove_monitors(list(self.__monitors))
+                self.__pending = {}
 
-                for directory, monitor in self.__monitors.iteritems():
-                    monitor.cancel()
+    def __add_monitors(self, root):
+        """
+            Watches root and its subdirectories, falling back to polling
+            when running out of watches
+        """
+        limit = _get_watch_limit()
+        with self.__lock:
+            for directory in common.walk_directories(root):
+                uri = directory.get_uri()
+                if uri in self.__monitors:
+                    continue
+                with LibraryMonitor._watch_lock:
+                    if LibraryMonitor._watch_count >= limit:
+                        logger.warning('Out of directory watches, polling '
+                                '%s for changes instead', self.__root.get_uri())
+                        self.__start_polling()
+                        return
+                    try:
+                        monitor = directory.monitor_directory(
+                                Gio.FileMonitorFlags.NONE, None)
+                    except GLib.Error:
+                        logger.warning('Could not watch %s, polling %s for '
+                                'changes instead', directory.get_uri(),
+                                self.__root.get_uri(), exc_info=True)
+                        self.__start_polling()
+                        return
+                    LibraryMonitor._watch_count += 1
+                monitor.connect('changed', self.on_location_changed)
+                self.__monitors[uri] = (directory, monitor)
+
+                self.emit('location-added', directory)
+
+    def __remove_monitors(self, uris):
+        with self.__lock:
+            for uri in uris:
+                directory, monitor = self.__monitors.pop(uri)
+                monitor.cancel()
+                with LibraryMonitor._watch_lock:
+                    LibraryMonitor._watch_count -= 1
 
-                    self.emit('location-removed', directory)
+                self.emit('location-removed', directory)
 
-                self.__monitors = {}
-                
-    def __process_change_queue(self, gfile):
-        if gfile in self.__queue:
-            added_tracks = trax.util.get_tracks_from_uri(gfile.get_uri())
-            for tr in added_tracks:
-                tr.read_tags()
-            self.__library.collection.add_tracks(added_tracks)
-            del self.__queue[gfile]
+    def __start_polling(self):
+        if not self.__polling:
+            self.__polling = True
+            GLib.timeout_add_seconds(MONITOR_POLL_INTERVAL, self.__poll)
 
-    def on_location_changed(self, monitor, gfile, other_gfile, event):
+    def __poll(self):
         """
-            Updates the library on changes of the location
+            Rescans the library in the background while polling
         """
-        
-        if event == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
-            self.__process_change_queue(gfile)
-        elif event == Gio.FileMonitorEvent.CREATED or \
-             event == Gio.FileMonitorEvent.CHANGED:
-            
-            # Enqueue tracks retrieval
-            if gfile not in self.__queue:
-                self.__queue[gfile] = True
-            
-                # File monitor only emits the DONE_HINT when using inotify,
-                # and only on single files. Give it some time, but don't 
-                # lose the change notification
-                GLib.timeout_add(500, self.__process_change_queue, gfile)
-            
-            # Set up new monitor if directory
-            fileinfo = gfile.query_info('standard::type', Gio.FileQueryInfoFlags.NONE, None)
-
-            if fileinfo.get_file_type() == Gio.FileType.DIRECTORY and \
-               gfile not in self.__monitors:
-                
-                for directory in common.walk_directories(gfile):
-                    monitor = directory.monitor_directory(Gio.FileMonitorFlags.NONE, None)
-                    monitor.connect('changed', self.on_location_changed)
-                    self.__monitors[directory] = monitor
+        if not self.props.monitored:
+            self.__polling = False
+            return False
+        self.__rescan()
+        return True
 
-                    self.emit('location-added', directory)
+    @common.threaded
+    def __rescan(self):
+        self.__library.rescan()
 
-        elif event == Gio.FileMonitorEvent.DELETED:
-            removed_tracks = []
+    def on_location_changed(self, monitor, gfile, other_gfile, event):
+        """
+            Queues the location of a change for updating the library
+        """
+        if event == Gio.FileMonitorEvent.CHANGES_DONE_HINT or \
+           event == Gio.FileMonitorEvent.CHANGED:
+            self.queue_update(gfile)
+        elif event == Gio.FileMonitorEvent.CREATED or \
+             event == Gio.FileMonitorEvent.DELETED:
+            # this may be a whole directory that was created or deleted
+            self.queue_update(gfile, recursive=True)
 
-            track = trax.Track(gfile.get_uri())
+        if event == Gio.FileMonitorEvent.DELETED:
+            # Remove obsolete monitors
+            uri = gfile.get_uri()
+            prefix = uri.rstrip('/') + '/'
+            with self.__lock:
+                self.__remove_monitors([u for u in self.__monitors
+                    if u == uri or u.startswith(prefix)])
 
-            if track in self.__library.collection:
-                # Deleted file was a regular track
-                removed_tracks += [track]
-            else:
-                # Deleted file was most likely a directory
-                for track in self.__library.collection:
-                    track_gfile = Gio.File.new_for_uri(track.get_loc_for_io())
+    def queue_update(self, gfile, recursive=False):
+        """
+            Queues a file or directory for updating the library
 
-                    if track_gfile.has_prefix(gfile):
-                        removed_tracks += [track]
+            :param gfile: the location that changed
+            :type gfile: :class:`Gio.File`
+            :param recursive: whether the subdirectories of gfile, if it
+                is a directory, may have changed too
+        """
+        uri = gfile.get_uri()
+        now = time.time()
+        with self.__lock:
+            self.__pending[uri] = self.__pending.get(uri, False) or recursive
+            self.__last_change = now
+            if self.__first_change is None:
+                self.__first_change = now
+            if self.__timer is None:
+                self.__timer = GLib.timeout_add(int(MONITOR_DELAY * 1000),
+                        self.__on_timeout)
+
+    def __on_timeout(self):
+        with self.__lock:
+            now = time.time()
+            if now - self.__last_change < MONITOR_DELAY and \
+                    now - self.__first_change < MONITOR_MAX_DELAY:
+                # still changing, wait a little longer
+                return True
+            self.__timer = None
+            self.__first_change = None
+        self.__update_in_background()
+        return False
 
-            self.__library.collection.remove_tracks(removed_tracks)
+    @common.threaded
+    def __update_in_background(self):
+        self.__update()
 
-            # Remove obsolete monitors
-            removed_directories = [d for d in self.__monitors \
-                if d == gfile or d.has_prefix(gfile)]
+    def __update(self):
+        """
+            Updates the library with the queued changes
+        """
+        with self.__update_lock:
+            # the changes will be found by the scan anyway
+            while self.__library.scanning:
+                time.sleep(1)
+            with self.__lock:
+                pending, self.__pending = self.__pending, {}
+            if not pending:
+                return
+            logger.debug('Updating %d changed locations in %s',
+                    len(pending), self.__root.get_uri())
+            self.__library.update_directories(pending.iteritems())
 
-            for directory in removed_directories:
-                self.__monitors[directory].cancel()
-                del self.__monitors[directory]
-                
-                self.emit('location-removed', directory)
+            # watch the directories that were created
+            if not self.props.monitored:
+                return
+            for uri, recursive in pending.iteritems():
+                gfile = Gio.File.new_for_uri(uri)
+                if recursive and uri not in self.__monitors and \
+                        gfile.query_file_type(Gio.FileQueryInfoFlags.NONE,
+                            None) == Gio.FileType.DIRECTORY:
+                    self.__add_monitors(gfile)
 
 class Library(object):
     """
@@ -525,7 +872,8 @@ class Library(object):
         5
         >>>
     """
-    def __init__(self, location, monitored=False, scan_interval=0, startup_scan=False):
+    def __init__(self, location, monitored=False, scan_interval=0, startup_scan=False,
+            scan_workers=DEFAULT_SCAN_WORKERS):
         """
             Sets up the Library
 
@@ -536,12 +884,22 @@ class Library(object):
             :type monitored: bool
             :param scan_interval: the interval for automatic rescanning
             :type scan_interval: int
+            :param scan_workers: the number of files whose tags are read
+                at the same time while scanning
+            :type scan_workers: int
         """
         self.location = location
         self.scan_interval = scan_interval
         self.scan_id = None
         self.scanning = False
         self._startup_scan = startup_scan
+        self._scan_workers = scan_workers
+        # directory URI -> (mtime, names of subdirectories, number and
+        # size of its files) as of the last scan, see __walk
+        self._dir_cache = {}
+        self._last_full_scan = 0
+        #: the number of files and bytes found by the last scan
+        self.scan_totals = (0, 0)
         self.monitor = LibraryMonitor(self)
         self.monitor.props.monitored = monitored
 
@@ -623,113 +981,266 @@ class Library(object):
     
     startup_scan = property(get_startup_scan, set_startup_scan)
 
-    def _count_files(self):
+    def get_scan_workers(self):
+        return self._scan_workers
+
+    def set_scan_workers(self, value):
         """
-            Counts the number of files present in this directory
+            Sets the number of files whose tags are read at the same time
+            while scanning. Reading several files at once mostly helps
+            with slow storage like network shares.
         """
-        count = 0
-        for file in common.walk(Gio.File.new_for_uri(self.location)):
-            if self.collection:
-                if self.collection._scan_stopped:
-                    break
-            count += 1
+        self._scan_workers = value
+        self.collection.serialize_libraries()
+        self.collection._dirty = True
 
-        return count
+    scan_workers = property(get_scan_workers, set_scan_workers)
 
-    def _check_compilation(self, ccheck, compilations, tr):
+    def update_track(self, gloc, force_update=False, fileinfo=None):
         """
-            This is the hacky way to test to see if a particular track is a
-            part of a compilation.
+            Rescan the track at a given location
 
-            Basically, if there is more than one track in a directory that has
-            the same album but different artist, we assume that it's part of a
-            compilation.
+            :param gloc: the location
+            :type gloc: :class:`Gio.File`
+            :param force_update: Force update of file (default only updates file
+                                 when mtime has changed)
+            :param fileinfo: information about the file including
+                time::modified, if already known
+            :type fileinfo: :class:`Gio.FileInfo`
 
-            :param ccheck: dictionary for internal use
-            :param compilations: if a compilation is found, it'll be appended
-                to this list
-            :param tr: the track to check
+            returns: the Track object, None if it could not be updated
         """
-        # check for compilations
-        if not settings.get_option('collection/file_based_compilations', True):
-            return
+        read = self._read_track(gloc, force_update, fileinfo)
+        if read is None:
+            return None
+        return self._add_track(*read)
 
-        def joiner(value):
-            if not value or isinstance(value, basestring):
-                return value
-            else:
-                try:
-                    return u"\u0000".join(value)
-                except UnicodeDecodeError:
-                    return "\0".join(value)
+    def update_directories(self, locations):
+        """
+            Updates the collection with the current contents of some
+            locations within the library, e.g. after they have changed
 
-        try:
-            basedir = joiner(tr.get_tag_raw('__basedir'))
-            album = joiner(tr.get_tag_raw('album'))
-            artist = joiner(tr.get_tag_raw('artist'))
-        except Exception:
-            logger.warning("Error while checking for compilation: %s", tr)
-            return
-        if not basedir or not album or not artist: return
-        album = album.lower()
-        artist = artist.lower()
-        try:
-            if not basedir in ccheck:
-                ccheck[basedir] = {}
+            The files found are read and the tracks of files that are
+            gone are removed. New tracks are added all at once.
 
-            if not album in ccheck[basedir]:
-                ccheck[basedir][album] = deque()
-        except TypeError:
-            logger.exception("Error adding to compilation")
+            :param locations: iterable of (URI, recursive) tuples. A URI
+                may be that of a directory, whose files are looked at,
+                including those of its subdirectories if recursive is
+                True, of a file, or of something that no longer exists.
+        """
+        db = self.collection
+        if db is None:
             return
+        libloc = Gio.File.new_for_uri(self.location)
+        finder = _MoveFinder(db, libloc.get_uri())
+        batch = []
+        removals = []
 
-        if ccheck[basedir][album] and \
-                artist not in ccheck[basedir][album]:
-            if not (basedir, album) in compilations:
-                compilations.append((basedir, album))
-                logger.debug("Compilation %(album)r detected in %(dir)r" %
-                        {'album': album, 'dir': basedir})
-
-        ccheck[basedir][album].append(artist)
+        for uri, recursive in locations:
+            gloc = Gio.File.new_for_uri(uri)
+            try:
+                info = gloc.query_info("standard::type,time::modified",
+                        Gio.FileQueryInfoFlags.NONE, None)
+                type = info.get_file_type()
+            except GLib.Error:
+                info = type = None
 
-    def update_track(self, gloc, force_update=False):
-        """
-            Rescan the track at a given location
+            if type == Gio.FileType.DIRECTORY:
+                if recursive:
+                    files = common.walk_with_info(gloc)
+                else:
+                    files = common.list_directory(gloc, libloc)
+            elif type == Gio.FileType.REGULAR:
+                files = [(gloc, info)]
+            else:
+                files = []
 
-            :param gloc: the location
-            :type gloc: :class:`Gio.File`
-            :param force_update: Force update of file (default only updates file
-                                 when mtime has changed)
+            seen = set()
+            dirtracks = []
+            try:
+                for fil, fileinfo in files:
+                    if fileinfo is None or \
+                            fileinfo.get_file_type() != Gio.FileType.REGULAR:
+                        continue
+                    seen.add(fil.get_uri())
+                    try:
+                        read = self._read_track(fil, fileinfo=fileinfo,
+                                finder=finder)
+                    except Exception:
+                        logger.exception("Error reading %s", fil.get_uri())
+                        continue
+                    if read is not None:
+                        dirtracks.append(self._add_track(*read, batch=batch))
+            except GLib.Error:
+                logger.exception("Unhandled exception while listing %s.", uri)
+                continue
 
-            returns: the Track object, None if it could not be updated
+            if type == Gio.FileType.REGULAR:
+                continue
+            update_compilations(dirtracks)
+            locs = db.get_locations_under(uri)
+            if type == Gio.FileType.DIRECTORY and not recursive:
+                start = len(uri.rstrip('/')) + 1
+                locs = [loc for loc in locs if '/' not in loc[start:]]
+            elif type is None and db.loc_is_member(uri):
+                locs.append(uri)
+            for loc in locs:
+                if loc not in seen:
+                    tr = db.get_track_by_loc(loc)
+                    if tr is not None:
+                        removals.append(tr)
+
+        if finder.candidates:
+            removals = self.__finish_moves(finder, removals, False, batch)
+        if batch:
+            db.add_tracks(batch)
+        if removals:
+            db.remove_tracks(removals)
+
+    def _read_track(self, gloc, force_update=False, fileinfo=None,
+            finder=None):
+        """
+            The part of update_track that reads the file, which may run
+            on any thread.
+
+            :param finder: a :class:`_MoveFinder` that new files which
+                may be moved tracks are passed to instead of being read
+
+            returns: a (track, mtime, whether the track is new) tuple to
+                pass to _add_track, None if there is no track
         """
         uri = gloc.get_uri()
         if not uri: # we get segfaults if this check is removed
             return None
-        mtime = gloc.query_info("time::modified", Gio.FileQueryInfoFlags.NONE, None).get_modification_time()
+        if fileinfo is None:
+            fileinfo = gloc.query_info("time::modified", Gio.FileQueryInfoFlags.NONE, None)
+        mtime = fileinfo.get_modification_time()
         mtime = mtime.tv_sec + (mtime.tv_usec/100000.0)
         tr = self.collection.get_track_by_loc(uri)
         if tr:
+            # the fingerprint is only taken along when the file is read
+            # anyway; unchanged tracks of older collections get one the
+            # next time they are modified
             if force_update or tr.get_tag_raw('__modified') < mtime:
-                tr.read_tags()
-                tr.set_tag_raw('__modified', mtime)
+                tr.read_tags(mtime, fast=True)
+                tr.set_tag_raw('__modified', mtime, notify_changed=False)
+                self.__set_fingerprint(tr, gloc, fileinfo)
+            return tr, mtime, False
+        if finder is not None and trax.util.is_valid_track(uri) and \
+                finder.add_candidate(gloc, fileinfo):
+            return None
+        tr = trax.Track(uri, scan=False)
+        # only read new tracks, see Track.__new__. Nothing else knows
+        # about them yet, so there is no one to notify.
+        if tr._init:
+            tr.read_tags(mtime, notify_changed=False, fast=True)
+            # stored for when this file is moved, since it can't be
+            # read anymore by then
+            self.__set_fingerprint(tr, gloc, fileinfo)
+        return tr, mtime, True
+
+    def __get_fingerprint(self, gloc, fileinfo):
+        """
+            returns: the fingerprint of a file, None if it isn't a track
+                or can't be read
+        """
+        if not trax.util.is_valid_track(gloc.get_uri()):
+            return None
+        size = None
+        if fileinfo is not None and \
+                fileinfo.has_attribute("standard::size"):
+            size = fileinfo.get_size()
+        try:
+            return trax.util.get_fingerprint(gloc, size)
+        except GLib.Error:
+            logger.debug("Could not compute fingerprint of %s",
+                    gloc.get_uri(), exc_info=True)
+            return None
+
+    def __set_fingerprint(self, tr, gloc, fileinfo):
+        fingerprint = self.__get_fingerprint(gloc, fileinfo)
+        if fingerprint is not None:
+            tr.set_tag_raw('__fingerprint', fingerprint, notify_changed=False)
+
+    def __finish_moves(self, finder, removals, force_update, batch):
+        """
+            Moves the tracks whose files were found elsewhere to their new
+            locations, and reads the other candidates of finder as usual.
+
+            :param removals: the tracks whose files are gone
+            :param batch: list that new tracks are appended to
+            :returns: the tracks of removals that weren't moved
+        """
+        moves, others = finder.pair(removals)
+        if moves:
+            db = self.collection
+            db.relocate_tracks([(tr, gloc.get_uri())
+                for tr, gloc, fileinfo in moves])
+            moved = set()
+            for tr, gloc, fileinfo in moves:
+                logger.debug("Track moved to %s", gloc.get_uri())
+                moved.add(tr)
+                mtime = fileinfo.get_modification_time()
+                mtime = mtime.tv_sec + (mtime.tv_usec/100000.0)
+                tr.set_tag_raw('__basedir', gloc.get_parent().get_path(),
+                        notify_changed=False)
+                tr.set_tag_raw('__modified', mtime, notify_changed=False)
+            removals = [tr for tr in removals if tr not in moved]
+
+        for gloc, fileinfo in others:
+            try:
+                read = self._read_track(gloc, force_update, fileinfo)
+            except Exception:
+                logger.exception("Error reading %s", gloc.get_uri())
+                continue
+            if read is not None:
+                self._add_track(*read, batch=batch)
+        return removals
+
+    def _add_track(self, tr, mtime, new, batch=None):
+        """
+            The part of update_track that adds a newly read track to the
+            collection.
+
+            :param batch: if given, a list that new tracks are appended
+                to instead, to be added all at once
+
+            returns: the Track object
+        """
+        if not new:
+            return tr
+        if tr._scan_valid == True:
+            tr.set_tag_raw('__date_added', time.time(), notify_changed=False)
+            tr.set_tag_raw('__modified', mtime, notify_changed=False)
+        # Track already existed. This fixes trax.get_tracks_from_uri
+        # on windows, unknown why fix isnt needed on linux.
+        elif tr._init:
+            return tr
+
+        if batch is not None:
+            batch.append(tr)
         else:
-            tr = trax.Track(uri)
-            if tr._scan_valid == True:
-                tr.set_tag_raw('__date_added', time.time())
-                self.collection.add(tr)
-                tr.set_tag_raw('__modified', mtime)
-
-            # Track already existed. This fixes trax.get_tracks_from_uri
-            # on windows, unknown why fix isnt needed on linux.
-            elif not tr._init:
-                self.collection.add(tr)
+            self.collection.add(tr)
         return tr
 
-    def rescan(self, notify_interval=None, force_update=False):
+    def rescan(self, notify_interval=None, force_update=False,
+            deep_verify=False, progress=None):
         """
             Rescan the associated folder and add the contained files
             to the Collection
+
+            The files found and processed are counted in progress, a
+            :class:`ScanProgress`, if given.
+
+            Tracks whose files weren't found while scanning are removed
+            from the Collection. If deep_verify is True, each of them is
+            checked for existence first, for storage that may not list
+            all files reliably.
+
+            The files of directories that haven't changed since the last
+            scan are not looked at again, unless force_update or
+            deep_verify is True or the last full scan was longer than
+            FULL_SCAN_INTERVAL ago.
         """
         # TODO: use gio's cancellable support
         
@@ -745,51 +1256,48 @@ class Library(object):
         libloc = Gio.File.new_for_uri(self.location)
 
         count = 0
-        dirtracks = deque()
-        compilations = deque()
-        ccheck = {}
-        for fil in common.walk(libloc):
+        dirtracks = []
+        if progress is None:
+            progress = ScanProgress(*self.scan_totals)
+        files_found = progress.files_found
+        bytes_found = progress.bytes_found
+
+        seen = set()
+        unlisted = []
+        skipped = set()
+        started = time.time()
+        full = force_update or deep_verify or \
+                started - self._last_full_scan > FULL_SCAN_INTERVAL
+        batch = []
+        batch_started = time.time()
+        finder = _MoveFinder(db, libloc.get_uri())
+        files = self.__read_files(libloc, force_update, unlisted, skipped,
+                full, progress, finder)
+        for fil, type, size, read in files:
+            if len(batch) >= SCAN_BATCH_SIZE or (batch and
+                    time.time() - batch_started > SCAN_BATCH_TIME):
+                db.add_tracks(batch)
+                batch = []
+                batch_started = time.time()
+
             count += 1
-            type = fil.query_info("standard::type", Gio.FileQueryInfoFlags.NONE, None).get_file_type()
+            progress.files_done += type == Gio.FileType.REGULAR
+            progress.bytes_done += size
             if type == Gio.FileType.DIRECTORY:
+                # the files of a directory come right after it
                 if dirtracks:
-                    for tr in dirtracks:
-                        self._check_compilation(ccheck, compilations, tr)
-                    for (basedir, album) in compilations:
-                        base = basedir.replace('"', '\\"')
-                        alb = album.replace('"', '\\"')
-                        items = [ tr for tr in dirtracks if \
-                                tr.get_tag_raw('__basedir') == base and \
-                                # FIXME: this is ugly
-                                alb in "".join(
-                                    tr.get_tag_raw('album') or []).lower()
-                                ]
-                        for item in items:
-                            item.set_tag_raw('__compilation', (basedir, album))
-                dirtracks = deque()
-                compilations = deque()
-                ccheck = {}
+                    update_compilations(dirtracks)
+                dirtracks = []
             elif type == Gio.FileType.REGULAR:
-                tr = self.update_track(fil, force_update=force_update)
-                if not tr:
-                    continue
-
-                if dirtracks is not None:
+                seen.add(fil.get_uri())
+                tr = read and self._add_track(*read, batch=batch)
+                if tr:
                     dirtracks.append(tr)
-                    # do this so that if we have, say, a 4000-song folder
-                    # we dont get bogged down trying to keep track of them
-                    # for compilation detection. Most albums have far fewer
-                    # than 110 tracks anyway, so it is unlikely that this
-                    # restriction will affect the heuristic's accuracy.
-                    # 110 was chosen to accomodate "top 100"-style
-                    # compilations.
-                    if len(dirtracks) > 110:
-                        logger.debug("Too many files, skipping "
-                                "compilation detection heuristic for "
-                                + fil.get_uri())
-                        dirtracks = None
 
             if self.collection and self.collection._scan_stopped:
+                files.close()
+                if batch:
+                    db.add_tracks(batch)
                 self.scanning = False
                 logger.info("Scan canceled")
                 return
@@ -798,6 +1306,11 @@ class Library(object):
             if notify_interval is not None and count % notify_interval == 0:
                 event.log_event('tracks_scanned', self, count)
 
+        if dirtracks:
+            update_compilations(dirtracks)
+        self.scan_totals = (progress.files_found - files_found,
+                progress.bytes_found - bytes_found)
+
         # final progress update
         if notify_interval is not None:
             event.log_event('tracks_scanned', self, count)
@@ -805,29 +1318,157 @@ class Library(object):
 
 
         removals = deque()
-        for tr in self.collection.tracks.itervalues():
-            tr = tr._track
-            loc = tr.get_loc_for_io()
-            if not loc:
+        for loc in db.get_locations_under(libloc.get_uri()):
+            if loc in seen:
                 continue
-            gloc = Gio.File.new_for_uri(loc)
-            try:
-                if not gloc.has_prefix(libloc):
-                    continue
-            except UnicodeDecodeError:
-                logger.exception("Error decoding file location")
+            if skipped and loc[:loc.rfind('/') + 1] in skipped:
                 continue
-
-            if not gloc.query_exists(None):
+            # the files of directories that couldn't be listed, and all
+            # files when asked to, are checked one by one
+            if deep_verify or any(loc.startswith(dir) for dir in unlisted):
+                if Gio.File.new_for_uri(loc).query_exists(None):
+                    continue
+            tr = db.get_track_by_loc(loc)
+            if tr is not None:
                 removals.append(tr)
 
-        for tr in removals:
-            logger.debug(u"Removing %s"%unicode(tr))
-            self.collection.remove(tr)
+        # new files may be tracks that were moved
+        if finder.candidates:
+            removals = self.__finish_moves(finder, removals, force_update,
+                    batch)
+        if batch:
+            db.add_tracks(batch)
+        if removals:
+            for tr in removals:
+                logger.debug(u"Removing %s"%unicode(tr))
+            db.remove_tracks(removals)
             
+        if full:
+            self._last_full_scan = started
+        # save the directory cache
+        self.collection._dirty = True
+
         logger.info("Scan completed: %s", self.location)
         self.scanning = False
 
+    def __walk(self, libloc, unlisted, skipped, full, progress):
+        """
+            Walks the library like common.walk_with_info, yielding
+            (gloc, file type, fileinfo or None) for its directories and
+            regular files.
+
+            Unless full is True, the directories that haven't been
+            modified since the last scan aren't listed again; their
+            subdirectories are taken from the directory cache, their
+            URIs are added to skipped, and their files are counted as
+            found and done in progress.
+        """
+        old_cache, cache = self._dir_cache, {}
+        started = time.time()
+        queue = deque()
+        queue.append((libloc, None))
+
+        while queue:
+            dir, dirinfo = queue.pop()
+            uri = dir.get_uri().rstrip('/') + '/'
+            try:
+                if dirinfo is None:
+                    dirinfo = dir.query_info("time::modified",
+                            Gio.FileQueryInfoFlags.NONE, None)
+                mtime = dirinfo.get_modification_time()
+                mtime = mtime.tv_sec + mtime.tv_usec / 1000000.0
+            except GLib.Error:
+                mtime = None
+            yield dir, Gio.FileType.DIRECTORY, None
+
+            cached = old_cache.get(uri)
+            # entries of older versions don't have the file counts
+            if not full and mtime is not None and cached is not None \
+                    and len(cached) == 4 and cached[0] == mtime:
+                skipped.add(uri)
+                cache[uri] = cached
+                progress.files_found += cached[2]
+                progress.bytes_found += cached[3]
+                progress.files_done += cached[2]
+                progress.bytes_done += cached[3]
+                for name in cached[1]:
+                    queue.append((dir.get_child(name), None))
+                continue
+
+            subdirs = []
+            files = 0
+            bytes = 0
+            try:
+                for fil, fileinfo in common.list_directory(dir, libloc):
+                    type = fileinfo.get_file_type()
+                    if type == Gio.FileType.DIRECTORY:
+                        queue.append((fil, fileinfo))
+                        subdirs.append(fileinfo.get_name())
+                    else:
+                        if type == Gio.FileType.REGULAR:
+                            files += 1
+                            bytes += fileinfo.get_size()
+                        yield fil, type, fileinfo
+            except GLib.Error:
+                logger.exception("Unhandled exception while walking on %s.", dir)
+                unlisted.append(uri)
+                continue
+
+            # a directory modified in the same second as it was listed may
+            # be modified again without its mtime changing
+            if mtime is not None and mtime < started - 2:
+                cache[uri] = (mtime, subdirs, files, bytes)
+
+        self._dir_cache = cache
+
+    def __read_files(self, libloc, force_update, unlisted, skipped, full,
+            progress, finder):
+        """
+            Walks the library (see __walk), reading the tags of up to
+            scan_workers files at the same time.
+
+            Yields (gloc, file type, size, result of _read_track or None)
+            for every file, in the order they were found. The URIs of the
+            directories that couldn't be listed are appended to unlisted.
+        """
+        workers = self.scan_workers
+        pool = common.WorkerPool(workers, name='LibraryScan')
+        pending = deque()
+        # files that have been read but not handed back yet are kept
+        # in memory, so only a few more are read ahead
+        limit = 2 * workers
+
+        try:
+            for fil, type, fileinfo in self.__walk(libloc, unlisted, skipped,
+                    full, progress):
+                job = None
+                size = 0
+                if type == Gio.FileType.REGULAR:
+                    job = pool.submit(self._read_track, fil, force_update,
+                            fileinfo, finder)
+                    size = fileinfo.get_size()
+                    progress.files_found += 1
+                    progress.bytes_found += size
+                pending.append((fil, type, size, job))
+
+                while pending and (len(pending) > limit or
+                        pending[0][3] is None or pending[0][3].done()):
+                    yield self.__read_result(*pending.popleft())
+
+            while pending:
+                yield self.__read_result(*pending.popleft())
+        finally:
+            pool.close(cancel=True)
+
+    def __read_result(self, fil, type, size, job):
+        if job is None:
+            return fil, type, size, None
+        try:
+            return fil, type, size, job.get()
+        except Exception:
+            logger.exception("Error reading %s", fil.get_uri())
+            return fil, type, size, None
+
     def add(self, loc, move=False):
         """
             Copies (or moves) a file into the library and adds it to the
@@ -417,6 +417,115 @@ class cached(object):
         """Support instance methods."""
         return partial(self.__call__, obj)
 
+class _Job(object):
+    """
+        The result of a function queued on a :class:`WorkerPool`
+    """
+    __slots__ = ['func', 'args', 'result', 'error', 'finished']
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+
+    def done(self):
+        """
+            Returns whether the function has returned
+        """
+        return self.finished.is_set()
+
+    def get(self):
+        """
+            Waits for the function to return, and returns its result
+
+            :raises: the exception raised by the function, if any
+        """
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WorkerPool(object):
+    """
+        Runs functions on a fixed number of worker threads.
+
+        With less than two workers, functions are run right away in the
+        calling thread instead.
+
+        Simple usage:
+
+        >>> pool = WorkerPool(4)
+        >>> jobs = [pool.submit(len, s) for s in ['a', 'bb', 'ccc']]
+        >>> print [job.get() for job in jobs]
+        [1, 2, 3]
+        >>> pool.close()
+    """
+    def __init__(self, workers, name='WorkerPool'):
+        self.workers = workers
+        self.__jobs = deque()
+        self.__condition = threading.Condition()
+        self.__threads = []
+        if workers < 2:
+            return
+        for i in range(workers):
+            thread = threading.Thread(target=self.__run, name=name)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__jobs:
+                    self.__condition.wait()
+                job = self.__jobs.popleft()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, func, *args):
+        """
+            Queues a call of func with args
+
+            :returns: a job, whose get() method returns the result
+        """
+        job = _Job(func, args)
+        if not self.__threads:
+            job.run()
+            return job
+        with self.__condition:
+            self.__jobs.append(job)
+            self.__condition.notify()
+        return job
+
+    def close(self, cancel=False):
+        """
+            Stops the worker threads once the queued functions are done
+
+            :param cancel: if True, functions that haven't started yet
+                are not run at all, and their jobs return None
+        """
+        with self.__condition:
+            if cancel:
+                for job in self.__jobs:
+                    if job is not None:
+                        job.finished.set()
+                # keep the workers' stop signals
+                self.__jobs = deque(job for job in self.__jobs
+                        if job is None)
+            self.__jobs.extend([None] * len(self.__threads))
+            self.__condition.notify_all()
+        self.__threads = []
+
 def walk(root):
     """
         Walk through a Gio directory, yielding each file
@@ -432,36 +541,69 @@ def walk(root):
         :returns: a generator object
         :rtype: :class:`Gio.File`
     """
+    for fil, fileinfo in walk_with_info(root):
+        yield fil
+
+def walk_with_info(root):
+    """
+        Like :func:`walk`, but yields (file, fileinfo) tuples, so that
+        the type and modification time of the files that were listed
+        don't have to be queried again.
+
+        The root directory is yielded with None as its fileinfo.
+
+        :param root: a :class:`Gio.File` representing the
+            directory to walk through
+        :returns: a generator object
+        :rtype: tuples of :class:`Gio.File` and :class:`Gio.FileInfo`
+    """
     queue = deque()
-    queue.append(root)
+    queue.append((root, None))
 
     while len(queue) > 0:
-        dir = queue.pop()
-        yield dir
+        dir, dirinfo = queue.pop()
+        yield dir, dirinfo
         try:
-            for fileinfo in dir.enumerate_children("standard::type,"
-                    "standard::is-symlink,standard::name,"
-                    "standard::symlink-target,time::modified",
-                    Gio.FileQueryInfoFlags.NONE, None):
-                fil = dir.get_child(fileinfo.get_name())
-                # FIXME: recursive symlinks could cause an infinite loop
-                if fileinfo.get_is_symlink():
-                    target = fileinfo.get_symlink_target()
-                    if not "://" in target and not os.path.isabs(target):
-                        fil2 = dir.get_child(target)
-                    else:
-                        fil2 = Gio.File.new_for_uri(target)
-                    # already in the collection, we'll get it anyway
-                    if fil2.has_prefix(root):
-                        continue
-                type = fileinfo.get_file_type()
-                if type == Gio.FileType.DIRECTORY:
-                    queue.append(fil)
-                elif type == Gio.FileType.REGULAR:
-                    yield fil
+            for fil, fileinfo in list_directory(dir, root):
+                if fileinfo.get_file_type() == Gio.FileType.DIRECTORY:
+                    queue.append((fil, fileinfo))
+                else:
+                    yield fil, fileinfo
         except GLib.Error: # why doesnt gio offer more-specific errors?
             logger.exception("Unhandled exception while walking on %s.", dir)
 
+def list_directory(dir, root=None):
+    """
+        Lists the regular files and directories in a Gio directory,
+        as used by :func:`walk`
+
+        :param dir: a :class:`Gio.File` representing the directory
+        :param root: the directory being walked through; symlinks to
+            files inside it are skipped, since they are found anyway
+        :returns: a generator of (file, fileinfo) tuples, with
+            standard::type, standard::size and time::modified in the
+            fileinfo
+        :raises: :class:`GLib.Error` if the directory can't be listed
+    """
+    for fileinfo in dir.enumerate_children("standard::type,"
+            "standard::is-symlink,standard::name,"
+            "standard::symlink-target,standard::size,time::modified",
+            Gio.FileQueryInfoFlags.NONE, None):
+        fil = dir.get_child(fileinfo.get_name())
+        # FIXME: recursive symlinks could cause an infinite loop
+        if fileinfo.get_is_symlink() and root is not None:
+            target = fileinfo.get_symlink_target()
+            if not "://" in target and not os.path.isabs(target):
+                fil2 = dir.get_child(target)
+            else:
+                fil2 = Gio.File.new_for_uri(target)
+            # already in the collection, we'll get it anyway
+            if fil2.has_prefix(root):
+                continue
+        type = fileinfo.get_file_type()
+        if type in (Gio.FileType.DIRECTORY, Gio.FileType.REGULAR):
+            yield fil, fileinfo
+
 def walk_directories(root):
     """
         Walk through a Gio directory, yielding each subdirectory
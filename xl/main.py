@@ -432,10 +432,23 @@ class Exaile(object):
 
         # Initialize the collection
         logger.info("Loading collection...")
-        from xl import collection
+        from xl import collection, trax
+        from xl.trax import storage
+        storage_engine = storage.get_engine()
+        location = os.path.join(xdg.get_data_dir(), storage_engine.filename)
+        if storage_engine is storage.SQLiteStorage and not os.path.exists(location):
+            oldlocation = os.path.join(xdg.get_data_dir(),
+                    storage.ShelveStorage.filename)
+            if os.path.exists(oldlocation):
+                import xl.migrations.database as dbmig
+                try:
+                    dbmig.handle_sqlite_migration(oldlocation, location,
+                            trax.TrackDB._dbversion)
+                except Exception:
+                    logger.exception("Failed to migrate music DB to SQLite")
         try:
             self.collection = collection.Collection("Collection",
-                    location=os.path.join(xdg.get_data_dir(), 'music.db'))
+                    location=location, storage=storage_engine)
         except common.VersionError:
             logger.exception("VersionError loading collection")
             sys.exit(1)
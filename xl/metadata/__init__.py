@@ -25,6 +25,8 @@
 # from your version.
 
 
+from collections import namedtuple
+import logging
 import os
 import sys
 from gi.repository import Gio
@@ -34,6 +36,9 @@ import urlparse
 
 from xl.metadata import (ape, asf, flac, mka, mod, mp3, mp4, mpc, ogg, sid, speex,
         tta, wav, wv)
+from xl.metadata import _probe
+
+logger = logging.getLogger(__name__)
 
 #: dictionary mapping extensions to Format classes.
 formats = {
@@ -83,6 +88,20 @@ formats = {
         'xm'    : mod.ModFormat,
         }
 
+#: dictionary mapping Format classes to functions reading the tags of
+#: their files quickly, see :func:`probe`
+probes = {
+        flac.FlacFormat         : _probe.probe_flac,
+        mp3.MP3Format           : _probe.probe_mp3,
+        ogg.OggFormat           : _probe.probe_vorbis,
+        ogg.OggOpusFormat       : _probe.probe_opus,
+        }
+
+#: The result of :func:`probe`: the tags read, the Format class of the
+#: file, and the number of bytes read, or None if the whole file was
+#: handed to the Format class.
+ProbeResult = namedtuple('ProbeResult', 'tags format bytes_read')
+
 # pass get_loc_for_io() to this.
 def get_format(loc):
     """
@@ -91,9 +110,58 @@ def get_format(loc):
 
         :param loc: The location to read from as a Gio URI
     """
+    loc, formatclass = _get_format_class(loc)
+    if formatclass is None:
+        return None
+
+    try:
+        return formatclass(loc)
+    except NotReadable:
+        return None
+
+def probe(loc):
+    """
+        Reads the tags needed to add the file at loc to the collection,
+        the same ones that read_all() of its Format object returns.
+
+        For the formats in :data:`probes`, only the header and trailer
+        of the file are parsed, which reads a bounded number of bytes.
+        Other files, and files these readers can't handle, are read by
+        their Format class.
+
+        :param loc: The location to read from as a Gio URI
+        :returns: a :class:`ProbeResult`, or None if the file is not
+            supported
+    """
+    path, formatclass = _get_format_class(loc)
+    if formatclass is None:
+        return None
+
+    reader = probes.get(formatclass)
+    if reader is not None:
+        try:
+            tags, bytes_read = reader(path, formatclass)
+        except Exception:
+            logger.debug("Could not probe %s, reading it completely", loc,
+                    exc_info=True)
+        else:
+            logger.debug("Probed %s, %d bytes read", loc, bytes_read)
+            return ProbeResult(tags, formatclass, bytes_read)
+
+    try:
+        f = formatclass(path)
+    except NotReadable:
+        return None
+    return ProbeResult(f.read_all(), formatclass, None)
+
+def _get_format_class(loc):
+    """
+        :returns: the path of loc and the Format class for it, or None
+            as class if the file is not supported
+    """
     loc = Gio.File.new_for_uri(loc).get_path()
     if not loc:
-        return None
+        return loc, None
         
     # XXX: The path that we get from GIO is, for some reason, in UTF-8.
     # Bug? Intended? No idea.
@@ -114,15 +182,12 @@ def get_format(loc):
     try:
         formatclass = formats[ext]
     except KeyError:
-        return None # not supported
+        return loc, None # not supported
 
     if formatclass is None:
         formatclass = BaseFormat
 
-    try:
-        return formatclass(loc)
-    except NotReadable:
-        return None
+    return loc, formatclass
 
 
 # vim: et sts=4 sw=4
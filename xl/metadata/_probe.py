@@ -0,0 +1,418 @@
+# Copyright (C) 2008-2010 Adam Olsen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# The developers of the Exaile media player hereby grant permission
+# for non-GPL compatible GStreamer and Exaile plugins to be used and
+# distributed together with GStreamer and Exaile. This permission is
+# above and beyond the permissions granted by the GPL license by which
+# Exaile is covered. If you modify this code, you may extend this
+# exception to your version of the code, but you are not obligated to
+# do so. If you do not wish to do so, delete this exception statement
+# from your version.
+
+"""
+Fast readers for the tags needed to scan a file into the collection.
+
+Instead of loading a whole mutagen object, they parse the header of a
+file and, where needed, its trailer, reading at most HEADER_LIMIT plus
+TRAILER_SIZE bytes. The tags are returned like
+:meth:`xl.metadata._base.BaseFormat.read_all` would return them.
+
+Each reader takes the path of the file and its Format class, and
+returns a (tags, bytes read) tuple. They raise :class:`ProbeError` for
+files they can't handle, which are then read by the Format class.
+"""
+
+from io import BytesIO
+import struct
+
+import mutagen
+from mutagen import id3
+from mutagen._vorbis import VCommentDict
+from mutagen.mp3 import MPEGInfo
+from mutagen.ogg import OggPage
+
+# the most bytes read from the start of a file
+HEADER_LIMIT = 256 * 1024
+
+# the bytes read from the end of a file to find its length
+TRAILER_SIZE = 64 * 1024
+
+
+class ProbeError(Exception):
+    pass
+
+
+class _CountingReader(object):
+    """
+        Wraps a file, counting the bytes read from it
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        if self.bytes_read > HEADER_LIMIT + TRAILER_SIZE:
+            raise ProbeError('read limit exceeded')
+        return data
+
+    def seek(self, offset, whence=0):
+        self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+
+def _get_tags(formatclass, raw):
+    """
+        Returns the text tags of raw, a mapping of native tag names to
+        lists of values, as formatclass would read them
+    """
+    try:
+        formatclass._reverse_mapping
+    except AttributeError:
+        formatclass._compute_mappings()
+    if formatclass.case_sensitive:
+        reverse = lambda key: formatclass._reverse_mapping.get(key, key)
+    else:
+        reverse = lambda key: formatclass._reverse_mapping.get(key.lower(), key)
+
+    tags = {}
+    for key in raw.keys():
+        tag = reverse(key)
+        if tag in formatclass.ignore_tags or tag.startswith('__'):
+            continue
+        native = formatclass.tag_mapping.get(tag)
+        if native is None:
+            if not formatclass.others:
+                continue
+            native = tag
+        try:
+            values = raw[native]
+        except (KeyError, ValueError):
+            continue
+        if values:
+            tags[tag] = list(values)
+    return tags
+
+
+def _read_format(formatclass, path, raw):
+    """
+        Returns the tags of raw, a stand-in for the mutagen object of
+        formatclass, as its read_all() would return them
+    """
+    # BaseFormat.__init__ would load the whole file again
+    f = formatclass.__new__(formatclass)
+    f.loc = path
+    f.open = False
+    f.mutagen = raw
+    try:
+        formatclass._reverse_mapping
+    except AttributeError:
+        formatclass._compute_mappings()
+    return f.read_all()
+
+
+def probe_flac(path, formatclass):
+    """
+        Reads the STREAMINFO and VORBIS_COMMENT blocks of a FLAC file,
+        skipping over the others like embedded pictures
+    """
+    with open(path, 'rb') as f:
+        reader = _CountingReader(f)
+        if reader.read(4) != b'fLaC':
+            raise ProbeError('not a plain FLAC file')
+        length = None
+        comment = VCommentDict()
+        last = False
+        while not last:
+            header = reader.read(4)
+            if len(header) < 4:
+                raise ProbeError('truncated metadata')
+            last = bool(ord(header[0]) & 0x80)
+            blocktype = ord(header[0]) & 0x7f
+            size = struct.unpack('>I', b'\0' + header[1:])[0]
+            if blocktype == 0:
+                data = reader.read(size)
+                # 20 bits sample rate, 3 bits channels, 5 bits sample
+                # size and 36 bits total samples
+                streaminfo = struct.unpack('>Q', data[10:18])[0]
+                sample_rate = streaminfo >> 44
+                if not sample_rate:
+                    raise ProbeError('invalid sample rate')
+                length = (streaminfo & 0xFFFFFFFFF) / float(sample_rate)
+            elif blocktype == 4:
+                if reader.bytes_read + size > HEADER_LIMIT:
+                    raise ProbeError('comment too large')
+                comment = VCommentDict(reader.read(size), framing=False)
+            else:
+                reader.seek(size, 1)
+        if length is None:
+            raise ProbeError('no STREAMINFO block')
+
+        tags = _get_tags(formatclass, comment)
+        if length:
+            tags['__length'] = length
+        # see FlacFormat.get_bitrate
+        tags['__bitrate'] = -1
+        return tags, reader.bytes_read
+
+
+def _read_ogg_headers(reader, magic):
+    """
+        Returns the first two packets of the Ogg stream starting with
+        the identification header magic, and the stream's serial number
+    """
+    page = OggPage(reader)
+    if not page.packets or not page.packets[0].startswith(magic):
+        raise ProbeError('not a %r stream' % magic)
+    serial = page.serial
+    pages = [page]
+    while True:
+        packets = OggPage.to_packets(pages)
+        if len(packets) > 2 or (len(packets) == 2 and pages[-1].complete):
+            return packets, serial
+        if reader.bytes_read > HEADER_LIMIT:
+            raise ProbeError('headers too large')
+        page = OggPage(reader)
+        if page.serial == serial:
+            pages.append(page)
+
+
+def _find_last_position(f, reader, serial):
+    """
+        Returns the granule position of the last page of an Ogg stream,
+        looking only at the end of the file after the pages read so far
+    """
+    # the pages read so far end at the current position
+    start = f.tell()
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(max(start, size - TRAILER_SIZE))
+    data = reader.read(TRAILER_SIZE)
+    index = data.rfind(b'OggS')
+    while index >= 0:
+        try:
+            page = OggPage(BytesIO(data[index:]))
+        except Exception:
+            pass
+        else:
+            if page.serial == serial and page.position != -1:
+                return page.position
+        index = data.rfind(b'OggS', 0, index)
+    raise ProbeError('last page not found')
+
+
+def probe_vorbis(path, formatclass):
+    """
+        Reads the identification and comment headers of an Ogg Vorbis
+        file, and the position of its last page
+    """
+    with open(path, 'rb') as f:
+        reader = _CountingReader(f)
+        packets, serial = _read_ogg_headers(reader, b'\x01vorbis')
+        if not packets[1].startswith(b'\x03vorbis'):
+            raise ProbeError('no comment header')
+        comment = VCommentDict(packets[1][7:])
+        sample_rate, max_bitrate, nominal_bitrate, min_bitrate = \
+                struct.unpack('<4i', packets[0][12:28])
+        if sample_rate <= 0:
+            raise ProbeError('invalid sample rate')
+        position = _find_last_position(f, reader, serial)
+
+        # the same as mutagen's OggVorbisInfo
+        max_bitrate = max(0, max_bitrate)
+        min_bitrate = max(0, min_bitrate)
+        nominal_bitrate = max(0, nominal_bitrate)
+        if nominal_bitrate == 0:
+            bitrate = (max_bitrate + min_bitrate) // 2
+        elif max_bitrate and max_bitrate < nominal_bitrate:
+            bitrate = max_bitrate
+        elif min_bitrate > nominal_bitrate:
+            bitrate = min_bitrate
+        else:
+            bitrate = nominal_bitrate
+
+        tags = _get_tags(formatclass, comment)
+        length = position / float(sample_rate)
+        if length:
+            tags['__length'] = length
+        if bitrate:
+            tags['__bitrate'] = bitrate
+        return tags, reader.bytes_read
+
+
+def probe_opus(path, formatclass):
+    """
+        Reads the identification and comment headers of an Ogg Opus
+        file, and the position of its last page
+    """
+    with open(path, 'rb') as f:
+        reader = _CountingReader(f)
+        packets, serial = _read_ogg_headers(reader, b'OpusHead')
+        if not packets[1].startswith(b'OpusTags'):
+            raise ProbeError('no comment header')
+        comment = VCommentDict(packets[1][8:], framing=False)
+        version, channels, pre_skip = struct.unpack('<BBH', packets[0][8:12])
+        if version >> 4 != 0:
+            raise ProbeError('unsupported version')
+        position = _find_last_position(f, reader, serial)
+
+        tags = _get_tags(formatclass, comment)
+        # Opus always uses 48 kHz
+        length = (position - pre_skip) / 48000.0
+        if length:
+            tags['__length'] = length
+        return tags, reader.bytes_read
+
+
+# frames that read_all() ignores and which can be large: pictures,
+# objects, private data and lyrics
+_ID3_SKIPPED = {
+    2: (b'PIC', b'GEO', b'ULT'),
+    3: (b'APIC', b'GEOB', b'PRIV', b'USLT'),
+    4: (b'APIC', b'GEOB', b'PRIV', b'USLT'),
+}
+
+# the bytes mutagen reads from the end of a file to find an ID3v1 tag
+_ID3V1_SIZE = 128 + len(b'APE')
+
+
+def _from_syncsafe(data):
+    value = 0
+    for b in data:
+        value = (value << 7) | (ord(b) & 0x7f)
+    return value
+
+
+def _to_syncsafe(value):
+    return struct.pack('>4B', *[(value >> shift) & 0x7f
+                                for shift in (21, 14, 7, 0)])
+
+
+def _read_id3v2(reader):
+    """
+        Returns the ID3v2 tag at the start of a file without the
+        frames in _ID3_SKIPPED, and its size in the file
+    """
+    header = reader.read(10)
+    if len(header) < 10 or not header.startswith(b'ID3'):
+        reader.seek(0)
+        return b'', 0
+    vmaj, vrev, flags = struct.unpack('>3B', header[3:6])
+    size = header[6:10]
+    if vmaj not in _ID3_SKIPPED:
+        raise ProbeError('unsupported ID3v2 version')
+    if any(ord(b) & 0x80 for b in size):
+        raise ProbeError('tag size not synchsafe')
+    # an unsynchronised tag or an extended header have to be decoded
+    # before the frames can be found
+    if flags & 0x40 or (flags & 0x80 and vmaj < 4):
+        raise ProbeError('unsupported ID3v2 flags')
+    end = 10 + _from_syncsafe(size)
+
+    if vmaj == 2:
+        name_size, header_size = 3, 6
+    else:
+        name_size, header_size = 4, 10
+    frames = []
+    kept = 0
+    pos = 10
+    while pos + header_size <= end:
+        frame_header = reader.read(header_size)
+        name = frame_header[:name_size]
+        if len(frame_header) < header_size or not name.strip(b'\0'):
+            break
+        if vmaj == 2:
+            frame_size = struct.unpack('>I', b'\0' + frame_header[3:6])[0]
+        elif vmaj == 3:
+            frame_size = struct.unpack('>I', frame_header[4:8])[0]
+        else:
+            # mutagen guesses how broken taggers wrote these
+            if any(ord(b) & 0x80 for b in frame_header[4:8]):
+                raise ProbeError('frame size not synchsafe')
+            frame_size = _from_syncsafe(frame_header[4:8])
+        frame_size = min(frame_size, end - pos - header_size)
+        pos += header_size + frame_size
+        if name in _ID3_SKIPPED[vmaj]:
+            reader.seek(pos)
+            continue
+        kept += header_size + frame_size
+        if kept > HEADER_LIMIT:
+            raise ProbeError('tag too large')
+        frames.append(frame_header)
+        frames.append(reader.read(frame_size))
+
+    body = b''.join(frames)
+    tag = b'ID3' + struct.pack('>3B', vmaj, vrev, flags & ~0x10) + \
+            _to_syncsafe(len(body)) + body
+    return tag, end
+
+
+class _ProbedMP3(object):
+    """
+        Stands in for the mutagen.mp3.MP3 object of an MP3Format
+    """
+    def __init__(self, tags, info):
+        self.tags = tags
+        self.info = info
+
+    def keys(self):
+        if self.tags is None:
+            return []
+        return self.tags.keys()
+
+    def values(self):
+        if self.tags is None:
+            return []
+        return self.tags.values()
+
+
+def probe_mp3(path, formatclass):
+    """
+        Reads the ID3v2 tag of an MP3 file without its pictures, the
+        ID3v1 tag at its end, and the first MPEG frames
+    """
+    # older versions can't load ID3 tags from a file object
+    if mutagen.version < (1, 34):
+        raise ProbeError('mutagen too old')
+    with open(path, 'rb') as f:
+        reader = _CountingReader(f)
+        tag, tag_size = _read_id3v2(reader)
+        f.seek(0, 2)
+        if f.tell() - tag_size < _ID3V1_SIZE:
+            raise ProbeError('file too small')
+        f.seek(-_ID3V1_SIZE, 2)
+        # mutagen looks for the ID3v1 tag relative to the end of the
+        # file, so it finds it after the stripped ID3v2 tag as well
+        try:
+            tags = id3.ID3(BytesIO(tag + reader.read(_ID3V1_SIZE)))
+        except id3.ID3NoHeaderError:
+            tags = None
+        # the same offset as mutagen's ID3FileType.load
+        if tags is None:
+            offset = None
+        else:
+            offset = tag_size
+        info = MPEGInfo(reader, offset)
+
+        return (_read_format(formatclass, path, _ProbedMP3(tags, info)),
+                reader.bytes_read)
+
+# vim: et sts=4 sw=4
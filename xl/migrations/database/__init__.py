@@ -39,3 +39,13 @@ def handle_migration(db, pdata, oldversion, newversion):
                 "music database version %s to %s."%(oldversion, newversion))
 
 
+def handle_sqlite_migration(oldlocation, newlocation, dbversion):
+    """
+        Converts a shelve music database at oldlocation to a SQLite
+        database at newlocation. The shelve database is kept as it is.
+    """
+    migrator = imp.load_source("shelve_to_sqlite",
+            os.path.join(os.path.dirname(__file__), "shelve_to_sqlite.py"))
+    migrator.migrate(oldlocation, newlocation, dbversion)
+
+
@@ -0,0 +1,68 @@
+# Copyright (C) 2008-2010 Adam Olsen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# The developers of the Exaile media player hereby grant permission
+# for non-GPL compatible GStreamer and Exaile plugins to be used and
+# distributed together with GStreamer and Exaile. This permission is
+# above and beyond the permissions granted by the GPL license by which
+# Exaile is covered. If you modify this code, you may extend this
+# exception to your version of the code, but you are not obligated to
+# do so. If you do not wish to do so, delete this exception statement
+# from your version.
+
+
+"""
+    Copies a collection stored with the shelve storage engine into a
+    new SQLite database.
+"""
+
+import logging
+import os
+
+from xl.trax.storage import ShelveStorage, SQLiteStorage
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(oldlocation, newlocation, dbversion):
+    logger.info("Migrating music DB from %s to %s",
+            oldlocation, newlocation)
+
+    with ShelveStorage(oldlocation) as old:
+        version = old.get_version()
+        if version is not None and version < dbversion:
+            old.migrate(version, dbversion)
+
+        # build the new database under a temporary name, so that an
+        # interrupted migration is simply started over next time
+        tmplocation = newlocation + '.tmp'
+        if os.path.exists(tmplocation):
+            os.remove(tmplocation)
+
+        with SQLiteStorage(tmplocation) as new:
+            # attributes are plain python objects in both engines, so
+            # they can be copied without knowing what they are
+            for attr in old._pdata.keys():
+                if not attr.startswith("tracks-"):
+                    new.set(attr, old.get(attr))
+            new.write_tracks(old.iter_tracks())
+            new.set('_dbversion', dbversion)
+            new.commit()
+            count = new.get_track_count()
+
+    os.rename(tmplocation, newlocation)
+    logger.info("Migrated %d tracks", count)
@@ -80,6 +80,8 @@ class ExailePlayer(object):
         
         event.add_callback(self._on_track_end, 'playback_track_end', self)
         event.add_callback(self._on_track_tags_changed, 'track_tags_changed')
+        event.add_callback(self._on_tracks_tags_changed,
+                'tracks_tags_changed')
 
     def _setup_engine(self):
         
@@ -125,6 +127,12 @@ class ExailePlayer(object):
             return
         
         self._engine.on_track_stopoffset_changed(track)
+
+    @common.idle_add()
+    def _on_tracks_tags_changed(self, eventtype, job, changes):
+        for track, tags in changes:
+            if '__stopoffset' in tags:
+                self._engine.on_track_stopoffset_changed(track)
     
     def destroy(self):
         """
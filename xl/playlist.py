@@ -1809,14 +1809,22 @@ class SmartPlaylist(object):
 
         search_string, matchers = self._create_search_data(collection)
 
-        matcher = trax.TracksMatcher(search_string, case_sensitive=False)
-        
-        # prepend for now, since it is likely to remove more tracks, and
-        # smart playlists don't support mixed and/or expressions yet
-        for m in matchers:
-            matcher.prepend_matcher(m, self.or_match)
-        
-        trs = [ t.track for t in trax.search_tracks(collection, [matcher]) ]
+        if matchers:
+            matcher = trax.TracksMatcher(search_string, case_sensitive=False)
+
+            # prepend for now, since it is likely to remove more tracks, and
+            # smart playlists don't support mixed and/or expressions yet
+            for m in matchers:
+                matcher.prepend_matcher(m, self.or_match)
+
+            results = trax.search_tracks(collection, [matcher])
+        else:
+            # plain queries can reuse cached results while the
+            # collection is unchanged
+            results = trax.search_tracks_from_string(collection,
+                    search_string, case_sensitive=False)
+
+        trs = [ t.track for t in results ]
         if self.random_sort:
             random.shuffle(trs)
         else:
@@ -35,6 +35,8 @@ from xl.trax.track import Track
 from xl.trax.trackdb import TrackDB
 from xl.trax.search import (
         SearchResultTrack,
+        SearchSession,
+        SearchCancelled,
         search_tracks,
         search_tracks_from_string,
         TracksMatcher,
@@ -48,5 +50,6 @@ from xl.trax.util import (
         get_tracks_from_uri,
         sort_tracks,
         sort_result_tracks,
-        get_rating_from_tracks)
+        get_rating_from_tracks,
+        TagWriteJob)
 
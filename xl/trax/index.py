@@ -0,0 +1,427 @@
+# Copyright (C) 2008-2010 Adam Olsen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# The developers of the Exaile media player hereby grant permission
+# for non-GPL compatible GStreamer and Exaile plugins to be used and
+# distributed together with GStreamer and Exaile. This permission is
+# above and beyond the permissions granted by the GPL license by which
+# Exaile is covered. If you modify this code, you may extend this
+# exception to your version of the code, but you are not obligated to
+# do so. If you do not wish to do so, delete this exception statement
+# from your version.
+
+"""
+Indexes used to speed up searching a :class:`xl.trax.TrackDB`.
+
+The indexes only ever narrow down the set of tracks that have to be
+checked; the matchers in :mod:`xl.trax.search` still decide whether a
+track actually matches.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+# number of tracks updated at once above which a numeric index is rebuilt
+# instead of inserting into and deleting from its lists one by one
+_NUMERIC_BATCH = 16
+
+# length of the substrings of tokens that are indexed
+_GRAM_SIZE = 3
+
+
+def _grams(token):
+    return set(token[i:i + _GRAM_SIZE]
+            for i in xrange(len(token) - _GRAM_SIZE + 1))
+
+
+def _search_values(track, tag):
+    """
+        Returns the values of a tag in the form they are searched in,
+        lowercased. This mirrors what :class:`xl.trax.search._Matcher`
+        checks against.
+    """
+    return tuple(set(v for v in track._get_search_values(tag, True)
+            if v is not None))
+
+
+class _TagIndex(object):
+    """
+        Inverted index of the values of a single tag.
+
+        Maps each value to the tracks having it. If tokenize is True,
+        values are also split into whitespace separated tokens, and
+        tokens into n-grams, so that the values containing a piece of
+        text can be found without looking at every track.
+    """
+    __slots__ = ['tokenize', 'values', 'nulls', 'tokens', 'grams',
+            'track_values']
+
+    def __init__(self, tokenize=True):
+        self.tokenize = tokenize
+        self.values = {}        # value -> set of tracks
+        self.nulls = set()      # tracks without a value
+        self.tokens = {}        # token -> set of values
+        self.grams = {}         # n-gram -> set of tokens
+        self.track_values = {}  # track -> values of the track
+
+    def add(self, track, values):
+        self.track_values[track] = values
+        if not values:
+            self.nulls.add(track)
+        for value in values:
+            tracks = self.values.get(value)
+            if tracks is None:
+                tracks = self.values[value] = set()
+                if self.tokenize:
+                    for token in value.split():
+                        self.__add_token(token, value)
+            tracks.add(track)
+
+    def __add_token(self, token, value):
+        values = self.tokens.get(token)
+        if values is None:
+            values = self.tokens[token] = set()
+            for gram in _grams(token):
+                self.grams.setdefault(gram, set()).add(token)
+        values.add(value)
+
+    def remove(self, track):
+        self.nulls.discard(track)
+        for value in self.track_values.pop(track, ()):
+            tracks = self.values[value]
+            tracks.discard(track)
+            if tracks:
+                continue
+            del self.values[value]
+            if not self.tokenize:
+                continue
+            for token in value.split():
+                values = self.tokens.get(token)
+                if values is None:
+                    continue
+                values.discard(value)
+                if values:
+                    continue
+                del self.tokens[token]
+                for gram in _grams(token):
+                    tokens = self.grams[gram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self.grams[gram]
+
+    def find_equal(self, content):
+        """
+            :returns: the tracks having content as value, or the tracks
+                without a value if content is None
+        """
+        if content is None:
+            return set(self.nulls)
+        return set(self.values.get(content, ()))
+
+    def find_containing(self, content):
+        """
+            :returns: the tracks having a value that contains content,
+                or None if the index can't narrow the search down
+        """
+        pieces = content.split()
+        if not pieces:
+            return None
+        # a piece without whitespace can only be found inside a
+        # single token, so only the tokens containing it are checked
+        piece = max(pieces, key=len)
+        if len(piece) >= _GRAM_SIZE:
+            gramsets = sorted((self.grams.get(gram, ())
+                for gram in _grams(piece)), key=len)
+            tokens = set(gramsets[0]).intersection(*gramsets[1:])
+        else:
+            tokens = self.tokens
+
+        found = set()
+        for token in tokens:
+            if piece not in token:
+                continue
+            for value in self.tokens[token]:
+                if content in value:
+                    found.update(self.values[value])
+        return found
+
+
+class _NumericIndex(object):
+    """
+        Sorted index of the numeric values of a single tag, for range
+        queries.
+
+        keys holds the values in ascending order, and tracks the track
+        each of them belongs to.
+    """
+    __slots__ = ['keys', 'tracks', 'nulls', 'track_values']
+
+    def __init__(self):
+        self.keys = []
+        self.tracks = []
+        self.nulls = set()      # tracks without a value
+        self.track_values = {}  # track -> numeric values of the track
+
+    def __numbers(self, track, values):
+        numbers = set()
+        for value in values:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                continue
+            # NaN never compares true, and would break the ordering
+            if number == number:
+                numbers.add(number)
+        self.track_values[track] = numbers
+        if not values:
+            self.nulls.add(track)
+        return numbers
+
+    def build(self, items):
+        """
+            Indexes many tracks at once
+
+            :param items: iterable of (track, values) tuples
+        """
+        self.__set_pairs([(number, track) for track, values in items
+                for number in self.__numbers(track, values)])
+
+    def __set_pairs(self, pairs):
+        pairs.sort(key=lambda pair: pair[0])
+        self.keys = [pair[0] for pair in pairs]
+        self.tracks = [pair[1] for pair in pairs]
+
+    def update(self, tracks, get_values=None):
+        """
+            Removes many tracks at once, and adds them again with their
+            current values.
+
+            :param tracks: a list of tracks
+            :param get_values: function returning the values of a track,
+                or None to only remove the tracks
+        """
+        if len(tracks) <= _NUMERIC_BATCH:
+            for track in tracks:
+                self.remove(track)
+                if get_values is not None:
+                    self.add(track, get_values(track))
+            return
+        removed = set(tracks)
+        for track in removed:
+            self.nulls.discard(track)
+            self.track_values.pop(track, None)
+        pairs = [pair for pair in zip(self.keys, self.tracks)
+                if pair[1] not in removed]
+        if get_values is not None:
+            # the kept pairs are still sorted, so sorting merges them
+            # with the new ones in linear time
+            pairs.extend((number, track) for track in tracks
+                    for number in self.__numbers(track, get_values(track)))
+        self.__set_pairs(pairs)
+
+    def add(self, track, values):
+        for number in self.__numbers(track, values):
+            i = bisect.bisect_right(self.keys, number)
+            self.keys.insert(i, number)
+            self.tracks.insert(i, track)
+
+    def remove(self, track):
+        self.nulls.discard(track)
+        for number in self.track_values.pop(track, ()):
+            i = self.tracks.index(track,
+                    bisect.bisect_left(self.keys, number),
+                    bisect.bisect_right(self.keys, number))
+            del self.keys[i]
+            del self.tracks[i]
+
+    def find_greater(self, number):
+        return set(self.tracks[bisect.bisect_right(self.keys, number):])
+
+    def find_less(self, number):
+        found = set(self.tracks[:bisect.bisect_left(self.keys, number)])
+        # tracks without a value count as 0
+        if number > 0:
+            found.update(self.nulls)
+        return found
+
+    def find_between(self, low, high):
+        """
+            :returns: the tracks with a value in the open interval
+                (low, high)
+        """
+        return set(self.tracks[bisect.bisect_right(self.keys, low):
+                bisect.bisect_left(self.keys, high)])
+
+
+def _affects(tag, itag):
+    """
+        Whether changing tag changes the search values of itag
+    """
+    # albumartist is searched in the artist tag, and __basename is
+    # derived from __loc
+    return tag is None or tag == itag or \
+            (itag == 'albumartist' and tag == 'artist') or \
+            (itag == '__basename' and tag == '__loc')
+
+
+class SearchIndex(object):
+    """
+        Indexes the tag values of the tracks in a
+        :class:`xl.trax.TrackDB`.
+
+        A tag is indexed the first time it is searched in, and from then
+        on kept up to date as tracks are added, removed and modified.
+
+        :param get_tracks: function returning all tracks to index
+    """
+    def __init__(self, get_tracks):
+        self._get_tracks = get_tracks
+        self._lock = threading.RLock()
+        self._tag_indexes = {}
+        self._numeric_indexes = {}
+
+    def __all_indexes(self):
+        return self._tag_indexes.items() + self._numeric_indexes.items()
+
+    def clear(self):
+        """
+            Drops all indexes, they will be rebuilt when needed
+        """
+        with self._lock:
+            self._tag_indexes = {}
+            self._numeric_indexes = {}
+
+    def add_tracks(self, tracks):
+        with self._lock:
+            for tag, index in self._tag_indexes.iteritems():
+                for track in tracks:
+                    index.remove(track)
+                    index.add(track, _search_values(track, tag))
+            for tag, index in self._numeric_indexes.iteritems():
+                index.update(tracks,
+                        lambda track: _search_values(track, tag))
+
+    def remove_tracks(self, tracks):
+        with self._lock:
+            for index in self._tag_indexes.itervalues():
+                for track in tracks:
+                    index.remove(track)
+            for index in self._numeric_indexes.itervalues():
+                index.update(tracks)
+
+    def update_track(self, track, tag=None):
+        """
+            Updates the indexes after a tag of track has changed.
+
+            :param tag: the tag that changed, or None if unknown
+        """
+        with self._lock:
+            for itag, index in self.__all_indexes():
+                if _affects(tag, itag):
+                    index.remove(track)
+                    index.add(track, _search_values(track, itag))
+
+    def __get_tag_index(self, tag):
+        index = self._tag_indexes.get(tag)
+        if index is None:
+            # internal tags are only looked up as a whole, and values
+            # like __loc would make for a huge number of tokens
+            index = _TagIndex(tokenize=not tag.startswith('__'))
+            for track in self._get_tracks():
+                index.add(track, _search_values(track, tag))
+            self._tag_indexes[tag] = index
+        return index
+
+    def __get_numeric_index(self, tag):
+        index = self._numeric_indexes.get(tag)
+        if index is None:
+            index = _NumericIndex()
+            index.build((track, _search_values(track, tag))
+                    for track in self._get_tracks())
+            self._numeric_indexes[tag] = index
+        return index
+
+    def find_equal(self, tag, content):
+        """
+            Finds the tracks that may have content as a value of tag,
+            ignoring case. If content is None, finds the tracks that
+            don't have the tag.
+
+            :returns: a set of tracks, or None if the search can't be
+                narrowed down using the index
+        """
+        if content is not None and tag.startswith('__'):
+            # internal tags are compared as numbers where possible,
+            # see _ExactMatcher
+            try:
+                number = float(content)
+            except (TypeError, ValueError):
+                pass
+            else:
+                with self._lock:
+                    return self.__get_numeric_index(tag).find_between(
+                            number - 0.0001, number + 0.0001)
+        with self._lock:
+            index = self.__get_tag_index(tag)
+            if content is not None:
+                content = content.lower()
+            return index.find_equal(content)
+
+    def find_containing(self, tag, content):
+        """
+            Finds the tracks that may have a value of tag containing
+            content, ignoring case.
+
+            :returns: a set of tracks, or None if the search can't be
+                narrowed down using the index
+        """
+        if not content or tag.startswith('__'):
+            return None
+        with self._lock:
+            return self.__get_tag_index(tag).find_containing(content.lower())
+
+    def find_greater(self, tag, content):
+        """
+            Finds the tracks having a value of tag that is a number
+            greater than content.
+
+            :returns: a set of tracks
+        """
+        try:
+            number = float(content)
+        except (TypeError, ValueError):
+            return set()
+        with self._lock:
+            return self.__get_numeric_index(tag).find_greater(number)
+
+    def find_less(self, tag, content):
+        """
+            Finds the tracks having a value of tag that is a number
+            less than content. Tracks without the tag count as 0.
+
+            :returns: a set of tracks
+        """
+        try:
+            number = float(content)
+        except (TypeError, ValueError):
+            return set()
+        with self._lock:
+            return self.__get_numeric_index(tag).find_less(number)
+
+# vim: et sts=4 sw=4
@@ -24,12 +24,14 @@
 # do so. If you do not wish to do so, delete this exception statement
 # from your version.
 
+from collections import OrderedDict
+import threading
 import time
 import re
 
 from xl.unicode import shave_marks
 
-__all__ = ['TracksMatcher', 'search_tracks']
+__all__ = ['TracksMatcher', 'search_tracks', 'SearchSession']
 
 class SearchResultTrack(object):
     """
@@ -42,6 +44,12 @@ class SearchResultTrack(object):
         self.track = track
         self.on_tags = []
 
+def _lower(value):
+    return value.lower()
+
+def _identity(value):
+    return value
+
 class _Matcher(object):
     """
         Base class for match conditions
@@ -55,12 +63,7 @@ class _Matcher(object):
         self.lower = lower
 
     def match(self, srtrack):
-        vals = srtrack.track.get_tag_search(self.tag, format=False)
-        if vals == '__null__':
-            vals = None
-        if not isinstance(vals, list):
-            vals = [vals]
-            
+        vals = srtrack.track._get_search_values(self.tag)
         for item in vals:
             if item is not None:
                 item = self.lower(item)
@@ -72,6 +75,15 @@ class _Matcher(object):
     def _matches(self, value):
         raise NotImplementedError
 
+    def candidates(self, index):
+        """
+            Returns the set of tracks that can match this condition, as
+            far as a :class:`xl.trax.index.SearchIndex` can tell.
+
+            :returns: a set of tracks, or None if any track may match
+        """
+        return None
+
 class _ExactMatcher(_Matcher):
     """
         Condition for exact matches
@@ -90,6 +102,9 @@ class _ExactMatcher(_Matcher):
             newcontent = self.content
         return newvalue == newcontent
 
+    def candidates(self, index):
+        return index.find_equal(self.tag, self.content)
+
 class _InMatcher(_Matcher):
     """
         Condition for inexact (ie. containing) matches
@@ -102,6 +117,9 @@ class _InMatcher(_Matcher):
         except TypeError:
             return False
 
+    def candidates(self, index):
+        return index.find_containing(self.tag, self.content)
+
 class _RegexMatcher(_Matcher):
     """
         Condition for regular expression matches
@@ -130,6 +148,9 @@ class _GtMatcher(_Matcher):
             return False
         return value > content
 
+    def candidates(self, index):
+        return index.find_greater(self.tag, self.content)
+
 class _LtMatcher(_Matcher):
     """
         Condition for less than matches.
@@ -145,6 +166,9 @@ class _LtMatcher(_Matcher):
             return False
         return value < content
 
+    def candidates(self, index):
+        return index.find_less(self.tag, self.content)
+
 class _NotMetaMatcher(object):
     """
         Condition for boolean NOT
@@ -157,6 +181,9 @@ class _NotMetaMatcher(object):
     def match(self, srtrack):
         return not self.matcher.match(srtrack)
 
+    def candidates(self, index):
+        return None
+
 class _OrMetaMatcher(object):
     """
         Condition for boolean OR
@@ -169,6 +196,9 @@ class _OrMetaMatcher(object):
     def match(self, srtrack):
         return self.left.match(srtrack) or self.right.match(srtrack)
 
+    def candidates(self, index):
+        return _union([self.left, self.right], index)
+
 class _MultiMetaMatcher(object):
     """
         Condition for boolean AND
@@ -184,6 +214,9 @@ class _MultiMetaMatcher(object):
                 return False
         return True
 
+    def candidates(self, index):
+        return _intersection(self.matchers, index)
+
 class _ManyMultiMetaMatcher(object):
     """
         TODO: think of a proper docstring for this
@@ -211,12 +244,259 @@ class _ManyMultiMetaMatcher(object):
                     self.tags.update(ma.tags)
         return matched
 
+    def candidates(self, index):
+        return _union(self.matchers, index)
+
+class _Clause(object):
+    """
+        A match condition compiled into a plain function, see
+        :meth:`TracksMatcher.compile`.
+
+        :param test: function taking a :class:`SearchResultTrack` and
+            returning whether it matches
+        :param passes: estimated share of tracks that match
+        :param cost: estimated relative cost of calling test
+        :param description: text shown by :meth:`TracksMatcher.explain`
+        :param children: the clauses this clause is made of
+    """
+    __slots__ = ['test', 'passes', 'cost', 'description', 'children',
+            'position', 'get_tags']
+    def __init__(self, test, passes, cost, description, children=()):
+        self.test = test
+        self.passes = passes
+        self.cost = cost
+        self.description = description
+        self.children = children
+        self.position = 0
+        # function returning the tags matched, given the result of test
+        self.get_tags = None
+
+    def and_rank(self):
+        """
+            Sort key for checking clauses that all have to match: cheap
+            clauses that reject many tracks come first.
+        """
+        if self.passes >= 1:
+            return float('inf')
+        return self.cost / (1 - self.passes)
+
+    def or_rank(self):
+        """
+            Sort key for checking clauses of which one has to match:
+            cheap clauses that accept many tracks come first.
+        """
+        if self.passes <= 0:
+            return float('inf')
+        return self.cost / self.passes
+
+    def explain(self, lines, depth):
+        lines.append(u"%s%s  [passes ~%d%%, cost %.1f]" % ("  " * depth,
+            self.description, round(self.passes * 100), self.cost))
+        for child in self.children:
+            child.explain(lines, depth + 1)
+
+def _never(description):
+    return _Clause(lambda srtrack: False, 0.0, 0.0,
+            description + u" (never matches)")
+
+def _values_getter(tag, lower):
+    """
+        Returns a function returning the values of a tag that
+        :meth:`_Matcher.match` would check for a SearchResultTrack
+    """
+    if lower is _identity:
+        return lambda srtrack: srtrack.track._get_search_values(tag)
+    return lambda srtrack: srtrack.track._get_search_values(tag, True)
+
+def _compile_matcher(ma):
+    """
+        Compiles one of the _Matcher subclasses, with constants
+        converted up front
+    """
+    tag, content = ma.tag, ma.content
+    values = _values_getter(tag, ma.lower)
+    mtype = type(ma)
+
+    if mtype is _ExactMatcher:
+        description = u'%s == %s' % (tag, u'__null__' if content is None
+                else u'"%s"' % content)
+        number = None
+        if tag.startswith("__"):
+            try:
+                number = float(content)
+            except (TypeError, ValueError):
+                pass
+        if number is None:
+            def test(srtrack):
+                return content in values(srtrack)
+        else:
+            def test(srtrack):
+                for value in values(srtrack):
+                    try:
+                        if abs(float(value) - number) < 0.0001:
+                            return True
+                    except (TypeError, ValueError):
+                        if value == content:
+                            return True
+                return False
+        return _Clause(test, 0.05, 1.0, description)
+
+    if mtype is _InMatcher:
+        def test(srtrack):
+            for value in values(srtrack):
+                if value:
+                    try:
+                        if content in value:
+                            return True
+                    except TypeError:
+                        pass
+            return False
+        return _Clause(test, 0.2, 1.5, u'%s = "%s"' % (tag, content))
+
+    if mtype is _RegexMatcher:
+        search = ma._re.search
+        def test(srtrack):
+            for value in values(srtrack):
+                if value:
+                    try:
+                        if search(value) is not None:
+                            return True
+                    except TypeError:
+                        pass
+            return False
+        return _Clause(test, 0.2, 4.0, u'%s ~ "%s"' % (tag, content))
+
+    # lowercasing doesn't change what float() returns, so the range
+    # matchers can skip it
+    values = _values_getter(tag, _identity)
+    if mtype is _GtMatcher:
+        description = u'%s > %s' % (tag, content)
+        try:
+            number = float(content)
+        except (TypeError, ValueError):
+            return _never(description)
+        def test(srtrack):
+            for value in values(srtrack):
+                try:
+                    if float(value) > number:
+                        return True
+                except (TypeError, ValueError):
+                    pass
+            return False
+        return _Clause(test, 0.5, 1.2, description)
+
+    if mtype is _LtMatcher:
+        description = u'%s < %s' % (tag, content)
+        try:
+            number = float(content)
+        except (TypeError, ValueError):
+            return _never(description)
+        def test(srtrack):
+            for value in values(srtrack):
+                try:
+                    if (0.0 if value is None else float(value)) < number:
+                        return True
+                except (TypeError, ValueError):
+                    pass
+            return False
+        return _Clause(test, 0.5, 1.2, description)
+
+    return None
+
+def _compile_all(matchers):
+    """
+        Compiles a list of matchers which all have to match
+    """
+    children = sorted((_compile(ma) for ma in matchers),
+            key=_Clause.and_rank)
+    if len(children) == 1:
+        return children[0]
+    tests = [c.test for c in children]
+    def test(srtrack):
+        for t in tests:
+            if not t(srtrack):
+                return False
+        return True
+    passes, cost = 1.0, 0.0
+    for c in children:
+        cost += passes * c.cost
+        passes *= c.passes
+    return _Clause(test, passes, cost, u"ALL", children)
+
+def _compile_any(matchers, collect_tags=False):
+    """
+        Compiles a list of matchers of which one has to match. If
+        collect_tags is True, test returns the tags of all the matchers
+        that match, like _ManyMultiMetaMatcher.
+    """
+    children = [_compile(ma) for ma in matchers]
+    fails, cost = 1.0, 0.0
+    if collect_tags:
+        tagged = [(ma.tag, c.test) for ma, c in zip(matchers, children)]
+        def test(srtrack):
+            return [tag for tag, t in tagged if t(srtrack)]
+        for c in children:
+            cost += c.cost
+            fails *= 1 - c.passes
+    else:
+        children.sort(key=_Clause.or_rank)
+        tests = [c.test for c in children]
+        def test(srtrack):
+            for t in tests:
+                if t(srtrack):
+                    return True
+            return False
+        for c in children:
+            cost += fails * c.cost
+            fails *= 1 - c.passes
+    return _Clause(test, 1 - fails, cost, u"ANY", children)
+
+def _compile(ma, collect_tags=False):
+    """
+        Compiles a matcher into a :class:`_Clause`. Matchers that aren't
+        known here are called as they are.
+
+        :param collect_tags: whether to set up the clause to report the
+            tags it matched on, for :meth:`TracksMatcher.match`
+    """
+    mtype = type(ma)
+    clause = None
+    if isinstance(ma, _Matcher) and ma.lower in (_lower, _identity):
+        clause = _compile_matcher(ma)
+        if clause is not None and collect_tags:
+            tag = ma.tag
+            clause.get_tags = lambda result: (tag,)
+    elif mtype is _NotMetaMatcher:
+        child = _compile(ma.matcher)
+        test = child.test
+        clause = _Clause(lambda srtrack: not test(srtrack),
+                1 - child.passes, child.cost, u"NOT", (child,))
+    elif mtype is _OrMetaMatcher:
+        clause = _compile_any([ma.left, ma.right])
+        clause.description = u"OR"
+    elif mtype is _MultiMetaMatcher:
+        clause = _compile_all(ma.matchers)
+    elif mtype is _ManyMultiMetaMatcher and \
+            all(type(m) is _InMatcher for m in ma.matchers):
+        clause = _compile_any(ma.matchers, collect_tags)
+        if collect_tags:
+            clause.get_tags = lambda result: result
+
+    if clause is None:
+        clause = _Clause(ma.match, 0.5, 2.0, mtype.__name__)
+        if collect_tags:
+            if getattr(ma, 'tag', None) is not None:
+                clause.get_tags = lambda result: (ma.tag,)
+            elif hasattr(ma, 'tags'):
+                clause.get_tags = lambda result: ma.tags
+    return clause
+
 class TracksMatcher(object):
     """
         Holds criteria and determines whether
         a given track matches those criteria.
     """
-    __slots__ = ['matchers', 'case_sensitive', 'keyword_tags']
+    __slots__ = ['matchers', 'case_sensitive', 'keyword_tags', '_plan']
     def __init__(self, search_string, case_sensitive=True, keyword_tags=None):
         """
             :param search_string: a string describing the match conditions
@@ -232,6 +512,7 @@ class TracksMatcher(object):
         tokens = self.__red(tokens)
         tokens = self.__optimize_tokens(tokens)
         self.matchers = self.__tokens_to_matchers(tokens)
+        self._plan = None
 
     def append_matcher(self, matcher, or_match=False):
         '''Here so you can use playlist matchers. Probably needs better impl'''
@@ -239,6 +520,7 @@ class TracksMatcher(object):
             self.matchers.append(matcher)
         else:
             self.matchers[-1] = _OrMetaMatcher(self.matchers[-1], matcher)
+        self._plan = None
 
     def prepend_matcher(self, matcher, or_match=False):
         '''Here so you can use playlist matchers. Probably needs better impl'''
@@ -246,25 +528,74 @@ class TracksMatcher(object):
             self.matchers.insert(0, matcher)
         else:
             self.matchers[0] = _OrMetaMatcher(matcher, self.matchers[0])
+        self._plan = None
+
+    def compile(self):
+        """
+            Turns the matchers into a list of :class:`_Clause`, which
+            all have to match, in the order they should be checked in.
+            This is done automatically the first time a track is matched.
+        """
+        plan = []
+        for position, ma in enumerate(self.matchers):
+            clause = _compile(ma, collect_tags=True)
+            clause.position = position
+            plan.append(clause)
+        plan.sort(key=_Clause.and_rank)
+        self._plan = plan
+        return plan
+
+    def explain(self):
+        """
+            Describes how tracks are matched: the conditions, in the
+            order they are checked, with the estimated share of tracks
+            passing each one and its relative cost.
+
+            :returns: a multi-line string
+        """
+        plan = self._plan
+        if plan is None:
+            plan = self.compile()
+        if not plan:
+            return u"(matches all tracks)"
+        lines = []
+        for clause in plan:
+            clause.explain(lines, 0)
+        return u"\n".join(lines)
 
     def match(self, srtrack):
         """
             Determine whether a given SearchResultTrack's internal
             Track object matches this search condition.
         """
-        for ma in self.matchers:
-            if not ma.match(srtrack):
-                break
-            if ma.tag is not None:
-                if ma.tag not in srtrack.on_tags:
-                    srtrack.on_tags.append(ma.tag)
-            elif hasattr(ma, 'tags'):
-                for t in ma.tags:
-                    if t not in srtrack.on_tags:
-                        srtrack.on_tags.append(t)
-        else:
-            return True
-        return False
+        plan = self._plan
+        if plan is None:
+            plan = self.compile()
+        matched = []
+        for clause in plan:
+            result = clause.test(srtrack)
+            if not result:
+                return False
+            if clause.get_tags is not None:
+                matched.append((clause.position, clause, result))
+
+        # the tags are recorded in the order of the matchers
+        matched.sort()
+        on_tags = srtrack.on_tags
+        for position, clause, result in matched:
+            for t in clause.get_tags(result):
+                if t not in on_tags:
+                    on_tags.append(t)
+        return True
+
+    def candidates(self, index):
+        """
+            Returns the set of tracks that can match this condition, as
+            far as a :class:`xl.trax.index.SearchIndex` can tell.
+
+            :returns: a set of tracks, or None if any track may match
+        """
+        return _intersection(self.matchers, index)
 
     def __tokens_to_matchers(self, tokens, matchers=None):
         """
@@ -307,9 +638,9 @@ class TracksMatcher(object):
         # normal token
         else:
             if not self.case_sensitive:
-                lower = lambda x: x.lower()
+                lower = _lower
             else:
-                lower = lambda x: x
+                lower = _identity
 
             # TODO: this stuff is kinda repetitive, can we consolidate
             # it? Maybe move some of this into the matcher classes?
@@ -480,6 +811,9 @@ class TracksInList(object):
     def match(self, track):
         return track.track in self._tracks
 
+    def candidates(self, index):
+        return set(self._tracks)
+
 
 class TracksNotInList(TracksInList):
     '''
@@ -488,15 +822,85 @@ class TracksNotInList(TracksInList):
     def match(self, track):
         return track.track not in self._tracks
 
+    def candidates(self, index):
+        return None
+
+
+def _candidates(matcher, index):
+    try:
+        candidates = matcher.candidates
+    except AttributeError: # matchers from elsewhere
+        return None
+    return candidates(index)
+
+def _intersection(matchers, index):
+    """
+        Returns the tracks that can match all matchers, or None
+    """
+    result = None
+    for ma in matchers:
+        candidates = _candidates(ma, index)
+        if candidates is None:
+            continue
+        if result is None:
+            result = candidates
+        else:
+            result &= candidates
+    return result
+
+def _union(matchers, index):
+    """
+        Returns the tracks that can match any of the matchers, or None
+    """
+    result = set()
+    for ma in matchers:
+        candidates = _candidates(ma, index)
+        if candidates is None:
+            return None
+        result |= candidates
+    return result
+
 
-def search_tracks(trackiter, trackmatchers):
+def _get_trackdb_candidates(trackdb, matchers, index=None):
+    """
+        Returns the tracks of a :class:`xl.trax.TrackDB` that can match
+        all matchers. Unlike iterating over the TrackDB, this is safe
+        while other threads add or remove tracks.
+    """
+    if index is None:
+        index = trackdb.get_search_index()
+    candidates = _intersection(matchers, index)
+    if candidates is None:
+        return trackdb.get_tracks()
+    return candidates
+
+
+def search_tracks(trackiter, trackmatchers, index=None):
     """
         Search a set of tracks for those that match specified conditions.
 
         :param trackiter: An iterable object returning Track objects
         :param trackmatchers: A list of TrackMatcher objects
+        :param index: The :class:`xl.trax.index.SearchIndex` of a
+            :class:`xl.trax.TrackDB` containing all tracks of trackiter.
+            If given, only the tracks that the index can't rule out are
+            checked. Not needed if trackiter is the TrackDB itself.
     """
+    candidates = None
+    if index is None and hasattr(trackiter, 'get_search_index'):
+        # the order of a TrackDB doesn't matter, so only look at
+        # the candidates
+        trackiter = _get_trackdb_candidates(trackiter, trackmatchers)
+    elif index is not None:
+        candidates = _intersection(trackmatchers, index)
+
     for srtr in trackiter:
+        if candidates is not None:
+            if isinstance(srtr, SearchResultTrack):
+                if srtr.track not in candidates:
+                    continue
+            elif srtr not in candidates:
+                continue
         if not isinstance(srtr, SearchResultTrack):
             srtr = SearchResultTrack(srtr)
         for tma in trackmatchers:
@@ -514,18 +918,111 @@ def search_tracks(trackiter, trackmatchers):
         time.sleep(0)
 
 
+class _ResultCache(object):
+    """
+        Least recently used search results, limited both by the number
+        of results and by the number of tracks in all of them, so that
+        broad searches on a large collection don't keep many copies of
+        it (or tracks that were removed from it) alive.
+    """
+    def __init__(self, limit, track_limit):
+        self.limit = limit
+        self.track_limit = track_limit
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get(self, key):
+        """
+            :raises KeyError: if there are no results for key
+        """
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.track_limit:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while len(self.entries) > self.limit or self.size > self.track_limit:
+            key, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+# results of recent searches on TrackDBs, as tuples of (track, on_tags)
+_result_cache = _ResultCache(32, 20000)
+_result_cache_lock = threading.Lock()
+
+def _cache_key(trackiter, search_string, case_sensitive, keyword_tags):
+    """
+        Returns the key for the results of a search in the result cache,
+        or None if they can't be cached. This is only possible for
+        :class:`xl.trax.TrackDB`, whose generation changes whenever
+        the results might.
+    """
+    try:
+        generation = trackiter.get_generation()
+    except AttributeError:
+        return None
+    return (search_string, tuple(keyword_tags or ()), bool(case_sensitive),
+            generation)
+
+def _get_cached_results(key):
+    """
+        :returns: a new list of SearchResultTracks, or None
+    """
+    with _result_cache_lock:
+        try:
+            cached = _result_cache.get(key)
+        except KeyError:
+            return None
+    results = []
+    for track, on_tags in cached:
+        srtr = SearchResultTrack(track)
+        srtr.on_tags = list(on_tags)
+        results.append(srtr)
+    return results
+
+def _cache_results(key, results):
+    # an empty query matches every track, which is quickly done again
+    if not key[0].strip():
+        return
+    cached = tuple((srtr.track, tuple(srtr.on_tags)) for srtr in results)
+    with _result_cache_lock:
+        _result_cache.put(key, cached)
+
 def search_tracks_from_string(trackiter, search_string,
-        case_sensitive=True, keyword_tags=None):
+        case_sensitive=True, keyword_tags=None, index=None):
     """
         Convenience wrapper around search_tracks that builds matchers
         automatically from the search string.
 
+        When searching a :class:`xl.trax.TrackDB`, the results are
+        cached until its tracks change.
+
         Arguments have the same meaning as the corresponding arguments on
         on :class:`search_tracks` and :class:`TracksMatcher`.
     """
     matchers = [TracksMatcher(search_string, case_sensitive=case_sensitive,
         keyword_tags=keyword_tags)]
-    return search_tracks(trackiter, matchers)
+    key = _cache_key(trackiter, search_string, case_sensitive, keyword_tags)
+    if key is None:
+        return search_tracks(trackiter, matchers, index=index)
+
+    results = _get_cached_results(key)
+    if results is None:
+        results = list(search_tracks(trackiter, matchers, index=index))
+        _cache_results(key, results)
+    return iter(results)
 
 
 def match_track_from_string(track, search_string,
@@ -535,4 +1032,148 @@ def match_track_from_string(track, search_string,
     return matcher.match(SearchResultTrack(track))
 
 
+def _implies(new, old):
+    """
+        Whether every track matched by the matcher new is also matched
+        by the matcher old. False if that can't be told.
+    """
+    mtype = type(new)
+    if mtype is not type(old):
+        return False
+    if isinstance(new, _Matcher):
+        if new.tag != old.tag or new.lower is not old.lower:
+            return False
+        if new.content == old.content:
+            return True
+        try:
+            if mtype is _InMatcher:
+                return old.content in new.content
+            elif mtype is _GtMatcher:
+                return float(new.content) >= float(old.content)
+            elif mtype is _LtMatcher:
+                return float(new.content) <= float(old.content)
+        except (TypeError, ValueError):
+            pass
+        return False
+    elif mtype is _ManyMultiMetaMatcher:
+        return len(new.matchers) == len(old.matchers) and \
+            all(_implies(n, o) for n, o in zip(new.matchers, old.matchers))
+    elif mtype is _MultiMetaMatcher:
+        return _implies_all(new.matchers, old.matchers)
+    elif mtype is _NotMetaMatcher:
+        return _implies(old.matcher, new.matcher)
+    elif mtype is _OrMetaMatcher:
+        return all(_implies(n, old.left) or _implies(n, old.right)
+                for n in (new.left, new.right))
+    return False
+
+def _implies_all(new, old):
+    """
+        Whether tracks matching all of the matchers in new also match
+        all of the matchers in old
+    """
+    return all(any(_implies(n, o) for n in new) for o in old)
+
+
+class SearchCancelled(Exception):
+    """
+        Raised by :meth:`SearchSession.search` when the search was
+        cancelled
+    """
+
 
+class SearchSession(object):
+    """
+        Runs the searches of a search box, where each query is usually
+        the previous one with a character or a term added.
+
+        The results of the last search are remembered. If the new query
+        is a refinement of the last one, ie. it can only match tracks
+        that the last one matched, only those tracks are searched
+        again. Starting a search cancels the one that is still running.
+
+        :param case_sensitive: whether to search in a case-sensitive
+            manner.
+    """
+    def __init__(self, case_sensitive=True):
+        self.case_sensitive = case_sensitive
+        self._lock = threading.Lock()
+        self._serial = 0
+        # (trackiter, generation, keyword_tags, matcher, matched tracks)
+        self._last = None
+
+    def reset(self):
+        """
+            Forgets the last results, so that the next search looks at
+            all tracks. Call this when tracks were modified.
+        """
+        with self._lock:
+            self._last = None
+
+    def cancel(self):
+        """
+            Cancels the search that is running, if any. Can be called
+            from any thread.
+        """
+        with self._lock:
+            self._serial += 1
+
+    def __check(self, trackiter, serial):
+        for track in trackiter:
+            if self._serial != serial:
+                raise SearchCancelled()
+            yield track
+
+    def search(self, trackiter, search_string, keyword_tags=None,
+            index=None):
+        """
+            Searches for the tracks matching search_string.
+
+            :param trackiter: the tracks to search. Results of the last
+                search are only reused when this is the same object.
+            :param keyword_tags: a list of tags to match search keywords
+                in.
+            :param index: passed to :func:`search_tracks`
+            :returns: a list of :class:`SearchResultTrack`, in the
+                order of trackiter
+            :raises SearchCancelled: if :meth:`cancel` was called or
+                another search was started before this one finished
+        """
+        matcher = TracksMatcher(search_string,
+                case_sensitive=self.case_sensitive,
+                keyword_tags=keyword_tags)
+        with self._lock:
+            self._serial += 1
+            serial = self._serial
+            last = self._last
+
+        key = _cache_key(trackiter, search_string, self.case_sensitive,
+                keyword_tags)
+        # the generation is the last item of the key
+        generation = key and key[-1]
+
+        results = None
+        tracks = trackiter
+        if last is not None and last[0] is trackiter and \
+                last[1] == generation and \
+                last[2] == matcher.keyword_tags and \
+                _implies_all(matcher.matchers, last[3].matchers):
+            tracks = last[4]
+        elif key is not None:
+            results = _get_cached_results(key)
+            if results is None:
+                tracks = _get_trackdb_candidates(trackiter, [matcher], index)
+                index = None
+
+        if results is None:
+            results = list(search_tracks(self.__check(tracks, serial),
+                    [matcher], index=index))
+            if key is not None:
+                _cache_results(key, results)
+
+        with self._lock:
+            if self._serial != serial:
+                raise SearchCancelled()
+            self._last = (trackiter, generation, matcher.keyword_tags,
+                    matcher, [srtr.track for srtr in results])
+        return results
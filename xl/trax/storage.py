@@ -0,0 +1,409 @@
+# Copyright (C) 2008-2010 Adam Olsen
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# The developers of the Exaile media player hereby grant permission
+# for non-GPL compatible GStreamer and Exaile plugins to be used and
+# distributed together with GStreamer and Exaile. This permission is
+# above and beyond the permissions granted by the GPL license by which
+# Exaile is covered. If you modify this code, you may extend this
+# exception to your version of the code, but you are not obligated to
+# do so. If you do not wish to do so, delete this exception statement
+# from your version.
+
+"""
+Storage engines used to persist a :class:`xl.trax.TrackDB`.
+
+A storage engine stores two kinds of data: named attributes of the
+TrackDB (its name, library settings, etc.), and one record per track,
+consisting of the track's key, its tag dictionary and a dictionary of
+extra attributes.
+
+The engine used for the main collection is selected with the
+``collection/storage_engine`` setting, see :func:`get_engine`.
+"""
+
+from __future__ import absolute_import
+
+import cPickle
+import itertools
+import logging
+import shelve
+import shutil
+import sqlite3
+
+from xl import common
+
+logger = logging.getLogger(__name__)
+
+
+class TrackDBStorage(object):
+    """
+        Base class for TrackDB storage engines.
+
+        Storages are opened for the duration of a single load or save,
+        and can be used as a context manager::
+
+            with SQLiteStorage(location) as storage:
+                print storage.get_track_count()
+
+        :param location: Path to the file the data is stored in
+    """
+    #: suggested file name for the main collection
+    filename = None
+
+    def __init__(self, location):
+        self.location = location
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """
+            Opens the storage, creating it if it does not exist yet.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+            Closes the storage, writing out any pending changes
+        """
+        raise NotImplementedError
+
+    def get_version(self):
+        """
+            :returns: the version of the stored data, or None if the
+                storage is empty
+        """
+        return self.get('_dbversion')
+
+    def migrate(self, oldversion, newversion):
+        """
+            Upgrades the stored data from an older database version
+        """
+        raise common.VersionError("Don't know how to handle upgrade from "
+                "music database version %s to %s." % (oldversion, newversion))
+
+    def get(self, attr, default=None):
+        """
+            Retrieves a stored TrackDB attribute
+        """
+        raise NotImplementedError
+
+    def set(self, attr, value):
+        """
+            Stores a TrackDB attribute
+        """
+        raise NotImplementedError
+
+    def iter_tracks(self):
+        """
+            Iterates over all stored track records.
+
+            :returns: iterator of (key, tags, attrs) tuples
+        """
+        raise NotImplementedError
+
+    def get_track_count(self):
+        """
+            :returns: the number of stored tracks
+        """
+        return sum(1 for record in self.iter_tracks())
+
+    def write_tracks(self, records):
+        """
+            Stores track records, replacing any existing records that
+            have the same key.
+
+            :param records: iterable of (key, tags, attrs) tuples
+        """
+        raise NotImplementedError
+
+    def delete_tracks(self, keys):
+        """
+            Removes the track records with the given keys
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        """
+            Makes all changes since the last commit permanent
+        """
+        raise NotImplementedError
+
+
+class ShelveStorage(TrackDBStorage):
+    """
+        Stores each track as a pickled record in a :mod:`shelve` database.
+    """
+    filename = 'music.db'
+
+    def __init__(self, location):
+        TrackDBStorage.__init__(self, location)
+        self._pdata = None
+
+    def open(self):
+        try:
+            self._pdata = shelve.open(self.location, flag='c',
+                    protocol=common.PICKLE_PROTOCOL)
+        except ImportError:
+            import bsddb3 # ArchLinux disabled bsddb in python2, so we have to use the external module
+            _db = bsddb3.hashopen(self.location, 'c')
+            self._pdata = shelve.Shelf(_db, protocol=common.PICKLE_PROTOCOL)
+
+    def close(self):
+        if self._pdata is not None:
+            self._pdata.close()
+            self._pdata = None
+
+    def migrate(self, oldversion, newversion):
+        logger.info("Upgrading DB format....")
+        shutil.copyfile(self.location,
+                self.location + "-%s.bak" % oldversion)
+        import xl.migrations.database as dbmig
+        dbmig.handle_migration(self, self._pdata, oldversion, newversion)
+
+    def get(self, attr, default=None):
+        return self._pdata.get(attr, default)
+
+    def set(self, attr, value):
+        self._pdata[attr] = value
+
+    def iter_tracks(self):
+        for k in (x for x in self._pdata.keys() if x.startswith("tracks-")):
+            p = self._pdata[k]
+            yield (p[1], p[0], p[2])
+
+    def write_tracks(self, records):
+        for key, tags, attrs in records:
+            self._pdata["tracks-%s" % key] = (tags, key, attrs)
+
+    def delete_tracks(self, keys):
+        for key in keys:
+            key = "tracks-%s" % key
+            if key in self._pdata:
+                del self._pdata[key]
+
+    def commit(self):
+        self._pdata.sync()
+
+
+# How a value is stored in the tags table
+_PLAIN, _BYTES, _PICKLED = range(3)
+
+# idx value for tags that are not stored as a list
+_SCALAR = -1
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS attrs (
+        name TEXT PRIMARY KEY,
+        value BLOB
+    );
+    CREATE TABLE IF NOT EXISTS tracks (
+        key INTEGER PRIMARY KEY,
+        loc TEXT,
+        attrs BLOB
+    );
+    CREATE INDEX IF NOT EXISTS tracks_loc ON tracks (loc);
+    CREATE TABLE IF NOT EXISTS tags (
+        track INTEGER NOT NULL,
+        tag TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
+        value,
+        PRIMARY KEY (track, tag, idx)
+    );
+    CREATE INDEX IF NOT EXISTS tags_tag_value ON tags (tag, value);
+"""
+
+
+def _pickle(value):
+    return buffer(cPickle.dumps(value, common.PICKLE_PROTOCOL))
+
+
+def _encode_value(value):
+    """
+        Returns a (kind, value) tuple suitable for storing value in the
+        tags table
+    """
+    vtype = type(value)
+    if value is None or vtype in (unicode, int, long, float):
+        return _PLAIN, value
+    elif vtype is str:
+        return _BYTES, buffer(value)
+    return _PICKLED, _pickle(value)
+
+
+def _decode_value(kind, value):
+    if kind == _PLAIN:
+        return value
+    elif kind == _BYTES:
+        return str(value)
+    return cPickle.loads(str(value))
+
+
+def _decode_tags(rows):
+    """
+        Builds the tag dictionary of a track from its rows of the tags
+        table, as (tag, idx, kind, value) tuples ordered by tag and idx
+    """
+    tags = {}
+    for tag, idx, kind, value in rows:
+        value = _decode_value(kind, value)
+        if idx == _SCALAR:
+            tags[tag] = value
+        else:
+            tags.setdefault(tag, []).append(value)
+    return tags
+
+
+def _decode_attrs(value):
+    return cPickle.loads(str(value)) if value else {}
+
+
+class SQLiteStorage(TrackDBStorage):
+    """
+        Stores tracks in a SQLite database, with one row per tag value.
+
+        The database is kept in WAL mode and every save is a single
+        transaction, so an interrupted save leaves the previous state
+        intact. Since tags are stored in their own table, statistics can
+        be queried without loading any :class:`xl.trax.Track` objects.
+    """
+    filename = 'music.sqlite'
+
+    def __init__(self, location):
+        TrackDBStorage.__init__(self, location)
+        self._conn = None
+
+    def open(self):
+        self._conn = sqlite3.connect(self.location)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.rollback()
+            self._conn.close()
+            self._conn = None
+
+    def get(self, attr, default=None):
+        row = self._conn.execute('SELECT value FROM attrs WHERE name=?',
+                (attr,)).fetchone()
+        if row is None:
+            return default
+        return cPickle.loads(str(row[0]))
+
+    def set(self, attr, value):
+        self._conn.execute('INSERT OR REPLACE INTO attrs (name, value) '
+                'VALUES (?, ?)', (attr, _pickle(value)))
+
+    def __iter_tag_rows(self):
+        """
+            :returns: iterator of (key, rows) tuples, with the rows of
+                the tags table for each track
+        """
+        cursor = self._conn.execute('SELECT track, tag, idx, kind, value '
+                'FROM tags ORDER BY track, tag, idx')
+        for key, rows in itertools.groupby(cursor, lambda row: row[0]):
+            yield key, tuple(row[1:] for row in rows)
+
+    def iter_tracks(self):
+        attrs = dict(self._conn.execute('SELECT key, attrs FROM tracks'))
+        for key, rows in self.__iter_tag_rows():
+            yield (key, _decode_tags(rows), _decode_attrs(attrs.pop(key, None)))
+
+        # tracks without any tags
+        for key, tattrs in attrs.iteritems():
+            yield (key, {}, _decode_attrs(tattrs))
+
+    def get_track_count(self):
+        return self._conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    def get_tag_value_counts(self, tag):
+        """
+            Counts how many tracks have each value of a tag, without
+            loading the tracks.
+
+            :returns: a dictionary mapping values to track counts
+        """
+        counts = {}
+        for kind, value, count in self._conn.execute(
+                'SELECT kind, value, COUNT(*) FROM tags WHERE tag=? '
+                'GROUP BY kind, value', (tag,)):
+            value = _decode_value(kind, value)
+            try:
+                counts[value] = counts.get(value, 0) + count
+            except TypeError: # unhashable
+                pass
+        return counts
+
+    def write_tracks(self, records):
+        tracks = []
+        tags = []
+        for key, ttags, tattrs in records:
+            tracks.append((key, ttags.get('__loc'),
+                    _pickle(tattrs) if tattrs else None))
+            for tag, value in ttags.iteritems():
+                if isinstance(value, list) and value:
+                    for idx, v in enumerate(value):
+                        tags.append((key, tag, idx) + _encode_value(v))
+                else:
+                    tags.append((key, tag, _SCALAR) + _encode_value(value))
+
+        keys = [(t[0],) for t in tracks]
+        self._conn.executemany('DELETE FROM tags WHERE track=?', keys)
+        self._conn.executemany('INSERT OR REPLACE INTO tracks '
+                '(key, loc, attrs) VALUES (?, ?, ?)', tracks)
+        self._conn.executemany('INSERT INTO tags (track, tag, idx, kind, '
+                'value) VALUES (?, ?, ?, ?, ?)', tags)
+
+    def delete_tracks(self, keys):
+        keys = [(key,) for key in keys]
+        self._conn.executemany('DELETE FROM tags WHERE track=?', keys)
+        self._conn.executemany('DELETE FROM tracks WHERE key=?', keys)
+
+    def commit(self):
+        self._conn.commit()
+
+
+#: available storage engines, by the name used in settings
+ENGINES = {
+    'shelve': ShelveStorage,
+    'sqlite': SQLiteStorage,
+}
+
+
+def get_engine(name=None):
+    """
+        Returns the storage engine class with the given name. If no name
+        is given, the ``collection/storage_engine`` setting is used.
+    """
+    if name is None:
+        from xl import settings
+        name = settings.get_option('collection/storage_engine', 'shelve')
+    try:
+        return ENGINES[name]
+    except KeyError:
+        logger.warning("Unknown storage engine %r, using shelve", name)
+        return ShelveStorage
+
+# vim: et sts=4 sw=4
@@ -25,10 +25,12 @@
 # do so. If you do not wish to do so, delete this exception statement
 # from your version.
 
+from collections import OrderedDict
 from copy import deepcopy
 from gi.repository import Gio
 from gi.repository import GLib
 import logging
+import threading
 import time
 import unicodedata
 import weakref
@@ -71,62 +73,128 @@ _JOINSTR = _(u' / ')
 
 _no_set_raw = {'__basename'} | disk_tags
 
+# maximum number of tags whose search values are cached per track
+_SEARCH_CACHE_TAGS = 16
+# maximum number of sort keys cached per track
+_SORT_CACHE_KEYS = 16
+
 class _MetadataCacher(object):
     """
         Cache metadata Format objects to speed up get_tag_disk
+
+        Entries are kept in least recently used order, so that looking
+        them up, adding and evicting them takes constant time. Entries
+        that haven't been used for timeout seconds are dropped.
     """
-    def __init__(self, timeout=10, maxentries=20):
+    def __init__(self, timeout=10, maxentries=20, check_interval=1):
         """
             :param timeout: time (in s) until the cached obj gets removed.
             :param maxentries: maximum number of format objs to cache
+            :param check_interval: time (in s) for which an entry is used
+                without checking the modification time of its file again
         """
-        self._cache = []
+        # trackobj -> [formatobj, mtime, time of last use, time of last
+        # mtime check], oldest first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
         self.timeout = timeout
         self.maxentries = maxentries
+        self.check_interval = check_interval
         self._cleanup_id = None
+        #: number of lookups that found a usable entry
+        self.hits = 0
+        #: number of lookups that didn't
+        self.misses = 0
 
     def __cleanup(self):
-        if self._cleanup_id:
-            GLib.source_remove(self._cleanup_id)
-            self._cleanup_id = None
+        self._cleanup_id = None
         current = time.time()
         thresh = current - self.timeout
-        for item in self._cache[:]:
-            if item[2] < thresh:
-                self._cache.remove(item)
-        if self._cache:
-            next_expiry = min([i[2] for i in self._cache])
-            timeout = int((next_expiry + self.timeout) - current)
-            self._cleanup_id = GLib.timeout_add_seconds(timeout,
-                    self.__cleanup)
-
-    def add(self, trackobj, formatobj):
-        for item in self._cache:
-            if item[0] == trackobj:
-                return
-        item = [trackobj, formatobj, time.time()]
-        self._cache.append(item)
-        if len(self._cache) > self.maxentries:
-            least = min([(i[2], i) for i in self._cache])[1]
-            self._cache.remove(least)
-        if not self._cleanup_id:
-            self._cleanup_id = GLib.timeout_add_seconds(self.timeout,
-                    self.__cleanup)
+        with self._lock:
+            # the least recently used entries come first
+            while self._cache:
+                trackobj, item = next(self._cache.iteritems())
+                if item[2] >= thresh:
+                    break
+                del self._cache[trackobj]
+            if self._cache:
+                next_expiry = next(self._cache.itervalues())[2] + self.timeout
+                self._cleanup_id = GLib.timeout_add_seconds(
+                        max(1, int(next_expiry - current) + 1), self.__cleanup)
+        return False
+
+    def add(self, trackobj, formatobj, mtime=None):
+        """
+            :param mtime: the modification time of the file formatobj
+                was read from, see get
+        """
+        with self._lock:
+            self._cache.pop(trackobj, None)
+            current = time.time()
+            self._cache[trackobj] = [formatobj, mtime, current, current]
+            while len(self._cache) > self.maxentries:
+                self._cache.popitem(last=False)
+            if not self._cleanup_id:
+                self._cleanup_id = GLib.timeout_add_seconds(self.timeout,
+                        self.__cleanup)
 
     def remove(self, trackobj):
-        for item in self._cache:
-            if item[0] == trackobj:
-                self._cache.remove(item)
-                break
+        with self._lock:
+            self._cache.pop(trackobj, None)
+
+    def get(self, trackobj, get_mtime=None):
+        """
+            :param get_mtime: a function returning the current
+                modification time of the file, see add. It is only
+                called if the entry wasn't checked in the last
+                check_interval seconds; if the time differs from the one
+                the entry was added with, the entry is dropped.
+            :returns: the cached formatobj, or None
+        """
+        with self._lock:
+            item = self._cache.pop(trackobj, None)
+            current = time.time()
+            if item is not None and current - item[2] > self.timeout:
+                item = None
+
+        # outside of the lock, since querying the file can block
+        if item is not None and get_mtime is not None and \
+                current - item[3] > self.check_interval:
+            if get_mtime() != item[1]:
+                item = None
+            else:
+                item[3] = current
+
+        with self._lock:
+            if item is None:
+                self.misses += 1
+                return None
+            item[2] = current
+            self._cache[trackobj] = item
+            while len(self._cache) > self.maxentries:
+                self._cache.popitem(last=False)
+            self.hits += 1
+            return item[0]
 
-    def get(self, trackobj):
-        for item in self._cache:
-            if item[0] == trackobj:
-                item[2] = time.time()
-                return item[1]
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
 
 
-_CACHER = _MetadataCacher()
+_CACHER = _MetadataCacher(
+        maxentries=settings.get_option('collection/metadata_cache_size', 20))
+
+def _get_mtime(loc):
+    """
+        :returns: the modification time of the file at loc as a
+            (seconds, microseconds) tuple, or None
+    """
+    try:
+        mtime = Gio.File.new_for_uri(loc).query_info("time::modified",
+                Gio.FileQueryInfoFlags.NONE, None).get_modification_time()
+    except GLib.Error:
+        return None
+    return (mtime.tv_sec, mtime.tv_usec)
 
 class Track(object):
     """
@@ -134,12 +202,20 @@ class Track(object):
     """
     # save a little memory this way
     __slots__ = ["__tags", "_scan_valid",
-            "_dirty", "__weakref__", "_init"]
+            "_dirty", "__weakref__", "_init", "__search_cache",
+            "__sort_cache"]
     # this is used to enforce the one-track-per-uri rule
     __tracksdict = weakref.WeakValueDictionary()
     # store a copy of the settings values here - much faster (0.25 cpu
     # seconds) (see _the_cuts_cb)
     __the_cuts = settings.get_option('collection/strip_list', [])
+    # changed whenever the cached sort keys of all tracks become invalid
+    # (see get_tag_sort)
+    __sort_generation = 0
+    # weak references to the TrackDBs that want to know when one of their
+    # tracks is modified (see TrackDB._track_dirtied). This is replaced
+    # rather than modified, so that it can be iterated from any thread.
+    __trackdbs = ()
 
     def __new__(cls, *args, **kwargs):
         """
@@ -174,7 +250,9 @@ class Track(object):
                 uri = unpickles.get("__loc")
 
         if uri is not None:
-            uri = Gio.File.new_for_uri(uri).get_uri()
+            # pickled locations were already normalized when they were set
+            if unpickles is None:
+                uri = Gio.File.new_for_uri(uri).get_uri()
             try:
                 tr = cls.__tracksdict[uri]
                 tr._init = False
@@ -225,14 +303,17 @@ class Track(object):
         self.__tags = {}
         self._scan_valid = None # whether our last tag read attempt worked
         self._dirty = False
+        self.__search_cache = None
+        self.__sort_cache = None
 
         if _unpickles:
             self._unpickles(_unpickles)
             self.__register()
         elif uri:
-            self.set_loc(uri)
+            # no one knows about a new track yet
+            self.set_loc(uri, notify_changed=False)
             if scan:
-                self.read_tags()
+                self.read_tags(notify_changed=False)
         else:
             raise ValueError("Cannot create a Track from nothing")
 
@@ -253,17 +334,38 @@ class Track(object):
         except KeyError:
             pass
 
-    def set_loc(self, loc):
+    def __set_dirty(self, tag):
+        """
+            Flag this track as modified, and let any TrackDB holding it
+            know that it needs to be saved.
+
+            :param tag: the tag that was modified
+        """
+        self._dirty = True
+        # the tag has already been set, so anything cached after this
+        # uses the new value
+        self.__search_cache = None
+        self.__sort_cache = None
+        for ref in Track.__trackdbs:
+            db = ref()
+            if db is not None:
+                db._track_dirtied(self, tag)
+
+    def set_loc(self, loc, notify_changed=True):
         """
             Sets the location.
 
             :param loc: the location, as either a uri or a file path.
+            :param notify_changed: whether to send a signal, see
+                set_tag_raw
         """
         self.__unregister()
         gloc = Gio.File.new_for_commandline_arg(loc)
         self.__tags['__loc'] = gloc.get_uri()
         self.__register()
-        event.log_event('track_tags_changed', self, '__loc')
+        self.__set_dirty('__loc')
+        if notify_changed:
+            event.log_event('track_tags_changed', self, '__loc')
 
     def exists(self):
         """
@@ -348,9 +450,7 @@ class Track(object):
             
             # now that we've written the tags to disk, remove any tags that the
             # user asked to be deleted
-            to_remove = [k for k,v in self.__tags.iteritems() if v is None]
-            for rm in to_remove:
-                self.__tags.pop(rm)
+            self._remove_deleted_tags()
             
             return f
         except IOError:
@@ -361,22 +461,52 @@ class Track(object):
             logger.exception("Unknown exception: Could not write tags to file")
             return False
 
-    def read_tags(self):
+    def _remove_deleted_tags(self):
+        """
+            Removes the tags set to None, once the file was written
+        """
+        to_remove = [k for k,v in self.__tags.iteritems() if v is None]
+        for rm in to_remove:
+            self.__tags.pop(rm)
+
+    def read_tags(self, mtime=None, notify_changed=True, fast=False):
         """
             Reads tags from the file for this Track.
 
+            Only the tags whose values differ from the ones of the Track
+            are set, so rereading an unchanged file changes nothing.
+
+            :param mtime: the modification time of the file, if the
+                caller already knows it
+            :param notify_changed: whether to send a signal for each tag
+                that changed, see set_tag_raw
+            :param fast: whether to read the tags with
+                :func:`xl.metadata.probe`, which is faster for scanning
+
             Returns False if unsuccessful, and a Format object from
-            `xl.metadata` otherwise.
+            `xl.metadata` otherwise, or a :class:`xl.metadata.ProbeResult`
+            if fast is True.
         """
+        def set_tag(tag, values):
+            if self.__tags.get(tag) != self._xform_set_values(tag, values):
+                self.set_tag_raw(tag, values, notify_changed=notify_changed)
+
         loc = self.get_loc_for_io()
         try:
-            f = metadata.get_format(loc)
-            if f is None:
-                self._scan_valid = False
-                return False # not a supported type
-            ntags = f.read_all()
+            if fast:
+                result = metadata.probe(loc)
+                if result is None:
+                    self._scan_valid = False
+                    return False # not a supported type
+                f, ntags = result.format, result.tags
+            else:
+                f = result = metadata.get_format(loc)
+                if f is None:
+                    self._scan_valid = False
+                    return False # not a supported type
+                ntags = f.read_all()
             for k, v in ntags.iteritems():
-                self.set_tag_raw(k, v)
+                set_tag(k, v)
                 
             # remove tags that could be in the file, but are in fact not
             # in the file. Retain tags in the DB that aren't supported by
@@ -393,19 +523,19 @@ class Track(object):
                 to_del &= set(f.tag_mapping.keys())
                 
             for tag in to_del:
-                self.set_tag_raw(tag, None)
+                set_tag(tag, None)
             
             # fill out file specific items
             gloc = Gio.File.new_for_uri(loc)
-            mtime = gloc.query_info("time::modified", Gio.FileQueryInfoFlags.NONE, None).get_modification_time()
-            mtime = mtime.tv_sec + (mtime.tv_usec/100000.0)
-            self.set_tag_raw('__modified', mtime)
+            if mtime is None:
+                mtime = gloc.query_info("time::modified", Gio.FileQueryInfoFlags.NONE, None).get_modification_time()
+                mtime = mtime.tv_sec + (mtime.tv_usec/100000.0)
+            set_tag('__modified', mtime)
             # TODO: this probably breaks on non-local files
             path = gloc.get_parent().get_path()
-            self.set_tag_raw('__basedir', path)
-            self._dirty = True
+            set_tag('__basedir', path)
             self._scan_valid = True
-            return f
+            return result
         except Exception:
             self._scan_valid = False
             logger.exception("Error reading tags for %s", loc)
@@ -517,7 +647,7 @@ class Track(object):
         # the user wanted the tag to be deleted
         self.__tags[tag] = self._xform_set_values(tag, values)
 
-        self._dirty = True
+        self.__set_dirty(tag)
         if notify_changed:
             event.log_event("track_tags_changed", self, tag)
 
@@ -557,6 +687,30 @@ class Track(object):
                 tag=="albumartist".
             :param extend_title: If the title tag is unknown, try to
                 add some identifying information to it.
+
+            The values are cached until the track is modified or the
+            strip list setting changes, so that sorting many tracks
+            repeatedly doesn't format them again.
+        """
+        key = (tag, join, artist_compilations)
+        cache = self.__sort_cache
+        if cache is None or cache[0] != Track.__sort_generation:
+            cache = self.__sort_cache = (Track.__sort_generation, {})
+        try:
+            value = cache[1][key]
+        except KeyError:
+            value = self.__get_tag_sort(tag, join, artist_compilations)
+            if len(cache[1]) >= _SORT_CACHE_KEYS:
+                cache[1].clear()
+            cache[1][key] = value
+        # don't let callers modify the cached list
+        if isinstance(value, list):
+            return list(value)
+        return value
+
+    def __get_tag_sort(self, tag, join, artist_compilations):
+        """
+            Computes a value for get_tag_sort
         """
         # The two magic values here are to ensure that compilations
         # and unknown values are always sorted below all normal
@@ -744,16 +898,60 @@ class Track(object):
             
         return value
     
+    def _get_search_values(self, tag, lower=False):
+        """
+            Returns the values of a tag the way the search system
+            compares them: like get_tag_search(tag, format=False), but
+            always as a tuple, which is (None,) if the tag is not set.
+
+            The values are cached until the track is modified, so that
+            repeated searches don't normalize them again.
+
+            :param lower: whether to return the values lowercased
+
+            internal use only please
+        """
+        cache = self.__search_cache
+        if cache is None:
+            cache = self.__search_cache = {}
+        try:
+            values, lowered = cache[tag]
+        except KeyError:
+            values = self.get_tag_search(tag, format=False)
+            if values == '__null__':
+                values = (None,)
+            elif isinstance(values, list):
+                values = tuple(values)
+            else:
+                values = (values,)
+            lowered = tuple([v if v is None else v.lower() for v in values])
+            # don't keep two copies of values that are already lowercase
+            if lowered == values:
+                lowered = values
+            if len(cache) >= _SEARCH_CACHE_TAGS:
+                cache.clear()
+            cache[tag] = (values, lowered)
+        if lower:
+            return lowered
+        return values
+
     def _get_format_obj(self):
-        f = _CACHER.get(self)
+        loc = self.get_loc_for_io()
+        # only local files are checked for changes, as querying other
+        # locations is slow
+        get_mtime = None
+        if loc.startswith('file://'):
+            get_mtime = lambda: _get_mtime(loc)
+        f = _CACHER.get(self, get_mtime)
         if not f:
+            mtime = get_mtime and get_mtime()
             try:
-                f = metadata.get_format(self.get_loc_for_io())
+                f = metadata.get_format(loc)
             except Exception: # TODO: What exception?
                 return None
             if not f:
                 return None
-        _CACHER.add(self, f)
+            _CACHER.add(self, f, mtime)
         return f
     
     def get_tag_disk(self, tag):
@@ -976,6 +1174,7 @@ class Track(object):
         """
         if data == "collection/strip_list":
             cls._Track__the_cuts = settings.get_option('collection/strip_list', [])
+            cls._Track__sort_generation += 1
 
     ### Utility method intended for TrackDB ###
     
@@ -984,5 +1183,15 @@ class Track(object):
         '''Internal API, returns number of track objects we have'''
         return len(cls._Track__tracksdict)
 
+    @classmethod
+    def _register_trackdb(cls, db):
+        '''
+            Internal API, registers a TrackDB whose _track_dirtied method
+            will be called whenever a track is modified
+        '''
+        refs = [ref for ref in cls._Track__trackdbs if ref() is not None]
+        refs.append(weakref.ref(db))
+        cls._Track__trackdbs = tuple(refs)
+
 event.add_callback(Track._the_cuts_cb, 'collection_option_set')
 
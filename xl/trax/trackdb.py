@@ -26,14 +26,17 @@
 
 from __future__ import absolute_import
 
+import bisect
+import itertools
 import logging
-import shelve
 
 from copy import deepcopy
 
 from xl import common, event
 from xl.nls import gettext as _
 
+from xl.trax.index import SearchIndex
+from xl.trax.storage import ShelveStorage
 from xl.trax.track import Track
 from xl.trax.util import sort_tracks
 from xl.trax.search import search_tracks_from_string
@@ -41,7 +44,17 @@ from xl.trax.search import search_tracks_from_string
 logger = logging.getLogger(__name__)
 
 
+# source of TrackDB generations, shared so that a generation identifies
+# both the TrackDB and its state
+_generations = itertools.count(1)
+
 class TrackHolder(object):
+    """
+        Holds a track of a :class:`TrackDB`, along with its key and
+        attributes.
+    """
+    __slots__ = ['_track', '_key', '_attrs']
+
     def __init__(self, track, key, **kwargs):
         self._track = track
         self._key = key
@@ -78,8 +91,15 @@ class TrackDB(object):
                 of :class:`Track` objects.
         :param load_first: Set to True if this collection should be
                 loaded before any tracks are created. 
+        :param storage: The :class:`xl.trax.storage.TrackDBStorage`
+                subclass used to load and save this :class:`TrackDB`.
+                Defaults to :class:`xl.trax.storage.ShelveStorage`.
     """
-    def __init__(self, name="", location="", pickle_attrs=[], loadfirst=False):
+    _dbversion = 2.0
+    _dbminorversion = 0
+
+    def __init__(self, name="", location="", pickle_attrs=[], loadfirst=False,
+            storage=None):
         """
             Sets up the trackDB.
         """
@@ -92,15 +112,21 @@ class TrackDB(object):
         
         self.name = name
         self.location = location
+        self._storage = storage or ShelveStorage
         self._dirty = False
+        # TrackHolders whose tracks have changed since the last save
+        self._dirty_tracks = set()
         self.tracks = {}
+        # sorted locations of the tracks, see get_locations_under
+        self._sorted_locations = None
         self.pickle_attrs = pickle_attrs
         self.pickle_attrs += ['tracks', 'name', '_key']
         self._saving = False
         self._key = 0
-        self._dbversion = 2.0
-        self._dbminorversion = 0
         self._deleted_keys = []
+        self._search_index = SearchIndex(self.get_tracks)
+        self._generation = next(_generations)
+        Track._register_trackdb(self)
         if location:
             self.load_from_location()
             self._timeout_save()
@@ -174,61 +200,93 @@ class TrackDB(object):
                     _("You did not specify a location to load the db from"))
 
         logger.debug("Loading %s DB from %s." % (self.name, location))
-                    
+
+        storage = self._storage(location)
         try:
-            try:
-                pdata = shelve.open(location, flag='c',
-                        protocol=common.PICKLE_PROTOCOL)
-            except ImportError:
-                import bsddb3 # ArchLinux disabled bsddb in python2, so we have to use the external module
-                _db = bsddb3.hashopen(location, 'c')
-                pdata = shelve.Shelf(_db, protocol=common.PICKLE_PROTOCOL)
-            if "_dbversion" in pdata:
-                if int(pdata['_dbversion']) > int(self._dbversion):
+            storage.open()
+            version = storage.get_version()
+            if version is not None:
+                if int(version) > int(self._dbversion):
                     raise common.VersionError("DB was created on a newer Exaile version.")
-                elif pdata['_dbversion'] < self._dbversion:
-                    logger.info("Upgrading DB format....")
-                    import shutil
-                    shutil.copyfile(location,
-                            location + "-%s.bak"%pdata['_dbversion'])
-                    import xl.migrations.database as dbmig
-                    dbmig.handle_migration(self, pdata, pdata['_dbversion'],
-                            self._dbversion)
+                elif version < self._dbversion:
+                    storage.migrate(version, self._dbversion)
 
         except common.VersionError:
+            storage.close()
             raise
         except Exception:
             logger.exception("Failed to open music DB.")
+            storage.close()
             return
 
         for attr in self.pickle_attrs:
             try:
                 if 'tracks' == attr:
                     data = {}
-                    for k in (x for x in pdata.keys() \
-                            if x.startswith("tracks-")):
-                        p = pdata[k]
-                        tr = Track(_unpickles=p[0])
-                        loc = tr.get_loc_for_io()
+                    duplicates = []
+                    for loc, holder in self.__load_holders(storage):
                         if loc not in data:
-                            data[loc] = TrackHolder(tr, p[1], **p[2])
+                            data[loc] = holder
                         else:
                             logger.warning("Duplicate track found: %s" % loc )
                             # presumably the second track was written because of an error, 
                             # so use the first track found. 
-                            del pdata[k]
+                            duplicates.append(holder._key)
+                    if duplicates:
+                        storage.delete_tracks(duplicates)
+                        storage.commit()
                             
                     setattr(self, attr, data)
                 else:
-                    setattr(self, attr, pdata.get(attr, getattr(self, attr)))
+                    setattr(self, attr, storage.get(attr, getattr(self, attr)))
             except Exception:
                 # FIXME: Do something about this
                 logger.exception("Exception occurred while loading %s" % location)
 
-        pdata.close()
+        storage.close()
 
+        self._dirty_tracks = set()
+        self._sorted_locations = None
+        self._search_index.clear()
+        self._generation = next(_generations)
         self._dirty = False
 
+    @staticmethod
+    def __load_holders(storage):
+        for key, tags, attrs in storage.iter_tracks():
+            tr = Track(_unpickles=tags)
+            yield tr.get_loc_for_io(), TrackHolder(tr, key, **attrs)
+
+    def _track_dirtied(self, track, tag):
+        """
+            Called by :class:`xl.trax.Track` whenever a tag of a track is
+            modified, so that only the changed tracks are written on the
+            next save.
+        """
+        holder = self.tracks.get(track.get_loc_for_io())
+        if holder is not None and holder._track is track:
+            self._dirty_tracks.add(holder)
+            self._search_index.update_track(track, tag)
+            self._generation = next(_generations)
+
+    def get_generation(self):
+        """
+            Returns a number that changes whenever tracks are added,
+            removed or modified, so that results computed from the
+            tracks can be reused as long as it stays the same.
+
+            Generations are unique across all TrackDBs.
+        """
+        return self._generation
+
+    def get_search_index(self):
+        """
+            Returns the :class:`xl.trax.index.SearchIndex` of the tracks
+            in this :class:`TrackDB`, to be passed to
+            :func:`xl.trax.search_tracks`.
+        """
+        return self._search_index
+
     @common.synchronized
     def save_to_location(self, location=None):
         """
@@ -238,13 +296,7 @@ class TrackDB(object):
             :param location: the location to save the data to
             :type location: string
         """
-        if not self._dirty:
-            for track in self.tracks.itervalues():
-                if track._track._dirty:
-                    self._dirty = True
-                    break
-
-        if not self._dirty:
+        if not self._dirty and not self._dirty_tracks:
             return
 
         if not location:
@@ -259,46 +311,53 @@ class TrackDB(object):
 
         logger.debug("Saving %s DB to %s." % (self.name, location))
 
+        storage = self._storage(location)
         try:
-            try:
-                pdata = shelve.open(location, flag='c',
-                        protocol=common.PICKLE_PROTOCOL)
-            except ImportError:
-                import bsddb3
-                _db = bsddb3.hashopen(location, 'c')
-                pdata = shelve.Shelf(_db, protocol=common.PICKLE_PROTOCOL)
-            if pdata.get('_dbversion', self._dbversion) > self._dbversion:
+            storage.open()
+            if (storage.get_version() or self._dbversion) > self._dbversion:
                 raise common.VersionError("DB was created on a newer Exaile.")
         except Exception:
             logger.exception("Failed to open music DB for writing.")
+            storage.close()
+            self._saving = False
             return
 
-        for attr in self.pickle_attrs:
-            # bad hack to allow saving of lists/dicts of Tracks
-            if 'tracks' == attr:
-                for k, track in self.tracks.iteritems():
-                    key = "tracks-%s" % track._key
-                    if track._track._dirty or key not in pdata:
-                        pdata[key] = (
-                            track._track._pickles(),
-                            track._key,
-                            deepcopy(track._attrs)
-                        )
-            else:
-                pdata[attr] = deepcopy(getattr(self, attr))
-
-        pdata['_dbversion'] = self._dbversion
+        if location == self.location:
+            # anything modified from now on will be written by the next save
+            dirty_tracks, self._dirty_tracks = self._dirty_tracks, set()
+            deleted_keys, self._deleted_keys = self._deleted_keys, []
+        else:
+            # a different location won't have any of our records yet
+            dirty_tracks = set(self.tracks.itervalues())
+            deleted_keys = []
 
-        for key in self._deleted_keys:
-            key = "tracks-%s" % key
-            if key in pdata:
-                del pdata[key]
+        try:
+            storage.delete_tracks(deleted_keys)
 
-        pdata.sync()
-        pdata.close()
+            for attr in self.pickle_attrs:
+                # bad hack to allow saving of lists/dicts of Tracks
+                if 'tracks' == attr:
+                    storage.write_tracks(
+                        (track._key, track._track._pickles(),
+                            deepcopy(track._attrs))
+                        for track in dirty_tracks)
+                    for track in dirty_tracks:
+                        track._track._dirty = False
+                else:
+                    storage.set(attr, deepcopy(getattr(self, attr)))
 
-        for track in self.tracks.itervalues():
-            track._track._dirty = False
+            storage.set('_dbversion', self._dbversion)
+            storage.commit()
+        except Exception:
+            logger.exception("Failed to save music DB.")
+            if location == self.location:
+                # try again on the next save
+                self._dirty_tracks |= dirty_tracks
+                self._deleted_keys += deleted_keys
+            self._saving = False
+            return
+        finally:
+            storage.close()
 
         self._dirty = False
         self._saving = False
@@ -325,11 +384,7 @@ class TrackDB(object):
             Returns True if loc is a track in this collection, False
             if it is not
         """
-        # check for the actual track
-        if self.get_track_by_loc(loc):
-            return True
-        else:
-            return False
+        return loc in self.tracks
 
     def get_count(self):
         """
@@ -352,13 +407,28 @@ class TrackDB(object):
             Like add(), but takes a list of :class:`xl.trax.Track`
         """
         locations = []
+        new_locations = []
 
         for tr in tracks:
             location = tr.get_loc_for_io()
             locations += [location]
-            self.tracks[location] = TrackHolder(tr, self._key)
+            if location not in self.tracks:
+                new_locations.append(location)
+            holder = TrackHolder(tr, self._key)
+            self.tracks[location] = holder
+            self._dirty_tracks.add(holder)
             self._key += 1
 
+        sorted_locations = self._sorted_locations
+        if sorted_locations is not None:
+            if len(new_locations) > 64:
+                sorted_locations.extend(new_locations)
+                sorted_locations.sort()
+            else:
+                for location in new_locations:
+                    bisect.insort(sorted_locations, location)
+        self._search_index.add_tracks(tracks)
+        self._generation = next(_generations)
         event.log_event('tracks_added', self, locations)
 
         self._dirty = True
@@ -381,16 +451,137 @@ class TrackDB(object):
         for tr in tracks:
             location = tr.get_loc_for_io()
             locations += [location]
-            self._deleted_keys.append(self.tracks[location]._key)
-            del self.tracks[location]
-
+            holder = self.tracks.pop(location)
+            self._dirty_tracks.discard(holder)
+            self._deleted_keys.append(holder._key)
+
+        sorted_locations = self._sorted_locations
+        if sorted_locations is not None:
+            if len(locations) > 64:
+                removed = set(locations)
+                self._sorted_locations = [location
+                        for location in sorted_locations
+                        if location not in removed]
+            else:
+                for location in locations:
+                    del sorted_locations[
+                            bisect.bisect_left(sorted_locations, location)]
+        self._search_index.remove_tracks(tracks)
+        self._generation = next(_generations)
         event.log_event('tracks_removed', self, locations)
 
         self._dirty = True
 
+    @common.synchronized
+    def relocate_tracks(self, moves):
+        """
+            Changes the locations of tracks in the database, e.g. after
+            their files were moved, keeping everything else about them.
+
+            For the listeners, the tracks are removed from their old
+            locations and added at the new ones.
+
+            :param moves: list of (:class:`xl.trax.Track`, new location)
+                tuples. Tracks whose new location is already taken are
+                left alone.
+        """
+        old_locations = []
+        new_locations = []
+        tracks = []
+
+        for tr, location in moves:
+            old_location = tr.get_loc_for_io()
+            if location in self.tracks or old_location not in self.tracks:
+                logger.warning("Not moving %s to %s", old_location, location)
+                continue
+            holder = self.tracks.pop(old_location)
+            tr.set_loc(location, notify_changed=False)
+            location = tr.get_loc_for_io()
+            self.tracks[location] = holder
+            self._dirty_tracks.add(holder)
+            old_locations.append(old_location)
+            new_locations.append(location)
+            tracks.append(tr)
+
+        if not tracks:
+            return
+        sorted_locations = self._sorted_locations
+        if sorted_locations is not None:
+            if len(tracks) > 64:
+                removed = set(old_locations)
+                sorted_locations = [location
+                        for location in sorted_locations
+                        if location not in removed]
+                sorted_locations.extend(new_locations)
+                sorted_locations.sort()
+                self._sorted_locations = sorted_locations
+            else:
+                for location in old_locations:
+                    del sorted_locations[
+                            bisect.bisect_left(sorted_locations, location)]
+                for location in new_locations:
+                    bisect.insort(sorted_locations, location)
+        for tr in tracks:
+            self._search_index.update_track(tr, '__loc')
+        self._generation = next(_generations)
+        event.log_event('tracks_removed', self, old_locations)
+        event.log_event('tracks_added', self, new_locations)
+
+        self._dirty = True
+
     def get_tracks(self):
-        return list(self)
+        """
+            Returns a list of all tracks. Unlike iterating over the
+            TrackDB, this can be done while other threads add or remove
+            tracks.
+        """
+        # dict.values() copies the holders without releasing the GIL.
+        # Taking the lock instead could deadlock with the search index,
+        # which calls this with its own lock held.
+        return [holder._track for holder in self.tracks.values()]
+
+    @common.synchronized
+    def get_locations_under(self, uri):
+        """
+            Returns the locations of the tracks inside a directory,
+            without looking at the other tracks.
+
+            :param uri: the URI of the directory
+            :returns: a sorted list of locations
+        """
+        if self._sorted_locations is None:
+            self._sorted_locations = sorted(self.tracks)
+        sorted_locations = self._sorted_locations
+        prefix = uri.rstrip('/') + '/'
+        # '0' comes right after '/'
+        return sorted_locations[bisect.bisect_left(sorted_locations, prefix):
+                bisect.bisect_left(sorted_locations, prefix[:-1] + '0')]
+
+    def get_tracks_under(self, uri):
+        """
+            Returns the tracks inside a directory, see
+            get_locations_under.
 
+            :param uri: the URI of the directory
+            :returns: a list of :class:`xl.trax.Track`
+        """
+        tracks = []
+        for location in self.get_locations_under(uri):
+            holder = self.tracks.get(location)
+            if holder is not None:
+                tracks.append(holder._track)
+        return tracks
+
+    @common.synchronized
+    def search_session(self, session, search_string, keyword_tags=None):
+        """
+            Searches the tracks with a :class:`xl.trax.SearchSession`,
+            holding the lock of this TrackDB so that no tracks are added
+            or removed while it runs.
+
+            :returns: the results of :meth:`SearchSession.search`
+        """
+        return session.search(self, search_string, keyword_tags=keyword_tags)
 
     def search(self, query, sort_fields=[], return_lim=-1,
             tracks=None, reverse=False):
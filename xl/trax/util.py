@@ -24,13 +24,25 @@
 # do so. If you do not wish to do so, delete this exception statement
 # from your version.
 
+import bisect
+import hashlib
+import logging
+import threading
+
 from gi.repository import Gio
 from gi.repository import GLib
 
-from xl import metadata
-from xl.trax.track import Track
-from xl.trax.search import search_tracks, TracksMatcher
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from xl import common, event, metadata
+from xl.metadata.tags import disk_tags
+from xl.trax.track import Track, _CACHER
+from xl.trax.search import search_tracks_from_string
 
+logger = logging.getLogger(__name__)
 
 def is_valid_track(location):
     """
@@ -44,6 +56,59 @@ def is_valid_track(location):
     extension = Gio.File.new_for_uri(location).get_basename().split(".")[-1]
     return extension.lower() in metadata.formats
 
+# number of bytes read at the start and at the end of a file to compute
+# its fingerprint
+FINGERPRINT_BLOCK = 64 * 1024
+
+def get_fingerprint(gloc, size=None):
+    """
+        Computes a fingerprint of the contents of a file, which is used
+        to recognize a track after its file was moved or renamed.
+
+        Only the size of the file and its first and last
+        FINGERPRINT_BLOCK bytes are looked at, so this is cheap even for
+        large files.
+
+        :param gloc: the file
+        :type gloc: :class:`Gio.File`
+        :param size: the size of the file, if already known
+        :returns: the fingerprint
+        :rtype: string
+        :raises: :class:`GLib.Error` if the file can't be read
+    """
+    if size is None:
+        size = gloc.query_info("standard::size",
+                Gio.FileQueryInfoFlags.NONE, None).get_size()
+    digest = hashlib.sha1()
+    stream = gloc.read(None)
+    try:
+        if size <= 2 * FINGERPRINT_BLOCK:
+            digest.update(_read_bytes(stream, size))
+        else:
+            digest.update(_read_bytes(stream, FINGERPRINT_BLOCK))
+            stream.seek(size - FINGERPRINT_BLOCK, GLib.SeekType.SET, None)
+            digest.update(_read_bytes(stream, FINGERPRINT_BLOCK))
+    finally:
+        stream.close(None)
+    return '%d:%s' % (size, digest.hexdigest())
+
+def get_fingerprint_size(fingerprint):
+    """
+        :param fingerprint: a fingerprint returned by get_fingerprint
+        :returns: the size of the file it was computed from
+    """
+    return int(fingerprint.split(':', 1)[0])
+
+def _read_bytes(stream, count):
+    chunks = []
+    while count > 0:
+        chunk = stream.read_bytes(count, None).get_data()
+        if not chunk:
+            break
+        chunks.append(chunk)
+        count -= len(chunk)
+    return b''.join(chunks)
+
 def get_uris_from_tracks(tracks):
     """
         Returns all URIs for tracks
@@ -90,6 +155,73 @@ def get_tracks_from_uri(uri):
         tracks = [Track(uri)]
     return tracks
 
+class _SortRanks(object):
+    """
+        Gives every sort key seen so far an integer rank, so that
+        comparing the ranks of two keys gives the same result as
+        comparing the keys. Sorting by ranks is much faster than
+        comparing unicode strings over and over.
+
+        New keys are given a rank between those of their neighbours,
+        so the table only has to be renumbered once the gap between
+        two neighbours is used up.
+    """
+    # distance between the ranks of neighbouring keys after renumbering
+    GAP = 1 << 16
+    # number of keys after which the table is started over, so that it
+    # doesn't keep the keys of tracks that are long gone forever
+    LIMIT = 1 << 21
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []     # all keys, sorted
+        self._ranks = {}    # key -> rank
+
+    def get_ranks(self, keys):
+        """
+            :param keys: a list of sort keys
+            :returns: a list of the ranks of the keys
+            :raises TypeError: if a key can't be ranked
+        """
+        with self._lock:
+            ranks = self._ranks
+            new = set(key for key in keys if key not in ranks)
+            if new:
+                self.__add(new, keys)
+                ranks = self._ranks
+            return [ranks[key] for key in keys]
+
+    def __add(self, new, requested):
+        keys = self._keys
+        if len(keys) + len(new) > self.LIMIT:
+            # start over with the keys of this request only; all of them
+            # need a rank, not just the ones that weren't known yet
+            self.__renumber(sorted(set(requested)))
+            return
+        # inserting into the list one by one only pays off for a few keys
+        if len(new) > 64 or len(new) * 8 > len(keys):
+            self.__renumber(sorted(keys + list(new)))
+            return
+        ranks = self._ranks
+        for key in sorted(new):
+            i = bisect.bisect_left(keys, key)
+            low = ranks[keys[i - 1]] if i > 0 else 0
+            high = ranks[keys[i]] if i < len(keys) else low + 2 * self.GAP
+            if high - low < 2:
+                keys.insert(i, key)
+                self.__renumber(keys)
+                ranks = self._ranks
+                continue
+            keys.insert(i, key)
+            ranks[key] = (low + high) // 2
+
+    def __renumber(self, keys):
+        self._keys = keys
+        self._ranks = dict((key, (i + 1) * self.GAP)
+                for i, key in enumerate(keys))
+
+_sort_ranks = _SortRanks()
+
 def sort_tracks(fields, iter, trackfunc=None, reverse=False, artist_compilations=False):
     """
         Sorts tracks.
@@ -104,14 +236,38 @@ def sort_tracks(fields, iter, trackfunc=None, reverse=False, artist_compilations
         :type trackfunc: function or None
         :param reverse: whether to sort in reversed order
         :type reverse: boolean
+
+        The sort keys are replaced by integer ranks (see _SortRanks),
+        which are sorted using NumPy if it is available.
     """
     fields = list(fields) # we need the index method
     if trackfunc is None:
         trackfunc = lambda tr: tr
-    keyfunc = lambda tr: [trackfunc(tr).get_tag_sort(field,
-        artist_compilations=artist_compilations) for field in fields]
-    
-    return sorted(iter, key=keyfunc, reverse=reverse)
+    items = list(iter)
+    if not fields or len(items) < 2:
+        return items
+
+    try:
+        columns = [_sort_ranks.get_ranks([trackfunc(item).get_tag_sort(field,
+                artist_compilations=artist_compilations) for item in items])
+                for field in fields]
+    except TypeError:
+        # unhashable sort keys, compare them directly
+        keyfunc = lambda tr: [trackfunc(tr).get_tag_sort(field,
+            artist_compilations=artist_compilations) for field in fields]
+        return sorted(items, key=keyfunc, reverse=reverse)
+
+    if numpy is not None:
+        columns = [numpy.array(column, dtype=numpy.int64)
+                for column in reversed(columns)]
+        if reverse:
+            # keeps equal items in their original order, like sorted()
+            columns = [-column for column in columns]
+        return [items[i] for i in numpy.lexsort(columns)]
+
+    keys = zip(*columns)
+    order = sorted(xrange(len(items)), key=keys.__getitem__, reverse=reverse)
+    return [items[i] for i in order]
 
 def sort_result_tracks(fields, trackiter, reverse=False, artist_compilations=False):
     """
@@ -158,5 +314,123 @@ def get_album_tracks(tracksiter, track, artist_compilations=False):
     """
     if not all(track.get_tag_raw(t) for t in ['artist', 'album']):
         return []
-    matchers = map(lambda t: TracksMatcher(track.get_tag_search(t, artist_compilations=artist_compilations)), ['artist', 'album'])
-    return (r.track for r in search_tracks(tracksiter, matchers))
+    search_string = ' '.join(track.get_tag_search(t,
+            artist_compilations=artist_compilations)
+            for t in ['artist', 'album'])
+    return (r.track for r in
+            search_tracks_from_string(tracksiter, search_string))
+
+# number of files a TagWriteJob writes at the same time
+DEFAULT_TAG_WRITE_WORKERS = 4
+
+class TagWriteJob(common.ProgressThread):
+    """
+        Writes tag changes of many tracks to their files, several files
+        at a time.
+
+        Only the changed tags are written, and tags starting with '__'
+        are only set on the tracks. The tags of a track are updated
+        once its file was written, without sending 'track_tags_changed'
+        for each of them: when the job is done, a single
+        'tracks_tags_changed' event is sent with the job as object and
+        a list of (track, changed tags) tuples as data.
+
+        The 'progress-update' signal is emitted with (n, total) after
+        each file. Files that couldn't be written are listed in the
+        errors attribute as (track, exception) tuples, and their tracks
+        are left unchanged.
+
+        The job can be started as a thread, or its run method can be
+        called directly to write the tags in the calling thread. The
+        signals are emitted on the thread of the job, so user interfaces
+        should start it and handle them with GLib.idle_add.
+
+        Simple usage:
+
+        >>> job = TagWriteJob([(track, {'genre': u'Jazz'})])
+        >>> job.run()
+        >>> print job.errors
+        []
+    """
+    def __init__(self, changes, workers=DEFAULT_TAG_WRITE_WORKERS):
+        """
+            :param changes: (track, tags) tuples, where tags maps tag
+                names to the new values; a value of None removes the tag
+            :param workers: the number of files written at the same time
+            :type workers: int
+        """
+        common.ProgressThread.__init__(self)
+        self.changes = [(track, dict(tags)) for track, tags in changes]
+        self.workers = workers
+        self.written = []
+        self.errors = []
+        self.__stopped = threading.Event()
+
+    def stop(self):
+        """
+            Stops the job after the files being written
+        """
+        self.__stopped.set()
+        common.ProgressThread.stop(self)
+
+    def run(self):
+        """
+            Writes the tags
+        """
+        total = len(self.changes)
+        pool = common.WorkerPool(min(self.workers, total),
+                name='TagWriteJob')
+        jobs = [pool.submit(self._write_file, track, tags)
+                for track, tags in self.changes]
+        pool.close()
+
+        for n, (job, (track, tags)) in enumerate(zip(jobs, self.changes)):
+            if self.__stopped.is_set():
+                pool.close(cancel=True)
+            try:
+                if job.get() is None:
+                    # cancelled before it was started
+                    continue
+            except Exception as e:
+                logger.warning('Could not write tags to %s: %s',
+                        track.get_loc_for_io(), e)
+                self.errors.append((track, e))
+            else:
+                self._apply(track, tags)
+            self.emit('progress-update', (n + 1, total))
+
+        if self.written:
+            event.log_event('tracks_tags_changed', self, self.written)
+        if not self.__stopped.is_set():
+            self.emit('done')
+
+    def _write_file(self, track, tags):
+        """
+            Writes the changed tags to the file of track, called on
+            the worker threads
+
+            :returns: True
+            :raises: :class:`xl.metadata.NotWritable` if the format of
+                the file isn't supported, or any error of the format
+        """
+        filetags = dict((tag, track._xform_set_values(tag, values))
+                for tag, values in tags.iteritems()
+                if not tag.startswith('__'))
+        if filetags:
+            f = metadata.get_format(track.get_loc_for_io())
+            if f is None:
+                raise metadata.NotWritable('unsupported format')
+            f.write_tags(filetags)
+            _CACHER.remove(track)
+        return True
+
+    def _apply(self, track, tags):
+        """
+            Sets the written tags on track
+        """
+        for tag, values in tags.iteritems():
+            if tag not in disk_tags:
+                track.set_tag_raw(tag, values, notify_changed=False)
+        # like Track.write_tags, forget the tags that were deleted
+        track._remove_deleted_tags()
+        self.written.append((track, set(tags)))
@@ -329,6 +329,8 @@ class MainWindow(GObject.GObject):
         event.add_ui_callback(self.on_toggle_pause, 'playback_toggle_pause',
             player.PLAYER)
         event.add_ui_callback(self.on_track_tags_changed, 'track_tags_changed')
+        event.add_ui_callback(self.on_tracks_tags_changed,
+            'tracks_tags_changed')
         event.add_ui_callback(self.on_buffering, 'playback_buffering',
             player.PLAYER)
         event.add_ui_callback(self.on_playback_error, 'playback_error',
@@ -624,6 +626,13 @@ class MainWindow(GObject.GObject):
         if track is player.PLAYER.current:
             self._update_track_information()
 
+    def on_tracks_tags_changed(self, type, job, changes):
+        """
+            Called when tags of several tracks are written at once
+        """
+        if any(track is player.PLAYER.current for track, tags in changes):
+            self._update_track_information()
+
     def on_collection_tree_loaded(self, tree):
         """
             Updates information on collection tree load
@@ -192,6 +192,13 @@ class CollectionPanel(panel.Panel):
         self.order = None
         self.tracks = []
         self.sorted_tracks = []
+        # position of each track in self.tracks
+        self._track_positions = {}
+        self._sorted_positions = {}
+        self._search_session = trax.SearchSession(case_sensitive=False)
+        self._tree_serial = 0
+        # the keyword and order the tree was last filled with
+        self._tree_view = None
 
         event.add_ui_callback(self._check_collection_empty, 'libraries_modified',
             collection)
@@ -255,6 +262,8 @@ class CollectionPanel(panel.Panel):
         })
         self.tree.connect('key-release-event', self.on_key_released)
         event.add_ui_callback(self.refresh_tags_in_tree, 'track_tags_changed')
+        event.add_ui_callback(self.on_tracks_tags_changed,
+            'tracks_tags_changed')
         event.add_ui_callback(self.refresh_tracks_in_tree, 
             'tracks_added', self.collection)
         event.add_ui_callback(self.refresh_tracks_in_tree, 
@@ -406,10 +415,24 @@ class CollectionPanel(panel.Panel):
         """
         self.load_subtree(iter)
         search = self.get_node_search_terms(iter)
-        matcher = trax.TracksMatcher(search)
-        srtrs = trax.search_tracks(self.tracks, [matcher])
+        srtrs = self._search_tracks(search)
         return [ x.track for x in srtrs ]
 
+    def _search_tracks(self, search):
+        """
+            Searches the tracks shown in the tree, keeping their order.
+            The tracks are looked up in the collection's index, so that
+            only the tracks that can match are checked.
+        """
+        matcher = trax.TracksMatcher(search)
+        tracks = self.tracks
+        candidates = matcher.candidates(self.collection.get_search_index())
+        if candidates is not None:
+            positions = self._track_positions
+            tracks = [tracks[i] for i in sorted(
+                positions[tr] for tr in candidates if tr in positions)]
+        return trax.search_tracks(tracks, [matcher])
+
     def append_to_playlist(self, item=None, event=None, replace=False):
         """
             Adds items to the current playlist
@@ -482,6 +505,16 @@ class CollectionPanel(panel.Panel):
             self.collection.loc_is_member(track.get_loc_for_io()):
             self._refresh_tags_in_tree()
 
+    def on_tracks_tags_changed(self, type, job, changes):
+        if not settings.get_option('gui/sync_on_tag_change', True):
+            return
+        sort_tags = set(self.order.all_sort_tags())
+        for track, tags in changes:
+            if tags & sort_tags and \
+                self.collection.loc_is_member(track.get_loc_for_io()):
+                self._refresh_tags_in_tree()
+                return
+
     def refresh_tracks_in_tree(self, type, obj, loc):
         self._refresh_tags_in_tree()
 
@@ -504,6 +537,8 @@ class CollectionPanel(panel.Panel):
 #        print "sorting...", time.clock()
         self.sorted_tracks = trax.sort_tracks(self.order.get_sort_tags(0),
             self.collection.get_tracks())
+        self._sorted_positions = dict((tr, i)
+                for i, tr in enumerate(self.sorted_tracks))
 #        print "sorted.", time.clock()
 
     def load_tree(self):
@@ -511,14 +546,17 @@ class CollectionPanel(panel.Panel):
             Loads the Gtk.TreeView for this collection panel.
 
             Loads tracks based on the current keyword, or all the tracks in
-            the collection associated with this panel
+            the collection associated with this panel. The collection is
+            searched in the background, reusing the results of the same
+            search while the collection is unchanged, and the search is
+            cancelled if the tree is reloaded before it is done. This
+            returns before the tree is filled; 'collection-tree-loaded'
+            is emitted once it is.
         """
         logger.debug("Reloading collection tree")
         self.current_start_count = self.start_count
-        self.tree.set_model(None)
-        self.model.clear()
+        self._tree_serial += 1
 
-        self.root = None
         oldorder = self.order
         self.order = self.orders[self.choice.get_active()]
 
@@ -533,17 +571,108 @@ class CollectionPanel(panel.Panel):
         keyword = self.keyword.strip()
         tags = list(SEARCH_TAGS)
         tags += self.order.all_search_tags()
-        tags = list(set(tags)) # uniquify list to speed up search
+        tags = sorted(set(tags)) # uniquify list to speed up search
+
+        self._search_tree(self._tree_serial, (keyword, self.order),
+                self._sorted_positions, tags)
+
+    @common.threaded
+    def _search_tree(self, serial, view, positions, tags):
+        """
+            Searches the tracks to show in the tree, and shows them in
+            the order given by positions
+        """
+        try:
+            results = self.collection.search_session(self._search_session,
+                    view[0], keyword_tags=tags)
+        except trax.SearchCancelled:
+            return
+        except Exception:
+            logger.exception("Error while searching the collection")
+            return
+        results = [srtr for srtr in results if srtr.track in positions]
+        results.sort(key=lambda srtr: positions[srtr.track])
+        GLib.idle_add(self._populate_tree, serial, view, results)
+
+    def _populate_tree(self, serial, view, tracks):
+        """
+            Fills the tree with the results of a search. If the same
+            keyword and order are shown again, the rows that were
+            expanded and selected are restored.
+        """
+        # the tree was reloaded again in the meantime
+        if serial != self._tree_serial:
+            return False
+
+        expanded = []
+        selected = []
+        if view == self._tree_view:
+            self.tree.map_expanded_rows(lambda tree, path, data:
+                    expanded.append(self._get_row_queries(path)), None)
+            model, paths = self.tree.get_selection().get_selected_rows()
+            selected = [self._get_row_queries(path) for path in paths]
+        self._tree_view = view
+
+        self.tree.set_model(None)
+        self.model.clear()
+        self.root = None
 
-        self.tracks = list(
-                trax.search_tracks_from_string(self.sorted_tracks,
-                    keyword, case_sensitive=False, keyword_tags=tags) )
+        self.tracks = tracks
+        self._track_positions = dict((srtr.track, i)
+                for i, srtr in enumerate(self.tracks))
 
         self.load_subtree(None)
 
         self.tree.set_model(self.model)
 
+        # parents have to be expanded first to load their children
+        for queries in sorted(expanded, key=len):
+            iter = self._find_row(queries)
+            if iter is not None:
+                self.tree.expand_row(self.model.get_path(iter), False)
+        selection = self.tree.get_selection()
+        for queries in selected:
+            iter = self._find_row(queries)
+            if iter is not None:
+                selection.select_iter(iter)
+
         self.emit('collection-tree-loaded')
+        return False
+
+    def _get_row_queries(self, path):
+        """
+            Returns the search terms of the row at path and its parents,
+            from the top level down
+        """
+        queries = []
+        iter = self.model.get_iter(path)
+        while iter is not None:
+            queries.insert(0, self.model.get_value(iter, 2))
+            iter = self.model.iter_parent(iter)
+        return queries
+
+    def _find_row(self, queries):
+        """
+            Returns the iter of the row with the search terms returned
+            by _get_row_queries, or None if it doesn't exist anymore
+        """
+        iter = None
+        for query in queries:
+            iter = self.model.iter_children(iter)
+            while iter is not None and \
+                    self.model.get_value(iter, 2) != query:
+                iter = self.model.iter_next(iter)
+            if iter is None:
+                return None
+        return iter
+
+    def _expand_row(self, serial, path):
+        """
+            Expands the row at path, unless the tree was reloaded since
+        """
+        if serial == self._tree_serial:
+            self.tree.expand_row(path, False)
+        return False
 
     def _expand_node_by_name(self, search_num, parent, name, rest=None):
         """
@@ -600,8 +729,7 @@ class CollectionPanel(panel.Panel):
 
         try:
             tags = self.order.get_sort_tags(depth)
-            matchers = [trax.TracksMatcher(search)]
-            srtrs = trax.search_tracks(self.tracks, matchers)
+            srtrs = self._search_tracks(search)
             # sort only if we are not on top level, because tracks are 
             # already sorted by fist order
             if depth > 0:
@@ -702,7 +830,7 @@ class CollectionPanel(panel.Panel):
             len(self.keyword.strip()) >= \
                     settings.get_option("gui/expand_minimum_term_length", 2):
             for row in to_expand:
-                GLib.idle_add(self.tree.expand_row, row, False)
+                GLib.idle_add(self._expand_row, self._tree_serial, row)
 
         if iter_sep is not None:
             self.model.remove(iter_sep)
@@ -204,18 +204,17 @@ class TrackPropertiesDialog(GObject.GObject):
 
         return l
         
-    def _write_tag(self, track, tag, value):
-        tag_info = tag_data.get(tag)
-        if not tag_info or not tag_info.use_disk:
-            track.set_tag_raw(tag, value)
-        else:
-            track.set_tag_disk(tag, value)
+    def _tags_write(self, data, on_done=None):
+        """
+            Writes the tags in the background
 
-    def _tags_write(self, data):
-        errors = []
-        dialog = SavingProgressWindow(self.dialog, len(data))
+            :param on_done: function called once the tags were written
+                without errors
+        """
+        changes = []
         for n, trackdata in data:
             track = self.tracks[n]
+            tags = {}
             poplist = []
 
             for tag in trackdata:
@@ -224,14 +223,14 @@ class TrackPropertiesDialog(GObject.GObject):
                        and trackdata[tag] == ["0/0"]:
                         poplist.append(tag)
                         continue
-                    self._write_tag(track, tag, trackdata[tag])
+                    tags[tag] = trackdata[tag]
                 elif tag in ('__startoffset', '__stopoffset'):
                     try:
                         offset = int(trackdata[tag][0])
                     except ValueError:
                         poplist.append(tag)
                     else:
-                        track.set_tag_raw(tag, offset)
+                        tags[tag] = offset
 
             # In case a tag has been removed..
             for tag in track.list_tags():
@@ -248,15 +247,31 @@ class TrackPropertiesDialog(GObject.GObject):
                         poplist.append(tag)
 
             for tag in poplist:
-                self._write_tag(track, tag, None)
+                tags[tag] = None
 
-            if not track.write_tags():
-                errors.append(track.get_loc_for_io());
-                
-            trax.track._CACHER.remove(track)
-            dialog.step()
+            changes.append((track, tags))
+
+        dialog = SavingProgressWindow(self.dialog, len(changes))
+        job = trax.TagWriteJob(changes)
+        job.connect('progress-update',
+                lambda job, progress: GLib.idle_add(dialog.step))
+        job.connect('done', lambda job: GLib.idle_add(
+                self._on_tags_written, job, dialog, on_done))
+        job.start()
+
+    def _on_tags_written(self, job, dialog, on_done):
+        """
+            Called on the main thread once the job of _tags_write is done
+        """
         dialog.destroy()
-        
+
+        self.trackdata = self._tags_copy(self.tracks)
+        self.trackdata_original = self._tags_copy(self.tracks)
+        for row in self.rows:
+            if row.multi_id == 0:
+                row.label.set_attributes(self.__default_attributes)
+
+        errors = [track.get_loc_for_io() for track, error in job.errors]
         if len(errors) > 0:
             self.message.clear_buttons()
             self.message.add_button(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
@@ -265,6 +280,8 @@ class TrackPropertiesDialog(GObject.GObject):
                 _('Tags could not be written to the following files:\n'
                   '{files}').format(files='\n'.join(errors))
             )
+        elif on_done is not None:
+            on_done()
 
     def _build_from_track(self, position):
         self._clear_grids()
@@ -390,6 +407,15 @@ class TrackPropertiesDialog(GObject.GObject):
         self.dialog.resize(width, height)
 
     def on_apply_button_clicked(self, w):
+        self._apply_changes()
+
+    def _apply_changes(self, on_done=None):
+        """
+            Writes the modified tags
+
+            :param on_done: function called once the tags were written
+                without errors, or right away if nothing is written
+        """
         modified = []
         for n, trackdata in enumerate(self.trackdata):
             if trackdata != self.trackdata_original[n]:
@@ -406,35 +432,34 @@ class TrackPropertiesDialog(GObject.GObject):
                 dialog.destroy()
                 
                 if response != Gtk.ResponseType.YES:
+                    if on_done is not None:
+                        on_done()
                     return
-                    
-            self._tags_write(modified)
-
-            del self.trackdata
-            del self.trackdata_original
-            self.trackdata = self._tags_copy(self.tracks)
-            self.trackdata_original = self._tags_copy(self.tracks)
-
-            self.apply_button.set_sensitive(False)
-            for row in self.rows:
-                if row.multi_id == 0:
-                    row.label.set_attributes(self.__default_attributes)
 
         # Hide close confirmation if necessary
         if self.message.get_message_type() == Gtk.MessageType.QUESTION:
             self.message.hide()
 
+        if modified:
+            self.apply_button.set_sensitive(False)
+            self._tags_write(modified, on_done)
+        elif on_done is not None:
+            on_done()
+
     def _check_for_save(self):
         if self.trackdata != self.trackdata_original:
+            def close():
+                self._save_position()
+                self.dialog.destroy()
+
             def on_response(message, response):
                 """
                     Applies changes before closing if requested
                 """
                 if response == Gtk.ResponseType.APPLY:
-                    self.apply_button.clicked()
-
-                self._save_position()
-                self.dialog.destroy()
+                    self._apply_changes(close)
+                else:
+                    close()
 
             self.message.connect('response', on_response)
             self.message.clear_buttons()
@@ -1290,8 +1315,6 @@ class SavingProgressWindow(Gtk.Window):
 
         self.set_position(Gtk.WindowPosition.CENTER_ON_PARENT)
         self.show_all()
-        while Gtk.events_pending():
-            Gtk.main_iteration()
 
     def step(self):
         self.count += 1
@@ -1301,8 +1324,6 @@ class SavingProgressWindow(Gtk.Window):
             'count': self.count,
             'total': self.total
         })
-        while Gtk.events_pending():
-            Gtk.main_iteration()
 
 
 # vim: et sts=4 sw=4
@@ -694,6 +694,10 @@ class PlaylistView(AutoScrollTreeView, providers.ProviderHandler):
         self.selection.set_mode(Gtk.SelectionMode.MULTIPLE)
 
         self._filter_matcher = None
+        # the last filter results are refined while the filter is typed
+        self._filter_session = trax.SearchSession(case_sensitive=False)
+        self._filter_searched = set()
+        self._filter_results = set()
         
         self._setup_columns()
         self.columns_changed_id = self.connect("columns-changed",
@@ -709,6 +713,12 @@ class PlaylistView(AutoScrollTreeView, providers.ProviderHandler):
 
         event.add_ui_callback(self.on_option_set, "gui_option_set")
         event.add_ui_callback(self.on_playback_start, "playback_track_start", self.player)
+        event.add_ui_callback(self.on_filter_tracks_changed,
+                "playlist_tracks_added", self.playlist)
+        event.add_ui_callback(self.on_filter_tracks_changed,
+                "track_tags_changed")
+        event.add_ui_callback(self.on_filter_tracks_changed,
+                "tracks_tags_changed")
         self.connect("cursor-changed", self.on_cursor_changed )
         self.connect("row-activated", self.on_row_activated)
         self.connect("key-press-event", self.on_key_press_event)
@@ -740,14 +750,23 @@ class PlaylistView(AutoScrollTreeView, providers.ProviderHandler):
     
         if filter_string is None:
             self._filter_matcher = None
+            self._filter_session.reset()
+            self._filter_searched = set()
+            self._filter_results = set()
             self._refilter()
         else:
             # Merge default columns and currently enabled columns
-            keyword_tags = set(playlist_columns.DEFAULT_COLUMNS + [c.name for c in self.get_columns()])
+            keyword_tags = sorted(set(playlist_columns.DEFAULT_COLUMNS + [c.name for c in self.get_columns()]))
             self._filter_matcher = trax.TracksMatcher(filter_string,
                     case_sensitive=False,
                     keyword_tags=keyword_tags)
             logger.debug("Filtering playlist %r by %r.", self.playlist.name, filter_string)
+            # if the filter was only extended, this only looks at the
+            # tracks that matched before
+            results = self._filter_session.search(self.playlist,
+                    filter_string, keyword_tags=keyword_tags)
+            self._filter_searched = set(self.playlist)
+            self._filter_results = set(srtr.track for srtr in results)
             self._refilter()
             logger.debug("Filtering playlist %r by %r completed.", self.playlist.name, filter_string)
         
@@ -1289,9 +1308,24 @@ class PlaylistView(AutoScrollTreeView, providers.ProviderHandler):
     def modelfilter_visible_func(self, model, iter, data):
         if self._filter_matcher is not None:
             track = model.get_value(iter, 0)
+            if track in self._filter_searched:
+                return track in self._filter_results
+            # added or modified since the filter was set
             return self._filter_matcher.match(trax.SearchResultTrack(track))
         return True
 
+    def on_filter_tracks_changed(self, type, obj, data):
+        """
+            Called when tracks are added to the playlist or modified,
+            the results of the last filter don't apply to them anymore
+        """
+        self._filter_session.reset()
+        if type == 'track_tags_changed':
+            self._filter_searched.discard(obj)
+        elif type == 'tracks_tags_changed':
+            for track, tags in data:
+                self._filter_searched.discard(track)
+
 class PlaylistModel(Gtk.ListStore):
 
     __gsignals__ = {
@@ -1336,6 +1370,8 @@ class PlaylistModel(Gtk.ListStore):
                 "playback_player_resume", self.player)
         event.add_ui_callback(self.on_track_tags_changed,
                 "track_tags_changed")
+        event.add_ui_callback(self.on_tracks_tags_changed,
+                "tracks_tags_changed")
 
         event.add_ui_callback(self.on_option_set, "gui_option_set")
                 
@@ -1448,9 +1484,22 @@ class PlaylistModel(Gtk.ListStore):
             tag in self.columns:
             return
             
+        self._queue_redraw([track])
+
+    @guiutil.idle_add()
+    def on_tracks_tags_changed(self, type, job, changes):
+        if not settings.get_option('gui/sync_on_tag_change', True):
+            return
+
+        tracks = [track for track, tags in changes
+                  if any(tag in self.columns for tag in tags)]
+        if tracks:
+            self._queue_redraw(tracks)
+
+    def _queue_redraw(self, tracks):
         if self._redraw_timer:
             GLib.source_remove(self._redraw_timer)
-        self._redraw_queue.append( track )
+        self._redraw_queue.extend(tracks)
         self._redraw_timer = GLib.timeout_add(100, self._on_track_tags_changed)
             
     def _on_track_tags_changed(self):